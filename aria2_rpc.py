@@ -0,0 +1,255 @@
+import atexit
+import base64
+import json
+import os
+import secrets
+import socket
+import struct
+import subprocess
+import threading
+import time
+import logging
+from datetime import datetime
+
+class Aria2Error(Exception):
+	def __init__(self, message, code=None):
+		super().__init__(message)
+		self.code = code	# aria2 error code of a failed download, if any
+
+class Aria2Service:
+	'''One long-lived aria2c in JSON-RPC mode, shared by all downloads.
+
+	Downloads are submitted over RPC, and completion is reported by the notifications aria2c pushes over its
+	WebSocket, so that waiting for a download doesn't poll. Since all downloads go through one aria2c, its global
+	options (bandwidth limit, number of concurrent downloads, connections per server) apply across all courses.
+	aria2c stops with this process, even if it is killed. `executable` may point to a stand-in that speaks the same
+	protocol, such as `bench/fake_aria2.py`.'''
+	def __init__(self, aria2c_args=(), port: int = 6800, max_download_limit: str = "0",
+			max_concurrent_downloads: int = 5, executable: str = "aria2c"):
+		self.port = port
+		self.secret = secrets.token_hex(16)
+		self.command = [executable, *aria2c_args, '--enable-rpc', f'--rpc-listen-port={port}', f'--rpc-secret={self.secret}',
+			f'--max-overall-download-limit={max_download_limit}',
+			f'--max-concurrent-downloads={max_concurrent_downloads}', f'--stop-with-process={os.getpid()}',
+			'--continue=true', '--auto-file-renaming=false']
+		self.process = None
+		self.results = {}	# gid : final status ("complete", "error" or "removed"), error message and error code
+		self.tags = {}	# gid : tag given at submission, to group downloads by job
+		self.abandoned = set()	# gids removed by `download` after another one failed, whose last notification is ignored
+		self.condition = threading.Condition()	# guards `results`, `tags` and `abandoned`
+		self.listener = None
+		self.connected = threading.Event()	# set while the notification WebSocket is open
+		self.download_limit = max_download_limit
+
+	def start(self):
+		logging.info(f"Starting aria2c RPC service on port {self.port}.")
+		self.process = subprocess.Popen(self.command, stdout=subprocess.DEVNULL)
+		for _ in range(50):
+			try:
+				self.call("aria2.getVersion")
+				break
+			except OSError:
+				time.sleep(0.1)
+		else:
+			self.stop()
+			raise Aria2Error("aria2c RPC service did not start.")
+		atexit.register(self.stop)
+		self.listener = threading.Thread(target=self.listen, daemon=True)
+		self.listener.start()
+		# notifications sent before the WebSocket is open are lost, and only found by `check` after a minute
+		if not self.connected.wait(timeout=5):
+			logging.warning("aria2c notifications are not connected yet.")
+
+	def stop(self):
+		process, self.process = self.process, None	# first, so that the listener doesn't reconnect
+		if process is None:
+			return
+		atexit.unregister(self.stop)
+		try:
+			self.call("aria2.shutdown")
+			process.wait(timeout=10)
+		except (OSError, Aria2Error, subprocess.TimeoutExpired):
+			process.terminate()
+
+	def call(self, method, *params):
+		import urllib.request	# slow to import, and process_video imports this module for Aria2Error alone
+		request = json.dumps({"jsonrpc": "2.0", "id": secrets.token_hex(4), "method": method,
+			"params": [f"token:{self.secret}", *params]}).encode()
+		import urllib.error
+		try:
+			with urllib.request.urlopen(f"http://127.0.0.1:{self.port}/jsonrpc", request, timeout=10) as r:
+				response = json.load(r)
+		except urllib.error.HTTPError as e:	# aria2c answers errors with status 400
+			with e:
+				response = json.load(e)
+		if "error" in response:
+			raise Aria2Error(response["error"]["message"])
+		return response["result"]
+
+	def add(self, link: str, file_name: str, output_dir, headers=(), tag=None, options=None) -> str:
+		'''Submit a download. `options` are aria2c options of this download only, e.g. `{"split": 4}`.'''
+		options = {k: str(v) for k, v in (options or {}).items()}
+		gid = self.call("aria2.addUri", [link], {**options, "out": file_name, "dir": str(output_dir), "header": list(headers)})
+		with self.condition:
+			self.tags[gid] = tag
+		return gid
+
+	def download(self, links, file_names, output_dir, headers=(), tag=None, options=None):
+		'''Download the links and block until all of them are finished. Raise Aria2Error if any of them fails.
+
+		If one fails, the others are removed, so that they don't keep downloading (and writing to the same files as
+		a retry). `options` are the aria2c options of each download, see `add`.'''
+		options = options or [None] * len(links)
+		gids = []
+		pending = []	# submitted, and not waited for yet
+		try:
+			for link, file_name, link_options in zip(links, file_names, options):
+				gids.append(self.add(link, file_name, output_dir, headers, tag, link_options))
+				pending.append(gids[-1])
+			for gid in gids:
+				try:
+					self.wait(gid)
+				finally:
+					pending.remove(gid)
+		finally:
+			unfinished = []
+			with self.condition:
+				for gid in gids:
+					self.tags.pop(gid, None)
+				for gid in pending:
+					if self.results.pop(gid, None) is None:
+						self.abandoned.add(gid)
+						unfinished.append(gid)
+			for gid in unfinished:
+				try:
+					self.call("aria2.forceRemove", gid)
+				except (OSError, Aria2Error):	# finished meanwhile, or aria2c is gone
+					pass
+
+	def wait(self, gid: str):
+		with self.condition:
+			while gid not in self.results:
+				# the timeout only guards against a lost notification
+				if not self.condition.wait(timeout=60) and gid not in self.results:
+					self.check(gid)
+			status, message, code = self.results.pop(gid)
+		if status != "complete":
+			raise Aria2Error(f"Download {gid} {status}: {message}", code)
+
+	def check(self, gid: str):
+		'''Look up the status of a download directly. Must be called with the condition held.'''
+		status = self.call("aria2.tellStatus", gid, ["status", "errorMessage", "errorCode"])
+		if status["status"] in ("complete", "error", "removed"):
+			self.results[gid] = (status["status"], status.get("errorMessage", ""), status.get("errorCode"))
+
+	def progress(self, tag) -> dict:
+		'''Return the speed (bytes/s), downloaded and total bytes, and ETA (seconds) of the downloads with the given tag.'''
+		speed = completed = total = 0
+		with self.condition:
+			gids = [gid for gid, t in self.tags.items() if t == tag]
+		for gid in gids:
+			status = self.call("aria2.tellStatus", gid, ["downloadSpeed", "completedLength", "totalLength"])
+			speed += int(status["downloadSpeed"])
+			completed += int(status["completedLength"])
+			total += int(status["totalLength"])
+		eta = (total - completed) / speed if speed else None
+		return {"speed": speed, "completed": completed, "total": total, "eta": eta}
+
+	def change_global_option(self, **options):
+		self.call("aria2.changeGlobalOption", {k.replace('_', '-'): str(v) for k, v in options.items()})
+
+	def follow_schedule(self, schedule, interval: float = 60):
+		'''Apply the overall download limit of a `BandwidthSchedule` to all running downloads, checking every `interval` seconds.'''
+		def loop():
+			while self.process is not None:
+				limit = schedule.limit(datetime.now())
+				if limit != self.download_limit:
+					try:
+						self.change_global_option(max_overall_download_limit=limit)
+						logging.info(f"Download speed limit set to {limit if limit != '0' else 'unlimited'}.")
+						self.download_limit = limit
+					except (OSError, Aria2Error) as e:
+						logging.warning(f"Failed to change the download speed limit: {e}")
+				time.sleep(interval)
+		threading.Thread(target=loop, daemon=True).start()
+
+	def listen(self):
+		'''Receive download events over the WebSocket, reconnecting while the service is running.'''
+		while self.process is not None:
+			try:
+				for message in websocket_messages("127.0.0.1", self.port, "/jsonrpc", on_open=self.connected.set):
+					self.handle_event(json.loads(message))
+			except OSError as e:
+				if self.process is not None:
+					logging.warning(f"Lost connection to aria2c notifications: {e}")
+			self.connected.clear()
+			if self.process is not None:
+				time.sleep(1)
+
+	def handle_event(self, event: dict):
+		status = {
+			"aria2.onDownloadComplete": "complete",
+			"aria2.onDownloadError": "error",
+			"aria2.onDownloadStop": "removed",
+		}.get(event.get("method"))
+		if status is None:
+			return
+		for params in event["params"]:
+			gid = params["gid"]
+			message = ""
+			code = None
+			if status == "error":
+				try:
+					error = self.call("aria2.tellStatus", gid, ["errorMessage", "errorCode"])
+					message, code = error.get("errorMessage", ""), error.get("errorCode")
+				except (OSError, Aria2Error):
+					pass
+			with self.condition:
+				if gid in self.abandoned:
+					self.abandoned.discard(gid)
+					continue
+				self.results[gid] = (status, message, code)
+				self.condition.notify_all()
+
+def websocket_messages(host: str, port: int, path: str, on_open=None):
+	'''A minimal WebSocket client (RFC 6455) that yields the text messages sent by the server. `on_open` is called after the handshake.'''
+	sock = socket.create_connection((host, port))
+	with sock:
+		key = base64.b64encode(os.urandom(16)).decode()
+		sock.sendall((f"GET {path} HTTP/1.1\r\nHost: {host}:{port}\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+			f"Sec-WebSocket-Key: {key}\r\nSec-WebSocket-Version: 13\r\n\r\n").encode())
+		reader = sock.makefile('rb')
+		status_line = reader.readline()
+		if b" 101 " not in status_line:
+			raise ConnectionError(f"WebSocket handshake failed: {status_line!r}")
+		while reader.readline() not in (b"\r\n", b""):
+			pass
+		if on_open:
+			on_open()
+		fragments = []
+		while True:
+			header = reader.read(2)
+			if len(header) < 2:
+				return
+			opcode = header[0] & 0x0f
+			length = header[1] & 0x7f
+			if length == 126:
+				length = struct.unpack("!H", reader.read(2))[0]
+			elif length == 127:
+				length = struct.unpack("!Q", reader.read(8))[0]
+			mask = reader.read(4) if header[1] & 0x80 else None
+			payload = reader.read(length)
+			if mask:
+				payload = bytes(b ^ mask[i % 4] for i, b in enumerate(payload))
+			if opcode == 0x8:	# close
+				return
+			if opcode == 0x9:	# ping, answer with a (masked) pong
+				frame_mask = os.urandom(4)
+				sock.sendall(bytes([0x8a, 0x80 | len(payload)]) + frame_mask
+					+ bytes(b ^ frame_mask[i % 4] for i, b in enumerate(payload)))
+				continue
+			if opcode in (0x0, 0x1):
+				fragments.append(payload)
+				if header[0] & 0x80:	# final fragment
+					yield b"".join(fragments).decode()
+					fragments = []
@@ -1,10 +1,18 @@
 #!/usr/bin/env python3
 from config import *
 from sjtu_login import SJTU_Login
-from search_download import search_download
+from poll_engine import PollEngine
 from config import Config, Course, load_config
 from history import History
+from job_scheduler import JobScheduler
+from http_client import configure_client
+from session_store import SessionStore
+from sjtu_real_canvas_video import LTICache, VideoCatalog, resolve_links
+from poll_schedule import PollSchedule
+from metrics import metrics
+from compact import Compactor
 import argparse
+import asyncio
 import time
 import subprocess
 import logging
@@ -12,64 +20,80 @@ from datetime import datetime, timedelta
 
 CLI_description = '''Auto-download videos based on configuration.'''
 
-def should_download(course: Course, date: datetime) -> bool:
-	"""Check if videos for a given date should be downloaded based on the course's schedule."""
-	weekday = date.weekday() + 1  # Convert to 1-7 (Mon-Sun)
-	return weekday in course.course_table
+def run_post_download_script(config: Config):
+	if not config.post_download_script:
+		return
+	logging.info("Executing post download script.")
+	try:
+		subprocess.run(config.post_download_script)
+	except Exception as e:
+		logging.error(f"Error executing post download script: {e}")
 
 def auto_download(config: Config):
-	login = SJTU_Login(config.username, config.password)
+	if config.metrics:
+		metrics.configure(config.data_dir, config.metrics_port)
+	login = SJTU_Login(config.username, config.password, configure_client(config),
+					   SessionStore(config.data_dir, config.username, config.session_max_age))
 	login.login()
 	logging.info("Login successful.")
+	login.start_refresh(config.session_refresh_margin * 60)
 	history = History(config.data_dir)
+	lti_cache = LTICache(config.lti_cache_ttl * 60)
+	catalog = VideoCatalog(config.data_dir, config.catalog_page_size, lti_cache, config.skip_before, config.catalog_resync_every)
 
 	config.whisper_args += [
 		"--verbose", "False",
 	]
 
+	# the post download script runs whenever the job queue drains
+	scheduler = JobScheduler(config, history, on_idle=lambda: run_post_download_script(config),
+		relink=lambda job: resolve_links(job.course_id, job.video_ids, login.login(), login.client, lti_cache, config.detail_concurrency))
+	engine = PollEngine(config, login, catalog, history, scheduler)
+	schedule = PollSchedule(config, history) if config.adaptive_polling else None
+	compactor = Compactor(config) if config.compact else None
+
 	while True:
-		download = False	# whether any videos were downloaded
 		execution_begin_time = datetime.now()
-		for course_name, course in config.course.items():
-			today = datetime.now()
-			if course.auto_download:
-				for day_offset in range(config.skip_before):
-					video_date = today - timedelta(days=day_offset)
-
-					if should_download(course, video_date):
-						try:
-							success = search_download(config, course, login, min_count=course.course_table.get(video_date.weekday() + 1, 0), course_name=course_name, date=video_date, history=history)
-							if success[0]:
-								download = True
-						except Exception as e:
-							logging.error(f"Error downloading videos for {course_name} on {video_date.strftime('%Y-%m-%d')}: {e}", exc_info=True)
+		if schedule:
+			due = schedule.due(execution_begin_time)
+			with metrics.span("poll_cycle", courses=len(due)):
+				download = asyncio.run(engine.poll(due)) if due else set()	# the courses whose videos were queued
+			execution_end_time = datetime.now()
+			schedule.update(due, download, execution_end_time)
+			sleep_duration = schedule.sleep_time(execution_end_time)
+		else:
+			with metrics.span("poll_cycle", courses=len(config.course)):
+				download = asyncio.run(engine.poll())
 
-		# Execute post download script
-		if download and config.post_download_script:
-			logging.info("Executing post download script.")
-			try:
-				subprocess.run(config.post_download_script)
-			except Exception as e:
-				logging.error(f"Error executing post download script: {e}")
+			# Improve the logic, if downloading takes more than check_interval, warn and wait for check_interval minutes
+			# otherwise, sleep for check_interval - execution time minutes
+			execution_end_time = datetime.now()
+			execution_duration = (execution_end_time - execution_begin_time).seconds
+			sleep_duration = config.check_interval * 60 - execution_duration
+			if sleep_duration < 0:
+				logging.warning(f"Warning: Checking took longer than check_interval. Execution time: {execution_duration} seconds.")
+				sleep_duration = config.check_interval * 60
 
-		# Improve the logic, if downloading takes more than check_interval, warn and wait for check_interval minutes
-		# otherwise, sleep for check_interval - execution time minutes
-		execution_end_time = datetime.now()
-		execution_duration = (execution_end_time - execution_begin_time).seconds
-		sleep_duration = config.check_interval * 60 - execution_duration
-		if sleep_duration < 0:
-			logging.warning(f"Warning: Downloading took longer than check_interval. Execution time: {execution_duration} seconds.")
-			sleep_duration = config.check_interval * 60
+		if compactor:
+			# re-encodes only start while no job is queued, those running when one arrives finish at the lowest priority
+			compactor.start(idle=lambda: scheduler.pending() == 0)
 
 		# Sleep until next check time
+		metrics.gauge("sleep_seconds", sleep_duration)
+		metrics.export()
+		for job, progress in scheduler.progress().items():
+			eta = f"{progress['eta'] / 60:.1f} min" if progress['eta'] is not None else "unknown"
+			logging.info(f"Downloading {job}: {progress['completed'] / 2**20:.0f}/{progress['total'] / 2**20:.0f} MiB at {progress['speed'] / 2**20:.1f} MiB/s, ETA {eta}.")
+		next_check = (datetime.now() + timedelta(seconds=sleep_duration)).strftime('%H:%M')
 		if download:
-			logging.info(f"Download and processing finished. Sleeping.")
+			logging.info(f"New videos queued, {scheduler.pending()} jobs in progress. Sleeping until {next_check}.")
 		else:
-			logging.info(f"No videos downloaded. Sleeping.")
+			logging.info(f"No new videos. Sleeping until {next_check}.")
 		try:
 			time.sleep(sleep_duration)
 		except KeyboardInterrupt:
 			logging.info("Interrupted. Exiting.")
+			scheduler.shutdown(wait=False)
 			break
 
 def setup_parser(parser: argparse.ArgumentParser):
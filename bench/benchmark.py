@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+'''Benchmarks against the local stand-in server, run from the repository root:
+
+	python -m bench.benchmark --scenario poll --courses 8 --videos 200 --latency 30
+
+Scenarios:
+- poll: login, then poll cycles over all courses. The first cycle is cold (LTI launches and full listings), later ones
+  see `--uploads` new videos per course. Reports the latency and the requests of each cycle.
+- download: download `--clips` clips with aria2c, reports the throughput.
+- process: `process_video` from the links of `--clips` clips to the merged file, end to end. Needs `--media`, a real
+  video, as ffmpeg has to merge the clips.'''
+import argparse
+import asyncio
+import shutil
+import statistics
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+from bench.fake_sjtu import FakeSJTU, setup_parser as setup_server_parser, from_args
+from config import Config, Course
+from history import History
+from http_client import configure_client
+from session_store import SessionStore
+from sjtu_login import SJTU_Login
+from sjtu_real_canvas_video import LTICache, VideoCatalog, resolve_details
+from poll_engine import PollEngine
+import process_video
+
+def make_config(fake: FakeSJTU, root: Path, **options) -> Config:
+	every_day = {weekday: 1 for weekday in range(1, 8)}
+	return Config(username="bench", password="bench", data_dir=root / "data", tmp_dir=root / "tmp", video_dir=root / "videos",
+		host_overrides=fake.host_overrides(),
+		course={name: Course(course_id=course_id, course_table=every_day) for course_id, name in fake.course_names.items()},
+		**options)
+
+def report(name: str, values: list[float], unit: str):
+	if not values:
+		return
+	unit = f" {unit}" if unit else ""
+	print(f"  {name}: mean {statistics.mean(values):.1f}{unit}, median {statistics.median(values):.1f}{unit}, max {max(values):.1f}{unit}")
+
+def requests_since(fake: FakeSJTU, before) -> tuple[int, dict]:
+	after = fake.snapshot()
+	diff = {endpoint: after[endpoint] - before[endpoint] for endpoint in after if after[endpoint] > before[endpoint]}
+	return sum(diff.values()), diff
+
+async def poll_cycle(engine: PollEngine, config: Config) -> list:
+	'''Check every course like `PollEngine.poll`, and resolve the details of the new batches without downloading them.'''
+	semaphore = asyncio.Semaphore(config.poll_concurrency)
+	today = datetime.now()
+	results = await asyncio.gather(*(engine.check_course(name, course, today, semaphore) for name, course in config.course.items()))
+	batches = [batch for result in results for batch in result]
+	await asyncio.gather(*(asyncio.to_thread(resolve_details, batch[3], config.detail_concurrency) for batch in batches))
+	return batches
+
+def bench_poll(fake: FakeSJTU, root: Path, args: argparse.Namespace):
+	config = make_config(fake, root)
+	client = configure_client(config)
+	before = fake.snapshot()
+	start = time.perf_counter()
+	login = SJTU_Login(config.username, config.password, client, SessionStore(config.data_dir, config.username))
+	login.login()
+	elapsed = (time.perf_counter() - start) * 1000
+	count, _ = requests_since(fake, before)
+	print(f"login: {elapsed:.1f} ms, {count} requests (including the 1 s pause before submitting the captcha)")
+
+	history = History(config.data_dir)
+	catalog = VideoCatalog(config.data_dir, config.catalog_page_size, LTICache(config.lti_cache_ttl * 60),
+		config.skip_before, config.catalog_resync_every)
+	engine = PollEngine(config, login, catalog, history)
+	latencies = []
+	counts = []
+	for cycle in range(args.cycles):
+		if cycle:
+			for course_id in fake.catalog:
+				for _ in range(args.uploads):
+					fake.add_video(course_id, datetime.now())
+		before = fake.snapshot()
+		start = time.perf_counter()
+		batches = asyncio.run(poll_cycle(engine, config))
+		elapsed = (time.perf_counter() - start) * 1000
+		count, endpoints = requests_since(fake, before)
+		videos = [video for batch in batches for video in batch[3]]
+		with history.batch():
+			for video in videos:
+				history.add(video.video_id)	# as if processed, so the next cycle only sees new uploads
+		print(f"cycle {cycle + 1}{' (cold)' if cycle == 0 else ''}: {elapsed:.1f} ms, {count} requests, {len(videos)} new videos  {endpoints}")
+		if cycle:
+			latencies.append(elapsed)
+			counts.append(count)
+	if latencies:
+		print("warm cycles:")
+		report("latency", latencies, "ms")
+		report("requests", counts, "")
+
+def media_links(fake: FakeSJTU, clips: int) -> list[str]:
+	course_id = next(iter(fake.catalog))
+	return [fake.media_url(info["videoId"]) for info in fake.catalog[course_id][:clips]]
+
+def bench_download(fake: FakeSJTU, root: Path, args: argparse.Namespace):
+	if shutil.which("aria2c") is None:
+		print("download: skipped, aria2c is not installed")
+		return
+	links = media_links(fake, args.clips)
+	names = [f"clip{i}.mp4" for i in range(len(links))]
+	output_dir = root / "downloads"
+	output_dir.mkdir(parents=True, exist_ok=True)
+	start = time.perf_counter()
+	process_video.download_video(links, names, output_dir, output_dir)
+	elapsed = time.perf_counter() - start
+	total = sum((output_dir / name).stat().st_size for name in names)
+	print(f"download: {len(links)} clips, {total / 2**20:.0f} MiB in {elapsed:.2f} s, {total / 2**20 / elapsed:.1f} MiB/s")
+
+def bench_process(fake: FakeSJTU, root: Path, args: argparse.Namespace):
+	missing = [tool for tool in ("aria2c", "ffmpeg", "ffprobe") if shutil.which(tool) is None]
+	if missing or not fake.media_file:
+		print(f"process: skipped, {'needs --media' if not missing else ', '.join(missing) + ' not installed'}")
+		return
+	config = make_config(fake, root, stream_download=args.stream)
+	links = media_links(fake, args.clips)
+	output_file = config.video_dir / "bench.mp4"
+	start = time.perf_counter()
+	process_video.process_video(links, output_file, config=config)
+	elapsed = time.perf_counter() - start
+	print(f"process: {len(links)} clips to {output_file.stat().st_size / 2**20:.0f} MiB in {elapsed:.2f} s{' (streaming)' if args.stream else ''}")
+
+scenarios = {"poll": bench_poll, "download": bench_download, "process": bench_process}
+
+def main():
+	parser = argparse.ArgumentParser(description="Benchmark polling and downloads against a local stand-in server.")
+	setup_server_parser(parser)
+	parser.add_argument("--scenario", choices=[*scenarios, "all"], default="all")
+	parser.add_argument("--cycles", type=int, default=5, help="Number of poll cycles.")
+	parser.add_argument("--uploads", type=int, default=1, help="New videos per course before each warm poll cycle.")
+	parser.add_argument("--clips", type=int, default=4, help="Number of clips to download or process.")
+	parser.add_argument("--stream", action="store_true", help="Process in streaming mode.")
+	args = parser.parse_args()
+	fake = from_args(args, port=0).start()
+	print(f"Stand-in server on {fake.base_url}: {len(fake.catalog)} courses, {args.videos} videos each, "
+		f"{args.latency:.0f} ms latency, {'unlimited' if not args.bandwidth else f'{args.bandwidth:.0f} MiB/s'} bandwidth")
+	try:
+		for name, scenario in scenarios.items():
+			if args.scenario in (name, "all"):
+				with tempfile.TemporaryDirectory(prefix=f"forsythia-bench-{name}-") as root:
+					scenario(fake, Path(root), args)
+	finally:
+		fake.stop()
+
+if __name__ == "__main__":
+	main()
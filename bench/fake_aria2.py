@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+'''A local stand-in for aria2c in RPC mode, for tests of `aria2_rpc.Aria2Service` without network access:
+
+	Aria2Service([path_to_this_file], port, executable=sys.executable)
+
+It takes the same command line (`--rpc-listen-port`, `--rpc-secret`, `--stop-with-process`, the rest is ignored), and
+answers the JSON-RPC methods the service uses on `/jsonrpc`: getVersion, addUri, tellStatus, forceRemove,
+changeGlobalOption and shutdown. Notifications are pushed over a WebSocket on the same path, like aria2c.
+
+Each download is simulated from the query string of its link: it finishes after `delay` seconds (0.05 by default),
+writing `size` bytes to its output file, or fails with aria2 error code `fail` (e.g. `fake://clip?fail=29`). Two
+extra methods help tests: `fake.stats` returns the number of WebSocket connections opened and open, and
+`fake.dropConnections` closes the open ones.'''
+import argparse
+import base64
+import hashlib
+import json
+import os
+import struct
+import sys
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+websocket_guid = "258EAFA5-E914-47DA-95CA-C5AB0DC11B65"
+
+class FakeAria2:
+	def __init__(self, port: int, secret: str = ""):
+		self.secret = secret
+		self.downloads = {}	# gid : {"status", "errorCode", "errorMessage", "completedLength", "totalLength"}
+		self.timers = {}	# gid : timer that finishes the active download
+		self.options = {}	# global options changed over RPC
+		self.sockets = []	# open WebSocket connections, (request handler, write lock)
+		self.opened = 0
+		self.lock = threading.Lock()
+		self.server = Server(("127.0.0.1", port), make_handler(self))
+		self.server.daemon_threads = True
+
+	def call(self, method: str, params: list):
+		token = params[0] if params and isinstance(params[0], str) and params[0].startswith("token:") else None
+		if token is not None:
+			params = params[1:]
+		if method.startswith("aria2.") and token != f"token:{self.secret}":
+			raise RPCError(1, "Unauthorized")
+		handler = getattr(self, "rpc_" + method.split(".", 1)[1], None)
+		if handler is None:
+			raise RPCError(1, f"No such method: {method}")
+		return handler(*params)
+
+	def rpc_getVersion(self):
+		return {"version": "fake", "enabledFeatures": []}
+
+	def rpc_addUri(self, uris, options=None):
+		options = options or {}
+		gid = os.urandom(8).hex()
+		query = {k: v[0] for k, v in urllib.parse.parse_qs(urllib.parse.urlsplit(uris[0]).query).items()}
+		size = int(query.get("size", 16))
+		with self.lock:
+			self.downloads[gid] = {"status": "active", "completedLength": "0", "totalLength": str(size), "downloadSpeed": "1024"}
+			self.timers[gid] = threading.Timer(float(query.get("delay", 0.05)), self.finish, (gid, options, size, query.get("fail")))
+			self.timers[gid].start()
+		return gid
+
+	def rpc_tellStatus(self, gid, keys=None):
+		with self.lock:
+			status = self.downloads.get(gid)
+		if status is None:
+			raise RPCError(1, f"GID {gid} is not found")
+		return {k: v for k, v in status.items() if keys is None or k in keys}
+
+	def rpc_forceRemove(self, gid):
+		with self.lock:
+			timer = self.timers.pop(gid, None)
+			if timer is None:
+				raise RPCError(1, f"Active Download not found for GID#{gid}")
+			timer.cancel()
+			self.downloads[gid]["status"] = "removed"
+		self.notify("aria2.onDownloadStop", gid)
+		return gid
+
+	def rpc_changeGlobalOption(self, options):
+		self.options.update(options)
+		return "OK"
+
+	def rpc_shutdown(self):
+		threading.Thread(target=self.stop).start()
+		return "OK"
+
+	def rpc_stats(self):
+		with self.lock:
+			return {"opened": self.opened, "open": len(self.sockets)}
+
+	def rpc_dropConnections(self):
+		with self.lock:
+			sockets = list(self.sockets)
+		for handler, _ in sockets:
+			handler.connection.shutdown(2)
+		return "OK"
+
+	def finish(self, gid: str, options: dict, size: int, fail: str | None):
+		with self.lock:
+			if self.timers.pop(gid, None) is None:
+				return	# removed
+			if fail is None and options.get("out"):
+				Path(options.get("dir", "."), options["out"]).write_bytes(b"x" * size)
+			status = self.downloads[gid]
+			if fail is None:
+				status.update(status="complete", completedLength=str(size))
+			else:
+				status.update(status="error", errorCode=fail, errorMessage=f"Simulated failure {fail}")
+		self.notify("aria2.onDownloadComplete" if fail is None else "aria2.onDownloadError", gid)
+
+	def notify(self, method: str, gid: str):
+		payload = json.dumps({"jsonrpc": "2.0", "method": method, "params": [{"gid": gid}]}).encode()
+		length = len(payload)
+		if length < 126:
+			header = bytes([0x81, length])
+		elif length < 1 << 16:
+			header = bytes([0x81, 126]) + struct.pack("!H", length)
+		else:
+			header = bytes([0x81, 127]) + struct.pack("!Q", length)
+		with self.lock:
+			sockets = list(self.sockets)
+		for handler, write_lock in sockets:
+			try:
+				with write_lock:
+					handler.wfile.write(header + payload)
+			except OSError:
+				pass
+
+	def watch(self, pid: int):
+		'''Exit once process `pid` is gone, like aria2c's --stop-with-process.'''
+		while True:
+			try:
+				os.kill(pid, 0)
+			except ProcessLookupError:
+				self.stop()
+				return
+			time.sleep(0.2)
+
+	def serve(self):
+		self.server.serve_forever()
+
+	def stop(self):
+		self.server.shutdown()
+
+class RPCError(Exception):
+	def __init__(self, code: int, message: str):
+		super().__init__(message)
+		self.code = code
+
+class Server(ThreadingHTTPServer):
+	def handle_error(self, request, client_address):
+		if isinstance(sys.exc_info()[1], ConnectionError):
+			return	# dropped WebSocket connections
+		super().handle_error(request, client_address)
+
+def make_handler(fake: FakeAria2):
+	class Handler(BaseHTTPRequestHandler):
+		protocol_version = "HTTP/1.1"
+
+		def log_message(self, format, *args):
+			pass
+
+		def do_POST(self):
+			request = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)))
+			try:
+				response = {"result": fake.call(request["method"], request.get("params", []))}
+			except RPCError as e:
+				response = {"error": {"code": e.code, "message": str(e)}}
+			body = json.dumps({"jsonrpc": "2.0", "id": request.get("id"), **response}).encode()
+			self.send_response(400 if "error" in response else 200)
+			self.send_header("Content-Type", "application/json-rpc")
+			self.send_header("Content-Length", str(len(body)))
+			self.end_headers()
+			self.wfile.write(body)
+
+		def do_GET(self):
+			key = self.headers.get("Sec-WebSocket-Key")
+			if self.headers.get("Upgrade", "").lower() != "websocket" or not key:
+				self.send_error(400)
+				return
+			accept = base64.b64encode(hashlib.sha1((key + websocket_guid).encode()).digest()).decode()
+			self.send_response(101)
+			self.send_header("Upgrade", "websocket")
+			self.send_header("Connection", "Upgrade")
+			self.send_header("Sec-WebSocket-Accept", accept)
+			self.end_headers()
+			self.wfile.flush()
+			entry = (self, threading.Lock())
+			with fake.lock:
+				fake.sockets.append(entry)
+				fake.opened += 1
+			try:
+				while self.rfile.read(2):	# frames from the client are only pongs, ignored
+					pass
+			except OSError:
+				pass
+			finally:
+				with fake.lock:
+					fake.sockets.remove(entry)
+			self.close_connection = True
+
+	return Handler
+
+def main():
+	parser = argparse.ArgumentParser(description="Run a local stand-in for aria2c in RPC mode.")
+	parser.add_argument("--rpc-listen-port", type=int, default=6800)
+	parser.add_argument("--rpc-secret", default="")
+	parser.add_argument("--stop-with-process", type=int, default=None)
+	args, _ = parser.parse_known_args()
+	fake = FakeAria2(args.rpc_listen_port, args.rpc_secret)
+	if args.stop_with_process:
+		threading.Thread(target=fake.watch, args=(args.stop_with_process,), daemon=True).start()
+	fake.serve()
+
+if __name__ == "__main__":
+	main()
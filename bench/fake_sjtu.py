@@ -0,0 +1,369 @@
+#!/usr/bin/env python3
+'''A local stand-in for the SJTU servers, for benchmarks that must not touch production.
+
+It serves the jaccount login and captcha, the captcha solver on plus.sjtu.edu.cn, the Canvas login, API probe and
+external tool page on oc.sjtu.edu.cn, the LTI launch and video APIs on courses.sjtu.edu.cn, and a media origin with
+MP4 files and byte-range HLS playlists. Requests for host `h` are expected under `/h/...`, see `host_overrides`.
+
+Latency is added to every request, and media responses are throttled to the given bandwidth per connection.'''
+import argparse
+import email.utils
+import json
+import os
+import secrets
+import sys
+import threading
+import time
+import urllib.parse
+from collections import Counter
+from datetime import datetime, timedelta
+from http.cookies import SimpleCookie
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+hosts = ("jaccount.sjtu.edu.cn", "plus.sjtu.edu.cn", "oc.sjtu.edu.cn", "courses.sjtu.edu.cn")
+captcha_answer = "abcd"
+block_size = 1 << 16
+
+class FakeSJTU:
+	def __init__(self, courses: int = 4, videos: int = 40, latency: float = 0.0, bandwidth: float = 0,
+			media_size: int = 8 << 20, media_file: str = None, hls: bool = False, host: str = "127.0.0.1", port: int = 0,
+			page_padding: int = 200 << 10):
+		self.latency = latency	# in seconds, added to every request
+		self.bandwidth = bandwidth	# in bytes per second per media connection, 0 for unlimited
+		self.media_file = media_file	# a real video to serve for every clip, instead of random bytes
+		self.media_size = os.path.getsize(media_file) if media_file else media_size
+		self.hls = hls	# whether the video details point to HLS playlists instead of MP4 files
+		self.page_padding = page_padding	# bytes of markup after the launch form, like the real external tool page
+		self.block = os.urandom(block_size)
+		self.requests = Counter()	# endpoint : number of requests
+		self.lock = threading.Lock()
+		self.tokens = {}	# cookie value : what it grants ("jaccount", "canvas" or a canvasCourseId)
+		self.codes = set()	# OAuth codes handed from jaccount to Canvas
+		self.catalog = {}	# course_id : video infos, newest first
+		self.course_names = {}	# course_id : name
+		today = datetime.now().replace(hour=8, minute=0, second=0, microsecond=0)
+		for c in range(courses):
+			course_id = 10000 + c
+			self.course_names[course_id] = f"Course {c}"
+			self.catalog[course_id] = []
+			for k in reversed(range(videos)):
+				self.add_video(course_id, today - timedelta(days=k))
+		self.server = Server((host, port), make_handler(self))
+		self.server.daemon_threads = True
+		self.thread = None
+
+	@property
+	def base_url(self) -> str:
+		host, port = self.server.server_address[:2]
+		return f"http://{host}:{port}"
+
+	def host_overrides(self) -> dict[str, str]:
+		'''The `host_overrides` of a `Config` that sends all requests here.'''
+		return {host: f"{self.base_url}/{host}" for host in hosts}
+
+	def add_video(self, course_id: int, begin: datetime) -> dict:
+		'''Publish a new video, as the newest of the course.'''
+		with self.lock:
+			videos = self.catalog[course_id]
+			info = {
+				"videoId": f"{course_id}-{len(videos)}",
+				"videoName": f"{self.course_names[course_id]} {begin.strftime('%m-%d')}",
+				"subjName": self.course_names[course_id],
+				"courseBeginTime": begin.strftime("%Y-%m-%d %H:%M:%S"),
+				"courseEndTime": (begin + timedelta(minutes=95)).strftime("%Y-%m-%d %H:%M:%S"),
+			}
+			videos.insert(0, info)
+			return info
+
+	def media_url(self, video_id: str) -> str:
+		return f"{self.base_url}/media/{video_id}.{'m3u8' if self.hls else 'mp4'}"
+
+	def count(self, endpoint: str):
+		with self.lock:
+			self.requests[endpoint] += 1
+
+	def snapshot(self) -> Counter:
+		with self.lock:
+			return Counter(self.requests)
+
+	def new_token(self, grant) -> str:
+		token = secrets.token_hex(16)
+		with self.lock:
+			self.tokens[token] = grant
+		return token
+
+	def grant(self, cookies: dict, name: str):
+		with self.lock:
+			return self.tokens.get(cookies.get(name))
+
+	def media_bytes(self, start: int, end: int):
+		'''Yield the bytes [start, end) of the media, in blocks.'''
+		if self.media_file:
+			with open(self.media_file, 'rb') as f:
+				f.seek(start)
+				while start < end and (data := f.read(min(block_size, end - start))):
+					start += len(data)
+					yield data
+			return
+		while start < end:
+			offset = start % block_size
+			data = self.block[offset:offset + min(block_size - offset, end - start)]
+			start += len(data)
+			yield data
+
+	def start(self):
+		self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+		self.thread.start()
+		return self
+
+	def stop(self):
+		self.server.shutdown()
+		self.server.server_close()
+
+class Server(ThreadingHTTPServer):
+	def handle_error(self, request, client_address):
+		if isinstance(sys.exc_info()[1], ConnectionError):
+			return	# clients hang up early on purpose, e.g. once the launch form is parsed
+		super().handle_error(request, client_address)
+
+def make_handler(fake: FakeSJTU):
+	class Handler(BaseHTTPRequestHandler):
+		protocol_version = "HTTP/1.1"	# keep-alive, like the real servers
+
+		def log_message(self, format, *args):
+			pass
+
+		def do_GET(self):
+			self.handle_request("GET")
+
+		def do_POST(self):
+			self.handle_request("POST")
+
+		def handle_request(self, method):
+			length = int(self.headers.get("Content-Length") or 0)
+			body = self.rfile.read(length) if length else b""
+			url = urllib.parse.urlsplit(self.path)
+			host, _, path = url.path.lstrip("/").partition("/")
+			path = "/" + path
+			query = {k: v[0] for k, v in urllib.parse.parse_qs(url.query).items()}
+			form = {}
+			if self.headers.get("Content-Type", "").startswith("application/x-www-form-urlencoded"):
+				form = {k: v[0] for k, v in urllib.parse.parse_qs(body.decode()).items()}
+			cookie = SimpleCookie(self.headers.get("Cookie", ""))
+			cookies = {k: m.value for k, m in cookie.items()}
+			if fake.latency:
+				time.sleep(fake.latency)
+			route = routes.get((method, host, path))
+			if route is None and host == "oc.sjtu.edu.cn" and path.startswith("/courses/") and path.endswith("/external_tools/162"):
+				route = external_tool
+			if route is None and host == "media":
+				route = media
+			if route is None:
+				fake.count("not found")
+				return self.reply(404, b"not found")
+			fake.count(route.__name__)
+			route(self, path=path, query=query, form=form, cookies=cookies)
+
+		def reply(self, status, body=b"", content_type="text/plain", headers=()):
+			if isinstance(body, str):
+				body = body.encode()
+			self.send_response(status)
+			self.send_header("Content-Type", content_type)
+			self.send_header("Content-Length", str(len(body)))
+			for name, value in headers:
+				self.send_header(name, value)
+			self.end_headers()
+			self.wfile.write(body)
+
+		def redirect(self, location, headers=()):
+			self.reply(302, headers=[("Location", location), *headers])
+
+	def oauth_login(h, **_):
+		returl = urllib.parse.quote("https://courses.sjtu.edu.cn/app/oauth/2.0/callback", safe="")
+		h.redirect(f"https://jaccount.sjtu.edu.cn/jaccount/jalogin?sid=jaoauth220160718&client=fake&returl={returl}&se=fake")
+
+	def jalogin(h, **_):
+		uuid = "-".join(secrets.token_hex(n) for n in (4, 2, 2, 2, 6))
+		h.reply(200, f'<html><script>var loginContext = {{ uuid: "{uuid}" }};</script></html>', "text/html",
+			[("Set-Cookie", f"JASiteCookie={secrets.token_hex(8)}; Path=/")])
+
+	def captcha(h, **_):
+		h.reply(200, fake.block[:2048], "image/jpeg")
+
+	def captcha_solver(h, **_):
+		h.reply(200, json.dumps({"result": captcha_answer}), "application/json")
+
+	def ulogin(h, form, **_):
+		if form.get("pass") == "wrong" or form.get("captcha") != captcha_answer:
+			return h.redirect("https://jaccount.sjtu.edu.cn/jaccount/jalogin?err=1")
+		token = fake.new_token("jaccount")
+		h.redirect("https://courses.sjtu.edu.cn/app/oauth/2.0/callback", [("Set-Cookie", f"JAAuthCookie={token}; Path=/")])
+
+	def oauth_callback(h, **_):
+		h.reply(200, "ok", "text/html")
+
+	def openid_connect(h, **_):
+		h.redirect("https://jaccount.sjtu.edu.cn/oauth2/authorize?redirect_uri=https%3A%2F%2Foc.sjtu.edu.cn%2Flogin%2Foauth2%2Fcallback")
+
+	def authorize(h, cookies, **_):
+		if fake.grant(cookies, "JAAuthCookie") != "jaccount":
+			return h.redirect("https://jaccount.sjtu.edu.cn/jaccount/jalogin?sid=oc")
+		code = secrets.token_hex(8)
+		with fake.lock:
+			fake.codes.add(code)
+		h.redirect(f"https://oc.sjtu.edu.cn/login/oauth2/callback?code={code}")
+
+	def canvas_callback(h, query, **_):
+		with fake.lock:
+			valid = query.get("code") in fake.codes
+			fake.codes.discard(query.get("code"))
+		if not valid:
+			return h.reply(401, "invalid code")
+		token = fake.new_token("canvas")
+		expires = email.utils.formatdate(time.time() + 86400, usegmt=True)
+		h.redirect("https://oc.sjtu.edu.cn/?login_success=1", [("Set-Cookie", f"_normandy_session={token}; Path=/; Expires={expires}")])
+
+	def canvas_home(h, **_):
+		h.reply(200, "<html>Dashboard</html>", "text/html")
+
+	def users_self(h, cookies, **_):
+		if fake.grant(cookies, "_normandy_session") != "canvas":
+			return h.reply(401, json.dumps({"errors": [{"message": "user authorization required"}]}), "application/json")
+		h.reply(200, json.dumps({"id": 1, "name": "bench"}), "application/json")
+
+	def external_tool(h, path, cookies, **_):
+		if fake.grant(cookies, "_normandy_session") != "canvas":
+			return h.redirect("https://oc.sjtu.edu.cn/login")
+		course_id = path.split("/")[2]
+		inputs = {"oauth_consumer_key": "fake", "oauth_nonce": secrets.token_hex(8), "oauth_timestamp": str(int(time.time())),
+			"custom_canvas_course_id": course_id, "lti_message_type": "basic-lti-launch-request"}
+		form = "".join(f'<input type="hidden" name="{k}" value="{v}">' for k, v in inputs.items())
+		page = (f'<html><head><title>Video</title></head><body><form action="https://courses.sjtu.edu.cn/lti/launch" method="POST">'
+			f'{form}</form>' + "<div>" + "x" * fake.page_padding + "</div></body></html>")
+		h.reply(200, page, "text/html; charset=utf-8")
+
+	def lti_launch(h, form, **_):
+		course_id = int(form.get("custom_canvas_course_id", 0))
+		if course_id not in fake.catalog:
+			return h.reply(404, "unknown course")
+		canvas_course_id = f"C{course_id}"
+		token = fake.new_token(canvas_course_id)
+		h.redirect(f"https://courses.sjtu.edu.cn/lti/app/lti/vodVideo/playPage?canvasCourseId={canvas_course_id}",
+			[("Set-Cookie", f"JSESSIONID={token}; Path=/")])
+
+	def lti_session(h, cookies):
+		grant = fake.grant(cookies, "JSESSIONID")
+		if not grant or not grant.startswith("C"):
+			h.reply(401, "session expired")
+			return None
+		return int(grant[1:])
+
+	def find_vod_video_list(h, form, cookies, **_):
+		course_id = lti_session(h, cookies)
+		if course_id is None:
+			return
+		page_index, page_size = int(form.get("pageIndex", 1)), int(form.get("pageSize", 20))
+		with fake.lock:
+			videos = fake.catalog[course_id]
+			page = videos[(page_index - 1) * page_size:page_index * page_size]
+			total = len(videos)
+		h.reply(200, json.dumps({"code": "0", "body": {"list": page, "total": total}}), "application/json")
+
+	def get_vod_video_infos(h, form, cookies, **_):
+		course_id = lti_session(h, cookies)
+		if course_id is None:
+			return
+		with fake.lock:
+			info = next((i for i in fake.catalog[course_id] if i["videoId"] == form.get("id")), None)
+		if info is None:
+			return h.reply(404, "unknown video")
+		details = {**info, "rtmpUrlHdv": fake.media_url(info["videoId"]), "cdviViewNum": 0}
+		h.reply(200, json.dumps({"code": "0", "body": details}), "application/json")
+
+	def media(h, path, **_):
+		name = path.lstrip("/")
+		if name.endswith(".m3u8"):
+			segments = 6
+			size = fake.media_size
+			lines = ["#EXTM3U", "#EXT-X-VERSION:4", "#EXT-X-TARGETDURATION:600", "#EXT-X-MEDIA-SEQUENCE:0"]
+			for n in range(segments):
+				start, end = size * n // segments, size * (n + 1) // segments
+				lines += [f"#EXTINF:600.0,", f"#EXT-X-BYTERANGE:{end - start}@{start}", name[:-len(".m3u8")] + ".ts"]
+			lines.append("#EXT-X-ENDLIST")
+			return h.reply(200, "\n".join(lines) + "\n", "application/vnd.apple.mpegurl")
+		size = fake.media_size
+		start, end = 0, size
+		status = 200
+		range_header = h.headers.get("Range")
+		if range_header and range_header.startswith("bytes="):
+			first, _, last = range_header[len("bytes="):].partition("-")
+			start = int(first) if first else size - int(last)
+			end = int(last) + 1 if first and last else size
+			end = min(end, size)
+			status = 206
+		h.send_response(status)
+		h.send_header("Content-Type", "video/mp4")
+		h.send_header("Content-Length", str(end - start))
+		h.send_header("Accept-Ranges", "bytes")
+		if status == 206:
+			h.send_header("Content-Range", f"bytes {start}-{end - 1}/{size}")
+		h.end_headers()
+		began = time.monotonic()
+		sent = 0
+		try:
+			for data in fake.media_bytes(start, end):
+				h.wfile.write(data)
+				sent += len(data)
+				if fake.bandwidth:
+					ahead = sent / fake.bandwidth - (time.monotonic() - began)
+					if ahead > 0:
+						time.sleep(ahead)
+		except (BrokenPipeError, ConnectionResetError):
+			pass
+
+	routes = {
+		("GET", "courses.sjtu.edu.cn", "/app/oauth/2.0/login"): oauth_login,
+		("GET", "courses.sjtu.edu.cn", "/app/oauth/2.0/callback"): oauth_callback,
+		("GET", "jaccount.sjtu.edu.cn", "/jaccount/jalogin"): jalogin,
+		("GET", "jaccount.sjtu.edu.cn", "/jaccount/captcha"): captcha,
+		("POST", "plus.sjtu.edu.cn", "/captcha-solver/"): captcha_solver,
+		("POST", "jaccount.sjtu.edu.cn", "/jaccount/ulogin"): ulogin,
+		("GET", "jaccount.sjtu.edu.cn", "/oauth2/authorize"): authorize,
+		("GET", "oc.sjtu.edu.cn", "/login/openid_connect"): openid_connect,
+		("GET", "oc.sjtu.edu.cn", "/login/oauth2/callback"): canvas_callback,
+		("GET", "oc.sjtu.edu.cn", "/"): canvas_home,
+		("GET", "oc.sjtu.edu.cn", "/api/v1/users/self"): users_self,
+		("POST", "courses.sjtu.edu.cn", "/lti/launch"): lti_launch,
+		("POST", "courses.sjtu.edu.cn", "/lti/vodVideo/findVodVideoList"): find_vod_video_list,
+		("POST", "courses.sjtu.edu.cn", "/lti/vodVideo/getVodVideoInfos"): get_vod_video_infos,
+	}
+	return Handler
+
+def setup_parser(parser: argparse.ArgumentParser):
+	parser.add_argument("--host", default="127.0.0.1")
+	parser.add_argument("--port", type=int, default=8000)
+	parser.add_argument("--courses", type=int, default=4, help="Number of courses.")
+	parser.add_argument("--videos", type=int, default=40, help="Number of videos per course, one per day up to today.")
+	parser.add_argument("--latency", type=float, default=0, help="In milliseconds, added to every request.")
+	parser.add_argument("--bandwidth", type=float, default=0, help="In MiB/s per media connection, 0 for unlimited.")
+	parser.add_argument("--media_size", type=float, default=8, help="In MiB, size of the random media files.")
+	parser.add_argument("--media", default=None, help="A real video file to serve for every clip.")
+	parser.add_argument("--hls", action="store_true", help="Point the video details to HLS playlists.")
+
+def from_args(args: argparse.Namespace, port: int = None) -> FakeSJTU:
+	return FakeSJTU(args.courses, args.videos, args.latency / 1000, args.bandwidth * 2**20, int(args.media_size * 2**20),
+		args.media, args.hls, args.host, args.port if port is None else port)
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Run a local stand-in for the SJTU servers.")
+	setup_parser(parser)
+	args = parser.parse_args()
+	fake = from_args(args).start()
+	print(f"Serving on {fake.base_url}. Add this to the config file:")
+	print("[host_overrides]")
+	for host, url in fake.host_overrides().items():
+		print(f'"{host}" = "{url}"')
+	try:
+		fake.thread.join()
+	except KeyboardInterrupt:
+		fake.stop()
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+'''Startup time of the CLI, run from the repository root:
+
+	python -m bench.startup --runs 10
+
+Each case runs `forsythia.py` in a fresh interpreter with `-X importtime`, and reports the median wall time and the
+import time. The cases that should stay light fail if they import a heavy module, and every case fails if its median
+is over `--budget` milliseconds, so the exit status can guard against regressions.'''
+import argparse
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+root = Path(__file__).resolve().parent.parent
+heavy_modules = ("pydantic", "requests", "config", "http_client", "sjtu_login", "urllib.request", "numpy", "faster_whisper")
+# arguments : whether the case must not import any of `heavy_modules`
+cases = {
+	("-h",): True,
+	("process_video", "-h"): True,
+	("search", "-h"): False,
+	("search_download", "-h"): False,
+	("auto_download", "-h"): False,
+	("transcribe_worker", "-h"): False,
+	("compact", "-h"): False,
+	("multi_user", "-h"): False,
+}
+
+def run(args: tuple[str, ...]) -> tuple[float, float, set[str]]:
+	'''Run the CLI once, return the wall time and import time in milliseconds, and the imported modules.'''
+	start = time.perf_counter()
+	result = subprocess.run([sys.executable, "-X", "importtime", str(root / "forsythia.py"), *args],
+		cwd=root, capture_output=True, text=True)
+	elapsed = (time.perf_counter() - start) * 1000
+	if result.returncode != 0:
+		raise RuntimeError(f"forsythia.py {' '.join(args)} failed: {result.stderr[-2000:]}")
+	modules = set()
+	imports = 0
+	for line in result.stderr.splitlines():
+		if not line.startswith("import time:") or "|" not in line or "self [us]" in line:
+			continue
+		own, _, name = line[len("import time:"):].split("|")
+		modules.add(name.strip())
+		imports += int(own) / 1000
+	return elapsed, imports, modules
+
+def main():
+	parser = argparse.ArgumentParser(description="Measure the startup time of the CLI.")
+	parser.add_argument("--runs", type=int, default=5, help="Runs per case.")
+	parser.add_argument("--budget", type=float, default=0, help="In milliseconds, the highest median wall time allowed, 0 for no limit.")
+	args = parser.parse_args()
+	failures = []
+	for case, light in cases.items():
+		runs = [run(case) for _ in range(args.runs)]
+		wall = statistics.median(r[0] for r in runs)
+		imports = statistics.median(r[1] for r in runs)
+		heavy = sorted(set(heavy_modules) & runs[0][2])
+		name = " ".join(case)
+		print(f"{name:<22} {wall:7.1f} ms, imports {imports:6.1f} ms, {len(runs[0][2])} modules"
+			+ (f", heavy: {', '.join(heavy)}" if heavy else ""))
+		if light and heavy:
+			failures.append(f"{name} imports {', '.join(heavy)}")
+		if args.budget and wall > args.budget:
+			failures.append(f"{name} takes {wall:.1f} ms, over the budget of {args.budget:.0f} ms")
+	for failure in failures:
+		print(f"FAIL: {failure}")
+	sys.exit(1 if failures else 0)
+
+if __name__ == "__main__":
+	main()
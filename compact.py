@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import os
+import time
+import logging
+import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from datetime import datetime
+from pathlib import Path
+from config import Config, load_config, default_config_path
+from download_tuning import parse_time_range, in_time_range
+from fsutil import staging_path
+from metrics import metrics
+
+CLI_description = '''Re-encode old lectures in the video directory to save space, keeping the originals until the result is verified.'''
+codec_names = {"libx265": "hevc", "libsvtav1": "av1", "libaom-av1": "av1"}	# encoder : codec name reported by ffprobe
+retry_after = 7 * 86400	# in seconds, how long a file that failed or didn't shrink is left alone
+
+def probe(file: Path) -> dict:
+	'''The duration and the (type, codec) of each stream of a media file.'''
+	result = subprocess.run(['ffprobe', '-v', 'error', '-show_entries', 'stream=codec_type,codec_name:format=duration',
+		'-of', 'json', str(file)], check=True, capture_output=True, text=True)
+	info = json.loads(result.stdout)
+	return {
+		"duration": float(info["format"]["duration"]),
+		"streams": [(s.get("codec_type"), s.get("codec_name")) for s in info.get("streams", [])],
+	}
+
+def lower_priority(pid: int):
+	'''Let process `pid` (the encoder) run only when the CPU is otherwise idle, so downloads, merges and transcriptions
+	are not slowed down. Set from the parent, as `preexec_fn` is unsafe in a threaded process. The priority is per
+	thread, so the threads the encoder started already are set too, and those it starts later inherit it.'''
+	try:
+		threads = [int(tid) for tid in os.listdir(f"/proc/{pid}/task")]
+	except OSError:
+		threads = [pid]
+	for tid in threads:
+		try:
+			try:
+				os.sched_setscheduler(tid, os.SCHED_IDLE, os.sched_param(0))
+			except (AttributeError, PermissionError):
+				os.setpriority(os.PRIO_PROCESS, tid, 19)
+		except ProcessLookupError:	# the thread exited meanwhile
+			pass
+
+def run_idle(command: list[str]):
+	'''Like `subprocess.run(command, check=True)`, at the lowest CPU priority.'''
+	with subprocess.Popen(command) as process:
+		try:
+			lower_priority(process.pid)
+			process.wait()
+		except BaseException:
+			process.kill()
+			raise
+	if process.returncode:
+		raise subprocess.CalledProcessError(process.returncode, command)
+
+def in_hours(hours: str, now: datetime) -> bool:
+	'''Whether `now` is in the "HH:MM-HH:MM" range `hours`, which may wrap around midnight. An empty range is always.'''
+	return not hours or in_time_range(*parse_time_range(hours), now)
+
+class Compactor:
+	'''Re-encode the outputs in `video_dir` older than `compact_after` days with a CPU codec, at the lowest CPU priority.
+
+	Each file is encoded next to itself, checked with ffprobe (same streams and duration, the new codec, smaller than
+	the original), and renamed over the original, keeping its modification time. The outcome for each file is recorded
+	in `data_dir/compaction.json`: compacted files (and those already in the codec) are not probed again, and files that
+	failed or didn't shrink are left alone for `retry_after`. A file replaced by a new output is considered again.'''
+	def __init__(self, config: Config):
+		if config.compact_codec not in codec_names:
+			raise ValueError(f"Unsupported compact_codec {config.compact_codec}, expected one of {', '.join(codec_names)}.")
+		self.config = config
+		self.state_file = Path(config.data_dir) / "compaction.json"
+		self.records = {}	# file : {"mtime", "result" ("compacted", "kept" or "failed"), "at"}
+		self.lock = threading.Lock()
+		self.thread = None
+		if self.state_file.exists():
+			try:
+				with self.state_file.open('r') as f:
+					self.records = json.load(f)
+			except (OSError, ValueError) as e:
+				logging.warning(f"Failed to read {self.state_file}: {e}")
+
+	def candidates(self, older_than: float = None) -> list[Path]:
+		'''The outputs old enough to compact, oldest first.'''
+		older_than = self.config.compact_after if older_than is None else older_than
+		cutoff = time.time() - older_than * 86400
+		files = [f for f in Path(self.config.video_dir).glob("*.mp4")
+			if not f.name.startswith(".") and f.stat().st_mtime < cutoff and not self.settled(f)]
+		return sorted(files, key=lambda f: f.stat().st_mtime)
+
+	def settled(self, file: Path) -> bool:
+		'''Whether the file needs no attempt now, given the outcome recorded for it.'''
+		with self.lock:
+			record = self.records.get(str(file))
+		if record is None or record["mtime"] != file.stat().st_mtime:
+			return False
+		return record["result"] == "compacted" or record["at"] > time.time() - retry_after
+
+	def encode_command(self, input_file: Path, output_file: Path) -> list[str]:
+		codec = self.config.compact_codec
+		preset = ['-preset', self.config.compact_preset] if self.config.compact_preset else []
+		tag = ['-tag:v', 'hvc1'] if codec == "libx265" else []	# so that Apple players recognize HEVC in mp4
+		# audio and subtitles are copied as is, they are a small part of the size
+		return ['ffmpeg', '-i', str(input_file), '-map', '0', '-c', 'copy', '-c:v', codec, '-crf', str(self.config.compact_crf),
+			*preset, *tag, '-movflags', '+faststart', '-y', str(output_file), '-loglevel', 'error', '-hide_banner', '-nostdin']
+
+	def compact(self, file: Path) -> int:
+		'''Re-encode one file in place, return the bytes saved (0 if the file is kept as is).'''
+		stat = file.stat()
+		target = codec_names[self.config.compact_codec]
+		staged_file = staging_path(file)
+		try:
+			original = probe(file)
+			if any(kind == "video" and name == target for kind, name in original["streams"]) \
+					or not any(kind == "video" for kind, _ in original["streams"]):
+				self.record(file, stat.st_mtime, "compacted")	# already in the codec, or nothing to re-encode
+				return 0
+			logging.info(f"Compacting {file.name} ({stat.st_size / 2**20:.0f} MiB) with {self.config.compact_codec}.")
+			with metrics.span("compact", codec=self.config.compact_codec):
+				run_idle(self.encode_command(file, staged_file))
+			error = self.verify(original, probe(staged_file), target)
+			size = staged_file.stat().st_size
+			if error is None and size >= stat.st_size:
+				error = f"not smaller ({size / 2**20:.0f} MiB)"
+			if error:
+				logging.warning(f"Keeping the original of {file.name}: {error}.")
+				self.record(file, stat.st_mtime, "kept")
+				return 0
+			if file.stat().st_mtime != stat.st_mtime:
+				logging.warning(f"{file.name} changed while it was compacted, keeping it.")
+				return 0
+			os.utime(staged_file, (stat.st_atime, stat.st_mtime))	# keep the age of the lecture
+			staged_file.replace(file)
+			self.record(file, stat.st_mtime, "compacted")
+		except (OSError, subprocess.CalledProcessError, ValueError, KeyError) as e:
+			logging.error(f"Failed to compact {file.name}: {e}")
+			self.record(file, stat.st_mtime, "failed")
+			return 0
+		finally:
+			staged_file.unlink(missing_ok=True)
+		saved = stat.st_size - size
+		metrics.count("compacted_bytes_saved", saved)
+		logging.info(f"Compacted {file.name} to {size / 2**20:.0f} MiB, saved {saved / 2**20:.0f} MiB.")
+		return saved
+
+	def verify(self, original: dict, compacted: dict, target: str) -> str | None:
+		'''Return what is wrong with the compacted file, or None.'''
+		kinds = lambda info: sorted(kind for kind, _ in info["streams"])
+		if kinds(original) != kinds(compacted):
+			return f"streams differ ({', '.join(kinds(compacted))})"
+		if not all(name == target for kind, name in compacted["streams"] if kind == "video"):
+			return "video not re-encoded"
+		if abs(original["duration"] - compacted["duration"]) > max(1.0, original["duration"] * 0.005):
+			return f"duration {compacted['duration']:.1f}s instead of {original['duration']:.1f}s"
+		return None
+
+	def record(self, file: Path, mtime: float, result: str):
+		with self.lock:
+			self.records[str(file)] = {"mtime": mtime, "result": result, "at": time.time()}
+			tmp_file = self.state_file.with_suffix('.tmp')
+			with tmp_file.open('w') as f:
+				json.dump(self.records, f)
+			tmp_file.replace(self.state_file)
+
+	def run(self, files: list[Path], until=lambda: True) -> int:
+		'''Compact the files with `compact_workers` encoders, starting new ones only while `until()` holds. Return the bytes saved.'''
+		saved = 0
+		pending = iter(files)
+		running = set()
+		with ThreadPoolExecutor(self.config.compact_workers, thread_name_prefix="compact") as pool:
+			while True:
+				while len(running) < self.config.compact_workers and until() and (file := next(pending, None)):
+					running.add(pool.submit(self.compact, file))
+				if not running:
+					return saved
+				done, running = wait(running, return_when=FIRST_COMPLETED)
+				saved += sum(future.result() for future in done)
+
+	def start(self, idle):
+		'''Compact in the background while `idle()` holds and within `compact_hours`, unless already running.'''
+		if self.thread is not None and self.thread.is_alive():
+			return
+		files = self.candidates()
+		if not files:
+			return
+		until = lambda: idle() and in_hours(self.config.compact_hours, datetime.now())
+		if not until():
+			return
+		logging.info(f"Compacting {len(files)} lectures in the background.")
+		self.thread = threading.Thread(target=self.run, args=(files, until), daemon=True, name="compact")
+		self.thread.start()
+
+def setup_parser(parser: argparse.ArgumentParser):
+	parser.add_argument("-c", "--config", help="Path to the configuration file.", default=default_config_path)
+	parser.add_argument("--older_than", type=float, default=None, help="In days, only compact lectures older than this. Defaults to compact_after.")
+	parser.add_argument("--dry_run", action="store_true", help="Only list the lectures that would be compacted.")
+
+def main(args: argparse.Namespace):
+	config = load_config(args.config)
+	compactor = Compactor(config)
+	files = compactor.candidates(args.older_than)
+	total = sum(f.stat().st_size for f in files)
+	print(f"{len(files)} lectures to compact, {total / 2**30:.1f} GiB.")
+	if args.dry_run:
+		for file in files:
+			print(f"{datetime.fromtimestamp(file.stat().st_mtime).strftime('%Y-%m-%d')} {file.stat().st_size / 2**20:8.0f} MiB  {file.name}")
+		return
+	saved = compactor.run(files)
+	print(f"Saved {saved / 2**30:.1f} GiB.")
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description=CLI_description)
+	setup_parser(parser)
+	args = parser.parse_args()
+	main(args)
@@ -30,6 +30,7 @@ course_id = 64222
 course_table = { 1 = 2, 3 = 2, 5 = 2 }
 auto_download = True
 '''
+import re
 import sys
 if sys.version_info < (3, 11):
 	import toml as tomllib
@@ -49,6 +50,9 @@ class Course(BaseModel):
 	auto_download: bool = True	# whether to auto-download the videos
 	transcribe: bool = False	# whether to transcribe the videos
 	readable_subtitles: bool = False	# whether to generate readable subtitles (a txt file)
+	audio_only: bool = False	# whether to keep only the audio (an m4a file, with subtitles in a srt file next to it)
+	skip_silence: bool = False	# whether to skip long silences (breaks, before and after class) when transcribing
+	trim_silence: bool = False	# whether to cut long silences out of the output, the subtitles are shifted to match
 	whisper_initial_prompt: str = "数学分析，极限，证明，闭集，开集。"
 	# file_name: str = "{videoTitle}-{month}-{day}.mp4"	# Not implemented yet
 
@@ -65,19 +69,70 @@ class Config(BaseModel):
 	video_dir: Path = Field(default=Path("~/Videos/forsythia"),
 						 repr=str, validate_default=True)  # directory to save the downloaded video
 	skip_before: int = 2  # in days, videos older than this will be ignored by the auto-download
-	check_interval: int = 15  # in minutes, how often to check for new videos
+	check_interval: int = 15  # in minutes, how often to check for new videos (with adaptive polling, on class days without history yet)
+	adaptive_polling: bool = True  # check courses often right after class and back off otherwise, see `PollSchedule`
+	poll_min_interval: int = 2  # in minutes, how often to check a course while its videos are expected
+	poll_max_interval: int = 240  # in minutes, the longest wait between checks of a course
+	upload_window_margin: int = 30  # in minutes, added on both sides of the usual upload delays of a course
 	aria2c_args: list[str] = ["-x", "16", "-s", "16", "-j", "16", "-k", "1M",
 		"--summary-interval=0",
 		"--download-result=hide",
 		"--console-log-level=warn"
 	]  # arguments to pass to aria2c
+	aria2c_rpc: bool = False  # download through one long-lived aria2c in RPC mode, shared by all courses
+	aria2c_rpc_port: int = 6800  # port of the aria2c RPC service, only listening on localhost
+	max_download_limit: str = "0"  # overall download speed limit of the aria2c RPC service, e.g. "10M", 0 means unlimited
+	max_concurrent_downloads: int = 5  # number of clips the aria2c RPC service downloads at the same time
+	bandwidth_schedule: dict[str, str] = {}  # "HH:MM-HH:MM" : download speed limit during that time, e.g. { "08:00-18:00" = "5M" }, max_download_limit otherwise
+	# with aria2c_rpc, the limit applies across all running downloads and follows the schedule, otherwise each aria2c gets the limit at its start
+	adaptive_connections: bool = True  # tune the connections per download for each host from the throughput achieved, backing off when throttled
+	min_connections: int = 1  # fewest connections per download with adaptive_connections
+	max_connections: int = 16  # most connections per download with adaptive_connections, aria2c allows at most 16
 	whisper_args: list[str] = [
 		"--model", "large-v2",
 		'--language', 'Chinese',
 		"--vad_filter", "True",
 		# "--verbose", "False",
 	]  # arguments to pass to whisper-ctranslate2
+	transcript_cache: bool = True  # reuse the transcripts of clips that were transcribed before with the same settings
+	transcript_index: bool = True  # add the transcripts to the index searched by `forsythia.py search`
+	transcribe_worker: bool = False  # send transcriptions to a running `forsythia.py transcribe_worker`, falling back to whisper-ctranslate2
+	shard_count: int = 1  # split the audio of each clip at silences into this many shards transcribed in parallel, 1 to disable (not split with transcribe_worker)
+	# number of shards transcribed at the same time, each by a faster-whisper process that loads the model once and keeps it
+	# until the job queue is empty, so peak memory is shard_workers copies of the model (about 3 GB each for large-v2 on CPU)
+	shard_workers: int = 4
+	silence_noise: str = "-35dB"  # audio below this level counts as silence when skipping or trimming silences
+	min_silence_duration: float = 60  # in seconds, shorter silences are not skipped or trimmed
+	freeze_check: bool = False  # only skip or trim silences while the video is frozen too, so that silent writing on the board is kept (slower)
+	metrics: bool = True  # record the duration of each stage in data_dir/metrics.jsonl, and totals in data_dir/metrics.prom
+	metrics_port: int = 0  # serve the metrics in the Prometheus format on http://127.0.0.1:<port>/metrics, 0 to disable
+	compact: bool = False  # re-encode old lectures in video_dir to save space while the daemon is idle, see `forsythia.py compact`
+	compact_after: int = 30  # in days, lectures younger than this are kept as downloaded
+	compact_codec: str = "libx265"  # "libx265" (HEVC) or "libsvtav1" (AV1)
+	compact_crf: int = 28  # quality of the re-encode, lower is better and larger (around 28 for libx265, 35 for libsvtav1)
+	compact_preset: str = ""  # encoder preset, e.g. "slow" for libx265 or "8" for libsvtav1, the default of the encoder if empty
+	compact_hours: str = "01:00-07:00"  # "HH:MM-HH:MM" when the daemon may start re-encodes, empty for any time
+	compact_workers: int = 1  # number of files re-encoded at the same time
+	store_keep: int = 14  # in days, with multi_user, how long outputs no longer linked from a video_dir stay in the shared store
 	post_download_script: str = ""  # script to run after downloading the videos
+	http_timeout: float = 30  # in seconds, timeout of each HTTP request
+	http_pool_connections: int = 4  # number of hosts to keep connection pools for
+	http_pool_maxsize: int = 16  # number of keep-alive connections per host, also the limit of concurrent requests to a host
+	host_overrides: dict[str, str] = {}  # host : base URL to send its requests to instead, e.g. a local stand-in server for benchmarks
+	session_max_age: int = 24  # in hours, how long a stored login session is trusted at most
+	session_refresh_margin: int = 30  # in minutes, refresh the login session this long before it expires
+	lti_cache_ttl: int = 60  # in minutes, how long the LTI launch of a course is reused
+	catalog_page_size: int = 20  # number of videos fetched per page when updating the video listing
+	catalog_resync_every: int = 24  # fetch the whole listing of a course every this many polls, to drop deleted videos
+	poll_concurrency: int = 8  # number of courses checked concurrently
+	detail_concurrency: int = 8  # number of video details fetched concurrently for one day
+	download_workers: int = 2  # number of jobs downloading at the same time
+	merge_workers: int = 1  # number of jobs running ffmpeg at the same time
+	transcribe_workers: int = 1  # number of jobs transcribing at the same time
+	partial_max_age: int = 7  # in days, partial downloads older than this are deleted
+	retry_backoff: int = 30  # in minutes, how long a video whose job failed waits before it is queued again, doubled after each failure
+	max_attempts: int = 5  # a video whose job failed this many times is not queued again
+	stream_download: bool = False  # merge the clips while downloading them, without storing them (a single connection per clip, slower than aria2c)
 	course: dict[str, 'Course'] = {}  # auto-download settings for each course
 
 	@field_validator('data_dir', 'tmp_dir', 'video_dir')
@@ -90,6 +145,13 @@ class Config(BaseModel):
 			logging.warning(f"Directory {v} does not exist, creating it.")
 		return v
 
+	@field_validator('bandwidth_schedule')
+	def check_time_ranges(cls, v):
+		for time_range in v:
+			if not re.fullmatch(r'\s*\d{1,2}(:\d{2})?\s*-\s*\d{1,2}(:\d{2})?\s*', time_range):
+				raise ValueError(f'Invalid time range "{time_range}" in bandwidth_schedule, expected "HH:MM-HH:MM".')
+		return v
+
 def load_config(path: str = default_config_path) -> Config:
 	'''Load the configuration from the given path. If the file does not exist, default values are used.'''
 	try:
@@ -0,0 +1,67 @@
+import json
+import time
+import threading
+import logging
+from pathlib import Path
+
+class DownloadStore:
+	'''Downloaded clips named after their videoId, so that an interrupted download resumes from the bytes already on disk.
+
+	The clips live in `tmp_dir/downloads` next to their aria2c control files. When each download started is kept in
+	`data_dir/downloads.json`, and partials that are already in the history or too old are garbage-collected.'''
+	def __init__(self, data_dir, tmp_dir, max_age: int = 7):
+		self.dir = Path(tmp_dir) / "downloads"
+		self.dir.mkdir(parents=True, exist_ok=True)
+		self.state_file = Path(data_dir) / "downloads.json"
+		self.max_age = max_age * 86400	# in seconds
+		self.started = {}	# videoId : time the download started
+		self.lock = threading.Lock()
+		if self.state_file.exists():
+			try:
+				with self.state_file.open('r') as f:
+					self.started = json.load(f)
+			except (OSError, ValueError) as e:
+				logging.warning(f"Failed to read download state {self.state_file}: {e}")
+
+	def path(self, video_id: str) -> Path:
+		return self.dir / f"{video_id}.mp4"
+
+	def start(self, video_ids: list[str]):
+		with self.lock:
+			for video_id in video_ids:
+				self.started.setdefault(video_id, time.time())
+			self.save()
+
+	def remove(self, video_ids: list[str]):
+		'''Delete the clips once they are no longer needed.'''
+		with self.lock:
+			for video_id in video_ids:
+				self._delete(video_id)
+			self.save()
+
+	def gc(self, history=None, keep=()):
+		'''Delete partials that are in the history, untracked, or older than `max_age`, except those in `keep`.'''
+		now = time.time()
+		with self.lock:
+			on_disk = {p.name.split('.')[0] for p in self.dir.iterdir()}
+			for video_id in on_disk | set(self.started):
+				if video_id in keep:
+					continue
+				started = self.started.get(video_id)
+				if (history is not None and video_id in history) or started is None or now - started > self.max_age:
+					logging.info(f"Removing stale partial download {video_id}.")
+					self._delete(video_id)
+			self.save()
+
+	def _delete(self, video_id: str):
+		clip = self.path(video_id)
+		clip.unlink(missing_ok=True)
+		clip.with_name(clip.name + ".aria2").unlink(missing_ok=True)
+		self.started.pop(video_id, None)
+
+	def save(self):
+		'''Write the state to disk. Must be called with the lock held.'''
+		tmp_file = self.state_file.with_suffix('.tmp')
+		with tmp_file.open('w') as f:
+			json.dump(self.started, f)
+		tmp_file.replace(self.state_file)
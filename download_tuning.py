@@ -0,0 +1,140 @@
+import json
+import time
+import logging
+import threading
+import urllib.parse
+from datetime import datetime
+from pathlib import Path
+
+throttle_codes = (29,)	# aria2c exit status / error code when the server is overloaded (HTTP 503)
+throttle_statuses = ("429", "503")
+backoff_time = 600	# in seconds, how long the connections of a host are not raised again after a throttle
+explore_every = 5	# downloads at the best number of connections before trying a neighbor that was slower
+
+def host_of(link: str) -> str:
+	return urllib.parse.urlsplit(link).hostname or ""
+
+def is_throttle(code, message: str = "") -> bool:
+	'''Whether an aria2c error means that the server throttles us.'''
+	try:
+		if int(code) in throttle_codes:
+			return True
+	except (TypeError, ValueError):
+		pass
+	return any(status in message for status in throttle_statuses) or "Too Many" in message
+
+class DownloadTuner:
+	'''Pick the number of connections per download (aria2c `split` and `max-connection-per-server`) for each host.
+
+	The throughput achieved with each number of connections is tracked as a moving average. After each download the
+	tuner goes back to the best number so far. At the best number, it doubles (or halves) it to explore, right away if
+	that number wasn't tried yet and every `explore_every` downloads otherwise, and turns around at the bounds. When the
+	server throttles, the number is halved, the faster measurements above it are dropped, and it is not raised again
+	for `backoff_time`. The state is kept in `data_dir/download_tuning.json`.'''
+	def __init__(self, data_dir=None, min_connections: int = 1, max_connections: int = 16):
+		self.path = Path(data_dir) / "download_tuning.json" if data_dir else None
+		self.min_connections = min_connections
+		self.max_connections = max_connections
+		self.hosts = {}	# host : {"connections", "direction", "throughput": {connections: bytes/s}, "backoff_until", "streak"}
+		self.lock = threading.Lock()
+		if self.path and self.path.exists():
+			try:
+				with self.path.open('r') as f:
+					self.hosts = json.load(f)
+			except (OSError, ValueError) as e:
+				logging.warning(f"Failed to read download tuning {self.path}: {e}")
+
+	def state(self, host: str) -> dict:
+		'''Must be called with the lock held.'''
+		state = self.hosts.setdefault(host, {"connections": self.max_connections, "direction": -1, "throughput": {}, "backoff_until": 0, "streak": 0})
+		state["connections"] = min(max(state["connections"], self.min_connections), self.max_connections)
+		return state
+
+	def connections(self, link: str) -> int:
+		with self.lock:
+			return self.state(host_of(link))["connections"]
+
+	def options(self, link: str) -> dict:
+		'''aria2c options for downloading `link`.'''
+		connections = self.connections(link)
+		return {"split": connections, "max-connection-per-server": connections}
+
+	def observe(self, link: str, connections: int, size: int, seconds: float):
+		'''Record that `size` bytes were downloaded from the host of `link` in `seconds`, with `connections` per download.'''
+		if size <= 0 or seconds <= 0:
+			return
+		host = host_of(link)
+		with self.lock:
+			state = self.state(host)
+			throughput = state["throughput"]
+			key = str(connections)	# json keys are strings
+			speed = size / seconds
+			throughput[key] = speed if key not in throughput else 0.7 * throughput[key] + 0.3 * speed
+			best = int(max(throughput, key=throughput.get))
+			if best != connections:
+				state["connections"] = best	# worse than the best so far, go back
+				state["direction"] = -state["direction"]
+				state["streak"] = 0
+			else:
+				step = connections * 2 if state["direction"] > 0 else connections // 2
+				if state["direction"] > 0 and time.time() < state["backoff_until"]:
+					step = connections
+				step = min(max(step, self.min_connections), self.max_connections)
+				if step == connections:
+					state["direction"] = -state["direction"]	# at a bound, explore the other way next time
+				elif str(step) in throughput and state.get("streak", 0) < explore_every:
+					step = connections	# the neighbor was slower, stay for now
+				state["streak"] = 0 if step != connections else state.get("streak", 0) + 1
+				state["connections"] = step
+			logging.debug(f"{host}: {speed / 2**20:.1f} MiB/s with {connections} connections, next {state['connections']}.")
+			self.save()
+
+	def throttled(self, link: str):
+		'''Back off after the host of `link` throttled or rejected our connections.'''
+		host = host_of(link)
+		with self.lock:
+			state = self.state(host)
+			connections = max(state["connections"] // 2, self.min_connections)
+			state["throughput"] = {k: v for k, v in state["throughput"].items() if int(k) < state["connections"]}
+			state["connections"] = connections
+			state["direction"] = -1
+			state["backoff_until"] = time.time() + backoff_time
+			logging.warning(f"{host} is throttling downloads, using {connections} connections per download.")
+			self.save()
+
+	def save(self):
+		'''Must be called with the lock held.'''
+		if self.path is None:
+			return
+		tmp_path = self.path.with_suffix(".tmp")
+		with tmp_path.open("w") as f:
+			json.dump(self.hosts, f)
+		tmp_path.replace(self.path)
+
+def parse_time_range(time_range: str) -> tuple[int, int]:
+	'''"HH:MM-HH:MM" as minutes after midnight.'''
+	start, _, end = time_range.partition("-")
+	minutes = []
+	for value in (start, end):
+		hour, _, minute = value.strip().partition(":")
+		minutes.append(int(hour) * 60 + int(minute or 0))
+	return minutes[0], minutes[1]
+
+def in_time_range(start: int, end: int, now: datetime) -> bool:
+	'''Whether `now` is in [start, end), in minutes after midnight. The range may wrap around midnight.'''
+	minute = now.hour * 60 + now.minute
+	return start <= minute < end or (end < start and (minute >= start or minute < end))
+
+class BandwidthSchedule:
+	'''Download speed limits by time of day, e.g. `{"08:00-18:00": "5M"}`, and `default` outside of them.
+
+	A range may wrap around midnight ("22:00-06:00"). If ranges overlap, the first one listed wins.'''
+	def __init__(self, schedule: dict[str, str], default: str = "0"):
+		self.default = default
+		self.ranges = [(*parse_time_range(time_range), limit) for time_range, limit in schedule.items()]
+
+	def limit(self, now: datetime) -> str:
+		for start, end, limit in self.ranges:
+			if in_time_range(start, end, now):
+				return limit
+		return self.default
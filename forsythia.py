@@ -1,30 +1,36 @@
 #!/usr/bin/env python3
 import argparse
-import process_video
-import search_download
-import auto_download
+import importlib
+import sys
+import log
 
-def main():
+# subcommand : help. Each subcommand is the module of the same name, imported only when it runs,
+# so that e.g. a `process_video` merge of local files doesn't load pydantic, requests and the login stack.
+commands = {
+	'process_video': 'Process and merge videos with optional transcription and readable subtitles.',
+	'search_download': 'Search and download videos from SJTU Canvas. Skip if less than `min_count` videos are uploaded.',
+	'auto_download': 'Auto-download videos based on configuration.',
+	'transcribe_worker': 'Run a transcription worker that keeps the whisper model loaded and serves jobs over a Unix socket.',
+	'search': 'Search the transcripts of downloaded lectures. Terms separated by spaces must all appear in a subtitle.',
+	'compact': 'Re-encode old lectures in the video directory to save space, keeping the originals until the result is verified.',
+	'multi_user': 'Auto-download for several users at once, polling and downloading each course only once.',
+}
+
+def main(argv=None):
+	argv = sys.argv[1:] if argv is None else argv
 	parser = argparse.ArgumentParser(description='Forsythia is a tool to download videos from SJTU Canvas.')
 	subparsers = parser.add_subparsers(dest='command', required=True, help='Subcommand to run')
 
-	process_video_parser = subparsers.add_parser('process_video', help=process_video.CLI_description)
-	process_video.setup_parser(process_video_parser)
-
-	search_download_parser = subparsers.add_parser('search_download', help=search_download.CLI_description)
-	search_download.setup_parser(search_download_parser)
-
-	auto_download_parser = subparsers.add_parser('auto_download', help=auto_download.CLI_description)
-	auto_download.setup_parser(auto_download_parser)
-
-	args = parser.parse_args()
+	# the top-level parser has no options besides -h, so the subcommand is the first argument
+	command = argv[0] if argv and argv[0] in commands else None
+	module = importlib.import_module(command) if command else None
+	for name, help in commands.items():
+		subparser = subparsers.add_parser(name, help=help)
+		if name == command:
+			module.setup_parser(subparser)
 
-	if args.command == 'process_video':
-		process_video.main(args)
-	elif args.command == 'search_download':
-		search_download.main(args)
-	elif args.command == 'auto_download':
-		auto_download.main(args)
+	args = parser.parse_args(argv)
+	module.main(args)
 
 if __name__ == "__main__":
-	main()
\ No newline at end of file
+	main()
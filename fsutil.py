@@ -0,0 +1,72 @@
+import errno
+import os
+import shutil
+import logging
+from pathlib import Path
+try:
+	import fcntl
+except ImportError:	# not on Windows, files are always copied there
+	fcntl = None
+
+FICLONE = 0x40049409	# ioctl from linux/fs.h
+
+def staging_path(output_file: Path) -> Path:
+	'''A hidden file next to the output with the same extension, so that ffmpeg can write it and the final step is a rename on the same file system.'''
+	output_file = Path(output_file)
+	return output_file.with_name(f".{output_file.stem}.part{output_file.suffix}")
+
+def reflink(src, dst) -> bool:
+	'''Clone `src` to `dst` without copying the data, on file systems that share extents (Btrfs, XFS, ...). Return whether it worked.'''
+	if fcntl is None:
+		return False
+	try:
+		with open(src, 'rb') as s, open(dst, 'wb') as d:
+			fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+		return True
+	except OSError:
+		Path(dst).unlink(missing_ok=True)
+		return False
+
+def link(src, dst) -> str:
+	'''Make `dst` a copy of `src` that shares its data, appearing atomically: a reflink if the file system supports it
+	(the copies stay independent), otherwise a hardlink (the same file under two names), otherwise a plain copy.
+	Return which one was made.'''
+	src, dst = Path(src), Path(dst)
+	staged_file = staging_path(dst)
+	staged_file.unlink(missing_ok=True)
+	try:
+		if reflink(src, staged_file):
+			kind = "reflink"
+		else:
+			try:
+				os.link(src, staged_file)
+				kind = "hardlink"
+			except OSError:	# another file system, or links not supported
+				shutil.copyfile(src, staged_file)
+				kind = "copy"
+		os.replace(staged_file, dst)
+	finally:
+		staged_file.unlink(missing_ok=True)
+	return kind
+
+def place(src, dst):
+	'''Move `src` to `dst` so that `dst` appears atomically and complete.
+
+	On the same file system this is a rename. Otherwise `src` is cloned (or copied, if the file systems can't share
+	extents) to a staging file next to `dst`, which is then renamed.'''
+	src, dst = Path(src), Path(dst)
+	try:
+		os.replace(src, dst)
+		return
+	except OSError as e:
+		if e.errno != errno.EXDEV:
+			raise
+	staged_file = staging_path(dst)
+	try:
+		if not reflink(src, staged_file):
+			logging.debug(f"Copying {src} to {dst}")
+			shutil.copyfile(src, staged_file)
+		os.replace(staged_file, dst)
+	finally:
+		staged_file.unlink(missing_ok=True)
+	src.unlink()
@@ -1,27 +1,127 @@
 import os
+import time
+import sqlite3
 import logging
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+
+states = ("listed", "downloaded", "merged", "transcribed", "failed")
+finished_states = ("merged", "transcribed")	# the output file exists, so the video is not downloaded again
+fields = ("course", "size", "duration", "course_begin_time", "listed_at", "downloaded_at", "completed_at", "error", "attempts", "retry_at")
+failure_fields = ("error", "attempts", "retry_at")	# set as given, so that None clears them
 
 class History:
-	'''A class to keep track of downloaded videos to prevent redundant downloads.'''
+	'''A class to keep track of downloaded videos to prevent redundant downloads.
+
+	The state of each video (listed, downloaded, then merged or transcribed, or failed) is kept in `data_dir/history.db`
+	with its size, duration and timings. The database is in WAL mode, so other processes can read it while the daemon
+	writes. An existing `history.txt` is migrated on first use.'''
 	def __init__(self, data_dir: str):
 		self.data_dir = data_dir
-		self.history_file = f"{data_dir}/history.txt"
-		self.history = set()
-		self.load_history()
-
-	def load_history(self):
-		if os.path.exists(self.history_file):
-			with open(self.history_file, 'r') as f:
-				self.history = set(f.read().splitlines())
-		else:
-			os.makedirs(self.data_dir, exist_ok=True)
-			with open(self.history_file, 'w') as f:
-				logging.info(f"History file {self.history_file} does not exist, creating it.")
-
-	def add(self, video_id: str):
-		self.history.add(video_id)
-		with open(self.history_file, 'a') as f:
-			f.write(video_id + '\n')
+		os.makedirs(data_dir, exist_ok=True)
+		self.db_file = Path(data_dir) / "history.db"
+		# autocommit, transactions are opened explicitly by `batch`
+		self.db = sqlite3.connect(self.db_file, check_same_thread=False, isolation_level=None)
+		self.db.row_factory = sqlite3.Row
+		self.lock = threading.RLock()
+		self.depth = 0	# nesting of `batch`
+		self.db.execute("PRAGMA journal_mode=WAL")
+		self.db.execute("PRAGMA synchronous=NORMAL")
+		self.db.execute("PRAGMA busy_timeout=5000")
+		with self.batch():
+			self.db.execute('''CREATE TABLE IF NOT EXISTS videos (
+				video_id TEXT PRIMARY KEY,
+				state TEXT NOT NULL,
+				course TEXT,
+				size INTEGER,	-- in bytes
+				duration REAL,	-- in seconds
+				course_begin_time REAL,	-- timestamps in seconds
+				listed_at REAL,
+				downloaded_at REAL,
+				completed_at REAL,
+				updated_at REAL,
+				error TEXT,
+				attempts INTEGER,	-- number of failed jobs
+				retry_at REAL)''')
+			columns = {row["name"] for row in self.db.execute("PRAGMA table_info(videos)")}
+			for column, kind in (("attempts", "INTEGER"), ("retry_at", "REAL")):
+				if column not in columns:	# a database created before the column was added
+					self.db.execute(f"ALTER TABLE videos ADD COLUMN {column} {kind}")
+			self.db.execute("CREATE INDEX IF NOT EXISTS videos_state ON videos (state)")
+			self.db.execute("CREATE INDEX IF NOT EXISTS videos_course ON videos (course, course_begin_time)")
+		self.migrate(Path(data_dir) / "history.txt")
+
+	def migrate(self, history_file: Path):
+		'''Import the video IDs of the old text history as finished, and rename the file so that it is imported once.'''
+		if not history_file.exists():
+			return
+		with history_file.open('r') as f:
+			video_ids = [line for line in f.read().splitlines() if line]
+		logging.info(f"Migrating {len(video_ids)} videos from {history_file} to {self.db_file}.")
+		now = time.time()
+		with self.batch():
+			self.db.executemany("INSERT OR IGNORE INTO videos (video_id, state, updated_at) VALUES (?, 'merged', ?)",
+				((video_id, now) for video_id in video_ids))
+		history_file.rename(history_file.with_name(history_file.name + ".migrated"))
+
+	@contextmanager
+	def batch(self):
+		'''Group writes into one transaction, committed when the outermost `with history.batch():` exits.'''
+		with self.lock:
+			if self.depth == 0:
+				self.db.execute("BEGIN IMMEDIATE")
+			self.depth += 1
+			try:
+				yield
+			except BaseException:
+				self.depth -= 1
+				if self.depth == 0:
+					self.db.execute("ROLLBACK")
+				raise
+			self.depth -= 1
+			if self.depth == 0:
+				self.db.execute("COMMIT")
+
+	def update(self, video_id: str, state: str = None, **values):
+		'''Set the state and metadata of a video. Fields left out (or None, except `failure_fields`) keep their value, and
+		`listed_at` keeps the first one.
+		Without a state, a new video is inserted as listed and a known one keeps its state.'''
+		if state is not None and state not in states:
+			raise ValueError(f"Unknown state {state}")
+		unknown = set(values) - set(fields)
+		if unknown:
+			raise ValueError(f"Unknown history fields {', '.join(unknown)}")
+		columns = list(values)
+		updates = [f"{c} = COALESCE(videos.{c}, excluded.{c})" if c == "listed_at" else f"{c} = excluded.{c}" if c in failure_fields
+			else f"{c} = COALESCE(excluded.{c}, videos.{c})" for c in columns]
+		sql = (f"INSERT INTO videos (video_id, state, updated_at{''.join(', ' + c for c in columns)}) "
+			f"VALUES (:video_id, COALESCE(:state, 'listed'), :updated_at{''.join(', :' + c for c in columns)}) "
+			f"ON CONFLICT (video_id) DO UPDATE SET state = COALESCE(:state, videos.state), updated_at = excluded.updated_at"
+			f"{''.join(', ' + u for u in updates)}")
+		with self.batch():
+			self.db.execute(sql, {"video_id": video_id, "state": state, "updated_at": time.time(), **values})
+
+	def listed(self, video_id: str, **values):
+		'''Record that a video is in the listing, without moving it back from a later state (or clearing its error).'''
+		self.update(video_id, listed_at=time.time(), **values)
+
+	def add(self, video_id: str, state: str = "merged", **values):
+		'''Record that a video has been processed into its output file, clearing the failures of earlier jobs.'''
+		self.update(video_id, state, completed_at=time.time(), **{**dict.fromkeys(failure_fields), **values})
+
+	def get(self, video_id: str) -> dict | None:
+		with self.lock:
+			row = self.db.execute("SELECT * FROM videos WHERE video_id = ?", (video_id,)).fetchone()
+		return dict(row) if row else None
+
+	def videos(self, course: str, limit: int = 100) -> list[dict]:
+		'''The most recent videos of a course, by course begin time.'''
+		with self.lock:
+			rows = self.db.execute("SELECT * FROM videos WHERE course = ? ORDER BY course_begin_time DESC LIMIT ?", (course, limit)).fetchall()
+		return [dict(row) for row in rows]
 
 	def __contains__(self, video_id: str):
-		return video_id in self.history
\ No newline at end of file
+		with self.lock:
+			row = self.db.execute("SELECT state FROM videos WHERE video_id = ?", (video_id,)).fetchone()
+		return row is not None and row["state"] in finished_states
@@ -0,0 +1,88 @@
+import urllib.parse
+import requests
+from requests.adapters import HTTPAdapter
+
+class OverrideAdapter(HTTPAdapter):
+	'''Send the requests to some hosts to another base URL instead, such as a local stand-in server.
+
+	Responses keep the original URL, so that cookies, redirects and checks on `response.url` work as if the
+	request had gone to the original host.'''
+	def __init__(self, overrides: dict[str, str], **kwargs):
+		self.overrides = overrides	# host : base URL
+		super().__init__(**kwargs)
+
+	def send(self, request, **kwargs):
+		url = urllib.parse.urlsplit(request.url)
+		base = self.overrides.get(url.hostname)
+		if base is not None:
+			request.original_url = request.url
+			request.url = base.rstrip("/") + url.path + (f"?{url.query}" if url.query else "")
+		return super().send(request, **kwargs)
+
+	def build_response(self, req, resp):
+		if getattr(req, "original_url", None):
+			req.url = req.original_url
+		return super().build_response(req, resp)
+
+class HTTPClient:
+	'''A pooled HTTP client shared by the login and video modules.
+
+	Connections are kept alive per host, so a poll cycle pays for one handshake per host
+	instead of one per request. All requests share the cookie jar of the underlying session.'''
+	def __init__(self, timeout: float = 30, pool_connections: int = 4, pool_maxsize: int = 16, host_overrides: dict[str, str] = None):
+		self.timeout = timeout
+		self.session = requests.Session()
+		# with pool_block, pool_maxsize also bounds the number of concurrent requests to a host
+		pool_options = dict(pool_connections=pool_connections, pool_maxsize=pool_maxsize, pool_block=True)
+		adapter = OverrideAdapter(host_overrides, **pool_options) if host_overrides else HTTPAdapter(**pool_options)
+		self.session.mount("https://", adapter)
+		self.session.mount("http://", adapter)
+
+	@property
+	def cookies(self):
+		return self.session.cookies
+
+	def request(self, method, url, session_cookies=True, **kwargs):
+		'''Send a request through the pool. With `session_cookies=False`, cookies in the shared jar are not sent.'''
+		kwargs.setdefault("timeout", self.timeout)
+		if session_cookies:
+			return self.session.request(method, url, **kwargs)
+		send_kwargs = {k: kwargs.pop(k) for k in ("timeout", "allow_redirects", "stream") if k in kwargs}
+		headers = {**self.session.headers, **kwargs.pop("headers", {})}
+		prepared = requests.Request(method, url, headers=headers, **kwargs).prepare()
+		return self.session.send(prepared, **send_kwargs)
+
+	def get(self, url, **kwargs):
+		return self.request("GET", url, **kwargs)
+
+	def post(self, url, **kwargs):
+		return self.request("POST", url, **kwargs)
+
+	def close(self):
+		self.session.close()
+
+default_client = None
+
+def get_client() -> HTTPClient:
+	'''Return the process-wide client, creating one with default settings if needed.'''
+	global default_client
+	if default_client is None:
+		default_client = HTTPClient()
+	return default_client
+
+def new_client(config) -> HTTPClient:
+	'''A client built from the given `Config`, with its own connections and cookie jar.'''
+	return HTTPClient(
+		timeout=config.http_timeout,
+		pool_connections=config.http_pool_connections,
+		pool_maxsize=config.http_pool_maxsize,
+		host_overrides=config.host_overrides,
+	)
+
+def configure_client(config) -> HTTPClient:
+	'''Replace the process-wide client with one built from the given `Config`.'''
+	global default_client
+	if default_client is not None:
+		default_client.close()
+	default_client = new_client(config)
+	return default_client
@@ -0,0 +1,323 @@
+import json
+import time
+import shutil
+import threading
+import logging
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from pydantic import BaseModel
+from config import Config
+from history import History
+from download_store import DownloadStore
+from aria2_rpc import Aria2Service
+from fsutil import place
+from metrics import metrics
+import process_video
+
+link_ttl = 1800	# in seconds, the links are signed and expire, older ones are resolved again before they are used
+
+class Job(BaseModel):
+	'''A batch of videos of one course and day, processed into a single output file.'''
+	job_id: str
+	course_name: str
+	date: str	# YYYY-MM-DD
+	video_ids: list[str]
+	links: list[str]
+	links_at: float = 0	# when the links were resolved
+	course_id: int | None = None	# to resolve the links again
+	output_file: Path
+	transcribe: bool = False
+	readable_subtitle: bool = False
+	whisper_initial_prompt: str = ""
+	audio_only: bool = False
+	skip_silence: bool = False
+	trim_silence: bool = False
+	stage: str = "download"	# the next stage to run: download, transcribe or merge (merge and transcribe when streaming)
+	files: list[Path] = []	# clips to merge
+	transcript: Path | None = None	# subtitles of the clips, muxed while merging
+	merged_file: Path | None = None
+	subscribers: list[dict] = []	# with multi_user, the users the output is delivered to (see `MultiUserDaemon.deliver`)
+
+# stage : the pool that runs it
+stage_pools = {
+	"download": "network",
+	"merge": "ffmpeg",
+	"transcribe": "transcription",
+}
+
+class JobScheduler:
+	'''Run the stages of each job in separate worker pools, so that one course can download while another one is transcribed.
+
+	The queue is kept in `data_dir/jobs.json`, and unfinished jobs are resumed from their current stage on startup, with
+	links resolved again by `relink` if they may have expired. The videos of a failed job are recorded in the history with
+	their number of attempts, and are held back from the queue for `retry_backoff` (doubled after each failure), or for
+	good after `max_attempts`.'''
+	def __init__(self, config: Config, history: History = None, on_idle=None, on_finish=None, relink=None):
+		self.config = config
+		self.history = history
+		self.relink = relink	# called with a job, returns fresh links for its videos
+		self.on_idle = on_idle	# called after a job finishes and no job is left
+		self.on_finish = on_finish	# called with each job and whether it succeeded, before its temporary files are deleted
+		self.state_file = Path(config.data_dir) / "jobs.json"
+		self.pools = {
+			"network": ThreadPoolExecutor(config.download_workers, thread_name_prefix="download"),
+			"ffmpeg": ThreadPoolExecutor(config.merge_workers, thread_name_prefix="merge"),
+			"transcription": ThreadPoolExecutor(config.transcribe_workers, thread_name_prefix="transcribe"),
+		}
+		self.downloads = DownloadStore(config.data_dir, config.tmp_dir, config.partial_max_age)
+		self.jobs: dict[str, Job] = {}
+		self.finished = False	# whether any job has finished since the queue was last idle
+		self.lock = threading.Lock()
+		process_video.configure(config)
+		self.download_service = None
+		if config.aria2c_rpc:
+			self.download_service = Aria2Service(config.aria2c_args, config.aria2c_rpc_port,
+				config.max_download_limit, config.max_concurrent_downloads)
+			self.download_service.start()
+			if process_video.bandwidth_schedule:
+				self.download_service.follow_schedule(process_video.bandwidth_schedule)
+			process_video.download_service = self.download_service
+		self.load()
+		self.downloads.gc(history, keep={video_id for job in self.jobs.values() for video_id in job.video_ids})
+
+	def load(self):
+		if not self.state_file.exists():
+			return
+		try:
+			with self.state_file.open('r') as f:
+				jobs = [Job(**i) for i in json.load(f)]
+		except (OSError, ValueError) as e:
+			logging.error(f"Failed to read job queue {self.state_file}: {e}")
+			return
+		for job in jobs:
+			if job.stage != "download" and not all(f.exists() for f in job.files + [job.merged_file] if f):
+				job.stage = "download"	# the intermediate files are gone, start over
+			logging.info(f"Resuming job {job.course_name}-{job.date} at stage {job.stage}.")
+			self.jobs[job.job_id] = job
+			self.schedule(job)
+
+	def save(self):
+		'''Write the queue to disk. Must be called with the lock held.'''
+		tmp_file = self.state_file.with_suffix('.tmp')
+		with tmp_file.open('w') as f:
+			json.dump([job.model_dump(mode='json') for job in self.jobs.values()], f)
+		tmp_file.replace(self.state_file)
+
+	def submit(self, course_name: str, date: str, video_ids: list[str], links: list[str], output_file: Path,
+			transcribe=False, readable_subtitle=False, whisper_initial_prompt="", audio_only=False,
+			skip_silence=False, trim_silence=False, subscribers=None, course_id: int = None) -> Job:
+		job = Job(job_id=uuid.uuid4().hex, course_name=course_name, date=date, video_ids=video_ids, links=links,
+			links_at=time.time(), course_id=course_id, output_file=output_file, transcribe=transcribe, readable_subtitle=readable_subtitle,
+			whisper_initial_prompt=whisper_initial_prompt, audio_only=audio_only,
+			skip_silence=skip_silence, trim_silence=trim_silence, subscribers=subscribers or [])
+		with self.lock:
+			self.jobs[job.job_id] = job
+			self.save()
+		metrics.count("jobs_queued", course=course_name)
+		self.schedule(job)
+		return job
+
+	def __contains__(self, video_id: str):
+		'''Whether the video is part of a job that hasn't finished yet, or is held back after failed jobs.'''
+		with self.lock:
+			if any(video_id in job.video_ids for job in self.jobs.values()):
+				return True
+		return self.held(video_id)
+
+	def held(self, video_id: str) -> bool:
+		'''Whether the jobs of the video failed recently (it waits for its `retry_at`) or `max_attempts` times.'''
+		if self.history is None:
+			return False
+		row = self.history.get(video_id)
+		if row is None or row["state"] != "failed":
+			return False
+		return (row["attempts"] or 0) >= self.config.max_attempts or (row["retry_at"] or 0) > time.time()
+
+	def subscribed(self, user: str) -> set[str]:
+		'''The videos of the unfinished jobs that will be delivered to `user`.'''
+		with self.lock:
+			return {video_id for job in self.jobs.values() if any(s["user"] == user for s in job.subscribers)
+				for video_id in job.video_ids}
+
+	def join(self, video_ids: list[str], subscriber: dict, **options) -> Job | None:
+		'''Add a subscriber to the unfinished job of the same videos and options, if there is one.'''
+		with self.lock:
+			for job in self.jobs.values():
+				if job.video_ids == video_ids and all(getattr(job, k) == v for k, v in options.items()):
+					job.subscribers.append(subscriber)
+					self.save()
+					return job
+		return None
+
+	def pending(self) -> int:
+		with self.lock:
+			return len(self.jobs)
+
+	def progress(self) -> dict[str, dict]:
+		'''Return the download speed, progress and ETA of each downloading job, keyed by "course-date".'''
+		if self.download_service is None:
+			return {}
+		with self.lock:
+			jobs = [job for job in self.jobs.values() if job.stage == "download"]
+		return {f"{job.course_name}-{job.date}": self.download_service.progress(job.job_id) for job in jobs}
+
+	def schedule(self, job: Job):
+		self.pools[stage_pools[job.stage]].submit(self.run, job)
+		self.report_depth()
+
+	def report_depth(self):
+		'''Record the number of jobs waiting for or running each stage.'''
+		with self.lock:
+			depth = {stage: sum(1 for job in self.jobs.values() if job.stage == stage) for stage in stage_pools}
+		for stage, jobs in depth.items():
+			metrics.gauge("queue_depth", jobs, stage=stage)
+
+	def run(self, job: Job):
+		tmp_path = self.job_tmp_path(job)
+		try:
+			with metrics.span("job_stage", stage=job.stage, course=job.course_name):
+				next_stage = getattr(self, f"{job.stage}_stage")(job, tmp_path)
+		except Exception as e:
+			logging.error(f"Job {job.course_name}-{job.date} failed at stage {job.stage}: {e}", exc_info=True)
+			self.finish(job, success=False, error=f"{job.stage}: {e}")
+			return
+		if next_stage is None:
+			self.finish(job, success=True)
+			return
+		with self.lock:
+			job.stage = next_stage
+			self.save()
+		self.schedule(job)
+
+	def job_tmp_path(self, job: Job) -> Path:
+		tmp_path = Path(self.config.tmp_dir) / job.job_id
+		tmp_path.mkdir(parents=True, exist_ok=True)
+		return tmp_path
+
+	def refresh_links(self, job: Job):
+		'''Resolve the links of the job again if they may have expired, e.g. when it is resumed.'''
+		if self.relink is None or job.course_id is None or time.time() - job.links_at < link_ttl:
+			return
+		logging.info(f"Resolving the links of {job.course_name} on {job.date} again.")
+		links = self.relink(job)
+		with self.lock:
+			job.links, job.links_at = links, time.time()
+			self.save()
+
+	def download_stage(self, job: Job, tmp_path: Path):
+		if self.config.stream_download:
+			return "merge"	# the merge stage reads the links directly
+		self.refresh_links(job)
+		logging.info(f"Downloading {len(job.links)} videos for {job.course_name} on {job.date}.")
+		files, links, file_names = process_video.prepare_inputs(job.links, self.downloads.dir, job.video_ids)
+		self.downloads.start(job.video_ids)
+		process_video.download_video(links, file_names, self.downloads.dir, tmp_path, tag=job.job_id)
+		job.files = files
+		if self.history:
+			now = time.time()
+			metadata = [(file.stat().st_size, process_video.probe_duration(file)) for file in files]
+			with self.history.batch():
+				for video_id, (size, duration) in zip(job.video_ids, metadata):
+					self.history.update(video_id, "downloaded", size=size, duration=duration, downloaded_at=now)
+		return "transcribe" if job.transcribe else "merge"
+
+	def merge_stage(self, job: Job, tmp_path: Path):
+		if job.files:
+			if job.transcribe and (job.transcript is None or not job.transcript.exists()):
+				return "transcribe"
+			readable_subtitle_path = job.output_file.with_suffix('.txt') if job.transcribe and job.readable_subtitle else ''
+			self.warn_overwrite(job)
+			process_video.merge_and_mux(job.files, job.output_file, tmp_path, job.transcript, readable_subtitle_path,
+				job.audio_only, job.trim_silence, (job.course_name, job.date))
+			return None
+		# streaming mode, the clips are only available merged
+		self.refresh_links(job)
+		direct = not job.transcribe and not job.trim_silence
+		merged_file = process_video.staging_path(job.output_file) if direct else tmp_path / f"merged{job.output_file.suffix}"
+		process_video.stream_merge_video(job.links, merged_file, tmp_path, job.audio_only)
+		job.merged_file = merged_file
+		if job.transcribe:
+			return "transcribe"
+		if job.trim_silence:
+			trimmed_file = process_video.staging_path(job.output_file)
+			process_video.trim_dead_air(merged_file, trimmed_file, tmp_path)
+			merged_file = trimmed_file
+		self.place(job, merged_file)
+		return None
+
+	def transcribe_stage(self, job: Job, tmp_path: Path):
+		logging.info(f"Transcribing {job.course_name} on {job.date}.")
+		if job.files:
+			# transcribe the clips ahead of the merge, which adds the subtitles in the same pass
+			transcript = tmp_path / "subtitles.srt"
+			process_video.transcribe_clips(job.files, transcript, tmp_path, job.whisper_initial_prompt, job.skip_silence)
+			job.transcript = transcript
+			return "merge"
+		transcribed_file = process_video.staging_path(job.output_file)
+		readable_subtitle_path = job.output_file.with_suffix('.txt') if job.readable_subtitle else ''
+		subtitle_path = job.output_file.with_suffix('.srt') if job.audio_only else ''
+		process_video.transcribe_video(job.merged_file, transcribed_file, tmp_path,
+			initial_prompt=job.whisper_initial_prompt, readable_subtitle_path=readable_subtitle_path,
+			subtitle_path=subtitle_path, skip_silence=job.skip_silence, trim_silence=job.trim_silence,
+			index_as=(job.course_name, job.date, job.output_file))
+		self.place(job, transcribed_file)
+		return None
+
+	def warn_overwrite(self, job: Job):
+		if job.output_file.exists():
+			logging.warning(f"Output file {job.output_file} already exists. Will overwrite it.")
+
+	def place(self, job: Job, out_file: Path):
+		self.warn_overwrite(job)
+		logging.info(f"Moving the final file to {job.output_file}")
+		place(out_file, job.output_file)	# a rename if the file is already staged next to the output
+
+	def finish(self, job: Job, success: bool, error: str = None):
+		if self.on_finish:
+			try:
+				self.on_finish(job, success)
+			except Exception as e:
+				logging.error(f"Failed to hand over job {job.course_name}-{job.date}: {e}", exc_info=True)
+		shutil.rmtree(Path(self.config.tmp_dir) / job.job_id, ignore_errors=True)
+		process_video.staging_path(job.output_file).unlink(missing_ok=True)
+		if success:
+			self.downloads.remove(job.video_ids)	# partials of a failed job are kept for the retry
+		with self.lock:
+			if self.history:
+				with self.history.batch():
+					for video_id in job.video_ids:
+						if success:
+							self.history.add(video_id, "transcribed" if job.transcribe else "merged")
+						else:
+							self.record_failure(video_id, error)
+			del self.jobs[job.job_id]
+			self.save()
+			self.finished = self.finished or success
+			idle = not self.jobs and self.finished
+			if idle:
+				self.finished = False
+		metrics.count("jobs_finished" if success else "jobs_failed", course=job.course_name)
+		self.report_depth()
+		if success:
+			logging.info(f"Finished processing {job.course_name} on {job.date}.")
+		if not self.pending():
+			process_video.release_shard_pool()	# the models of the shard pool are only loaded while there is work
+		if idle and self.on_idle:
+			self.on_idle()
+
+	def record_failure(self, video_id: str, error: str):
+		'''Count the failed attempt and hold the video back, with an exponential backoff. Must be called in a history batch.'''
+		attempts = ((self.history.get(video_id) or {}).get("attempts") or 0) + 1
+		if attempts >= self.config.max_attempts:
+			logging.error(f"Video {video_id} failed {attempts} times, it will not be queued again.")
+			retry_at = None
+		else:
+			retry_at = time.time() + self.config.retry_backoff * 60 * 2 ** (attempts - 1)
+		self.history.update(video_id, "failed", error=error, attempts=attempts, retry_at=retry_at)
+
+	def shutdown(self, wait=True):
+		for pool in self.pools.values():
+			pool.shutdown(wait=wait)
+		if self.download_service:
+			self.download_service.stop()
@@ -0,0 +1,162 @@
+import json
+import os
+import time
+import logging
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+
+prefix = "forsythia"
+max_events_size = 16 << 20	# in bytes, `metrics.jsonl` is rotated to `metrics.jsonl.1` beyond this
+
+def label_key(labels: dict) -> tuple:
+	return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+def format_labels(key: tuple, **extra) -> str:
+	pairs = [*key, *extra.items()]
+	if not pairs:
+		return ""
+	escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in pairs)
+	return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+class Metrics:
+	'''Spans and counters around the stages of the daemon (login, LTI launch, listing, details, download, merge, transcription).
+
+	Every finished span is appended to `data_dir/metrics.jsonl` as one JSON object, with its duration, labels and error
+	if any. Counters, gauges and the totals of the spans are kept in memory, written to `data_dir/metrics.prom` in the
+	Prometheus text format by `export`, and served at `http://127.0.0.1:<port>/metrics` with `serve`.
+	Until `configure` is called, nothing is written.'''
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.spans = {}	# (name, labels) : [count, total seconds, errors]
+		self.counters = {}	# (name, labels) : value
+		self.gauges = {}	# (name, labels) : value
+		self.events_file = None
+		self.events = None
+		self.prometheus_file = None
+		self.server = None
+
+	def configure(self, data_dir, port: int = 0):
+		'''Write the events and the exports to `data_dir`, and serve them on `port` unless it is 0.'''
+		with self.lock:
+			if self.events:
+				self.events.close()
+			self.events_file = Path(data_dir) / "metrics.jsonl"
+			self.events = self.events_file.open('a', encoding='utf-8', buffering=1)
+			self.prometheus_file = Path(data_dir) / "metrics.prom"
+		if port and self.server is None:
+			self.serve(port)
+
+	@contextmanager
+	def span(self, name: str, **labels):
+		'''Time the block as the span `name`. Also usable as a decorator.'''
+		start = time.time()
+		begin = time.perf_counter()
+		error = None
+		try:
+			yield
+		except BaseException as e:
+			error = f"{type(e).__name__}: {e}"
+			raise
+		finally:
+			self.record(name, labels, start, time.perf_counter() - begin, error)
+
+	def record(self, name: str, labels: dict, start: float, duration: float, error: str = None):
+		key = (name, label_key(labels))
+		with self.lock:
+			totals = self.spans.setdefault(key, [0, 0.0, 0])
+			totals[0] += 1
+			totals[1] += duration
+			totals[2] += error is not None
+			if self.events is None:
+				return
+			event = {"time": start, "span": name, "duration": round(duration, 6), **labels}
+			if error:
+				event["error"] = error
+			try:
+				self.events.write(json.dumps(event, ensure_ascii=False, default=str) + "\n")
+				if self.events.tell() > max_events_size:
+					self.rotate()
+			except OSError as e:
+				logging.warning(f"Failed to write metrics to {self.events_file}: {e}")
+
+	def rotate(self):
+		'''Must be called with the lock held.'''
+		self.events.close()
+		os.replace(self.events_file, self.events_file.with_name(self.events_file.name + ".1"))
+		self.events = self.events_file.open('a', encoding='utf-8', buffering=1)
+
+	def count(self, name: str, value: float = 1, **labels):
+		'''Add `value` to the counter `name`, e.g. bytes downloaded or retries.'''
+		key = (name, label_key(labels))
+		with self.lock:
+			self.counters[key] = self.counters.get(key, 0) + value
+
+	def gauge(self, name: str, value: float, **labels):
+		'''Set the gauge `name`, e.g. the depth of a queue.'''
+		with self.lock:
+			self.gauges[(name, label_key(labels))] = value
+
+	def prometheus(self) -> str:
+		'''All metrics in the Prometheus text format.'''
+		lines = []
+		with self.lock:
+			spans = {key: list(totals) for key, totals in self.spans.items()}
+			counters = dict(self.counters)
+			gauges = dict(self.gauges)
+		if spans:
+			lines.append(f"# TYPE {prefix}_span_duration_seconds summary")
+			for (name, key), (count, total, _) in sorted(spans.items()):
+				lines.append(f"{prefix}_span_duration_seconds_sum{format_labels(key, span=name)} {total:.6f}")
+				lines.append(f"{prefix}_span_duration_seconds_count{format_labels(key, span=name)} {count}")
+			lines.append(f"# TYPE {prefix}_span_errors_total counter")
+			for (name, key), (_, _, errors) in sorted(spans.items()):
+				lines.append(f"{prefix}_span_errors_total{format_labels(key, span=name)} {errors}")
+		for kind, values, suffix in (("counter", counters, "_total"), ("gauge", gauges, "")):
+			for name in sorted({name for name, _ in values}):
+				lines.append(f"# TYPE {prefix}_{name}{suffix} {kind}")
+				for (n, key), value in sorted(values.items()):
+					if n == name:
+						lines.append(f"{prefix}_{name}{suffix}{format_labels(key)} {value:g}")
+		return "\n".join(lines) + "\n"
+
+	def export(self):
+		'''Write `metrics.prom`, e.g. for the textfile collector of node_exporter.'''
+		if self.prometheus_file is None:
+			return
+		tmp_file = self.prometheus_file.with_suffix('.tmp')
+		try:
+			tmp_file.write_text(self.prometheus())
+			tmp_file.replace(self.prometheus_file)
+		except OSError as e:
+			logging.warning(f"Failed to write metrics to {self.prometheus_file}: {e}")
+
+	def serve(self, port: int):
+		'''Serve the metrics on localhost in a background thread.'''
+		from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer	# only needed with metrics_port
+		metrics = self
+
+		class Handler(BaseHTTPRequestHandler):
+			def log_message(self, format, *args):
+				pass
+
+			def do_GET(self):
+				if self.path != "/metrics":
+					self.send_error(404)
+					return
+				body = metrics.prometheus().encode()
+				self.send_response(200)
+				self.send_header("Content-Type", "text/plain; version=0.0.4")
+				self.send_header("Content-Length", str(len(body)))
+				self.end_headers()
+				self.wfile.write(body)
+
+		self.server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+		self.server.daemon_threads = True
+		threading.Thread(target=self.server.serve_forever, daemon=True).start()
+		logging.info(f"Serving metrics on http://127.0.0.1:{port}/metrics.")
+
+metrics = Metrics()	# the process-wide metrics
+span = metrics.span
+count = metrics.count
+gauge = metrics.gauge
@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+import argparse
+import asyncio
+import time
+import logging
+from datetime import datetime, timedelta
+from pathlib import Path
+from config import Config, Course, load_config, default_config_path
+from history import History
+from http_client import new_client
+from job_scheduler import JobScheduler, Job
+from metrics import metrics
+from poll_engine import should_download
+from search_download import select_videos, output_path
+from session_store import SessionStore
+from shared_store import SharedStore
+from sjtu_login import SJTU_Login
+from sjtu_real_canvas_video import LTICache, VideoCatalog, RealCourse, resolve_details, resolve_links
+from transcript_index import TranscriptIndex
+from subtitle import iter_cues
+from auto_download import run_post_download_script
+
+CLI_description = '''Auto-download for several users at once, polling and downloading each course only once.'''
+
+class User:
+	'''One user of the daemon, with their own HTTP client, login session, history and transcript index.'''
+	def __init__(self, config: Config):
+		self.name = config.username
+		self.config = config
+		self.login = SJTU_Login(config.username, config.password, new_client(config),
+			SessionStore(config.data_dir, config.username, config.session_max_age))
+		self.history = History(config.data_dir)
+		self.lti_cache = LTICache(config.lti_cache_ttl * 60)	# launches of this user, to check their access to courses
+		self.index = TranscriptIndex(config.data_dir) if config.transcript_index else None
+
+	def can_access(self, course_id: int) -> bool:
+		'''Whether the user can open the videos of a course themselves, so that they only get what they could download.'''
+		try:
+			self.lti_cache.get(course_id, self.login.login(), self.login.client)
+			return True
+		except Exception as e:
+			logging.warning(f"{self.name} cannot open the videos of course {course_id}: {e}")
+			return False
+
+def job_options(course: Course) -> dict:
+	'''The options of a course that change its output. Users with the same options share the output.'''
+	return dict(transcribe=course.transcribe, readable_subtitle=course.transcribe and course.readable_subtitles,
+		whisper_initial_prompt=course.whisper_initial_prompt if course.transcribe else "",
+		audio_only=course.audio_only, skip_silence=course.transcribe and course.skip_silence, trim_silence=course.trim_silence)
+
+class MultiUserDaemon:
+	'''Run `auto_download` for several users in one process.
+
+	Each course is polled once per cycle, with the session of the first of its subscribers that can log in, and each
+	batch of videos is processed once per set of processing options into a `SharedStore`, then linked into the
+	`video_dir` of each subscriber. Users keep their own login session, history and transcript index, and only get the
+	videos of courses they can open themselves.
+
+	The first configuration also sets the options of the daemon (intervals, workers, aria2c, tmp_dir). The job queue,
+	video listings, partial downloads and transcript cache are kept in the store directory.'''
+	def __init__(self, configs: list[Config], store_dir: Path):
+		names = [config.username for config in configs]
+		if len(set(names)) != len(names):
+			raise ValueError("Each configuration must be of a different user.")
+		for field in ("data_dir", "video_dir"):
+			# the daemon runs as one OS user, so configurations that keep the default paths share them
+			owners = {}
+			for config in configs:
+				owner = owners.setdefault(getattr(config, field).resolve(), config.username)
+				if owner != config.username:
+					raise ValueError(f"{owner} and {config.username} have the same {field} {getattr(config, field)}, "
+						f"set a different one for each user.")
+		store_dir.mkdir(parents=True, exist_ok=True)
+		# the outputs go to the store, and the transcripts to the index of each user on delivery
+		self.config = configs[0].model_copy(update={"data_dir": store_dir, "transcript_index": False,
+			"whisper_args": configs[0].whisper_args + ["--verbose", "False"]})
+		self.users = {config.username: User(config) for config in configs}
+		self.store = SharedStore(store_dir)
+		self.catalog = VideoCatalog(store_dir, self.config.catalog_page_size, LTICache(self.config.lti_cache_ttl * 60),
+			max(config.skip_before for config in configs), self.config.catalog_resync_every)
+		self.scheduler = JobScheduler(self.config, History(store_dir), on_finish=self.deliver, relink=self.relink)
+		self.subscriptions: dict[int, list[tuple[User, str, Course]]] = {}	# course_id : (user, course name, course)
+		for user in self.users.values():
+			for course_name, course in user.config.course.items():
+				if course.auto_download:
+					self.subscriptions.setdefault(course.course_id, []).append((user, course_name, course))
+
+	def fetch(self, course_id: int, subscribers: list) -> list[RealCourse] | None:
+		for user, _, _ in subscribers:
+			try:
+				return self.catalog.fetch(course_id, user.login.login(), user.login.client)
+			except Exception as e:
+				logging.warning(f"Failed to fetch the video list of course {course_id} as {user.name}: {e}")
+		return None
+
+	def check_course(self, course_id: int, subscribers: list):
+		'''Fetch the listing of a course once, and deliver or queue the new videos of each subscriber.'''
+		videos = self.fetch(course_id, subscribers)
+		if videos is None:
+			return
+		today = datetime.now()
+		for user, course_name, course in subscribers:
+			dates = [today - timedelta(days=offset) for offset in range(user.config.skip_before)]
+			dates = [d for d in dates if should_download(course, d)]
+			if not dates or not user.can_access(course_id):
+				continue
+			queued = self.scheduler.subscribed(user.name)
+			for video_date in dates:
+				selected = [i for i in select_videos(videos, video_date, user.history)
+					if i.video_id not in queued and not self.scheduler.held(i.video_id)]
+				if selected:
+					self.record_listed(user, course_name, selected)
+				if selected and len(selected) >= course.course_table.get(video_date.weekday() + 1, 0):
+					try:
+						self.submit(user, course_name, course, video_date, selected)
+					except Exception as e:
+						logging.error(f"Error queueing videos for {user.name} {course_name} on {video_date.strftime('%Y-%m-%d')}: {e}", exc_info=True)
+
+	def record_listed(self, user: User, course_name: str, videos: list[RealCourse]):
+		with user.history.batch():
+			for video in videos:
+				user.history.listed(video.video_id, course=course_name, course_begin_time=video.start_time.timestamp())
+
+	def submit(self, user: User, course_name: str, course: Course, date: datetime, videos: list[RealCourse]):
+		'''Link the output from the store if another user got it already, join the job of another user, or queue a new one.'''
+		options = job_options(course)
+		video_ids = [i.video_id for i in videos]
+		output_file = output_path(user.config, course_name, date, course.audio_only)
+		subscriber = {"user": user.name, "course_name": course_name, "date": date.strftime('%Y-%m-%d'), "output_file": str(output_file)}
+		key = self.store.key(video_ids, options)
+		entry = self.store.get(key)
+		if entry is not None:
+			self.store.deliver(entry, output_file)
+			self.delivered(user, video_ids, options)
+			metrics.count("shared_deliveries", source="store")
+			return
+		if self.scheduler.join(video_ids, subscriber, **options):
+			logging.info(f"{user.name} shares the queued job of {course_name} on {date.strftime('%m-%d')}.")
+			metrics.count("shared_deliveries", source="job")
+			return
+		resolve_details(videos, self.config.detail_concurrency)
+		logging.info(f"Found {len(videos)} videos for {course_name}({course.course_id}) on {date.strftime('%m-%d')}.")
+		self.scheduler.submit(course_name, date.strftime('%Y-%m-%d'), video_ids, [i["rtmpUrlHdv"] for i in videos],
+			self.store.incoming(key, output_file.suffix), subscribers=[subscriber], course_id=course.course_id, **options)
+
+	def relink(self, job: Job) -> list[str]:
+		'''Resolve the links of a resumed job again, as the first of its subscribers that can log in.'''
+		for subscriber in job.subscribers:
+			user = self.users.get(subscriber["user"])
+			if user is None:
+				continue
+			try:
+				return resolve_links(job.course_id, job.video_ids, user.login.login(), user.login.client,
+					self.catalog.cache, self.config.detail_concurrency)
+			except Exception as e:
+				logging.warning(f"Failed to resolve the links of job {job.course_name}-{job.date} as {user.name}: {e}")
+		raise RuntimeError(f"No subscriber of job {job.course_name}-{job.date} could resolve its links.")
+
+	def deliver(self, job: Job, success: bool):
+		'''Store the output of a finished job and link it to each subscriber, or record the failure in their history.'''
+		options = {k: getattr(job, k) for k in job_options(Course(course_id=0))}
+		entry = self.store.put(self.store.key(job.video_ids, options), job.output_file) if success else None
+		for subscriber in job.subscribers:
+			user = self.users.get(subscriber["user"])
+			if user is None:
+				logging.warning(f"Job {job.course_name}-{job.date} was for {subscriber['user']}, who is no longer configured.")
+				continue
+			if not success:
+				with user.history.batch():
+					for video_id in job.video_ids:
+						user.history.update(video_id, "failed", error=f"shared job {job.job_id} failed")
+				continue
+			output_file = Path(subscriber["output_file"])
+			self.store.deliver(entry, output_file)
+			if user.index and job.transcript and job.transcript.exists():
+				with open(job.transcript, 'r', encoding='utf-8') as f:
+					user.index.add(subscriber["course_name"], subscriber["date"], output_file, iter_cues(f))
+			self.delivered(user, job.video_ids, options)
+			run_post_download_script(user.config)
+
+	def delivered(self, user: User, video_ids: list[str], options: dict):
+		with user.history.batch():
+			for video_id in video_ids:
+				user.history.add(video_id, "transcribed" if options["transcribe"] else "merged")
+
+	async def poll(self):
+		semaphore = asyncio.Semaphore(self.config.poll_concurrency)
+
+		async def check(course_id, subscribers):
+			async with semaphore:
+				await asyncio.to_thread(self.check_course, course_id, subscribers)
+
+		await asyncio.gather(*(check(course_id, subscribers) for course_id, subscribers in self.subscriptions.items()))
+
+	def run(self):
+		for user in self.users.values():
+			user.login.login()
+			user.login.start_refresh(user.config.session_refresh_margin * 60)
+		logging.info(f"Logged in {len(self.users)} users, {len(self.subscriptions)} courses to poll.")
+		while True:
+			begin = time.time()
+			with metrics.span("poll_cycle", courses=len(self.subscriptions)):
+				asyncio.run(self.poll())
+			self.store.gc(self.config.store_keep)
+			metrics.export()
+			sleep_duration = max(self.config.check_interval * 60 - (time.time() - begin), 0)
+			next_check = (datetime.now() + timedelta(seconds=sleep_duration)).strftime('%H:%M')
+			logging.info(f"{self.scheduler.pending()} jobs in progress. Sleeping until {next_check}.")
+			try:
+				time.sleep(sleep_duration)
+			except KeyboardInterrupt:
+				logging.info("Interrupted. Exiting.")
+				self.scheduler.shutdown(wait=False)
+				break
+
+def setup_parser(parser: argparse.ArgumentParser):
+	parser.add_argument("-c", "--config", action="append", required=True,
+		help="Configuration file of a user, repeat for each user. The first one also sets the options of the daemon.")
+	parser.add_argument("-s", "--store", default=None,
+		help="Directory of the shared store and the state of the daemon. Defaults to `shared` in the data_dir of the first user. "
+			"Put it on the file system of the video_dir of the users, so that outputs are linked instead of copied.")
+
+def main(args: argparse.Namespace):
+	configs = [load_config(path) for path in args.config or [default_config_path]]
+	store_dir = Path(args.store).expanduser().resolve() if args.store else configs[0].data_dir / "shared"
+	if configs[0].metrics:
+		metrics.configure(store_dir, configs[0].metrics_port)
+	MultiUserDaemon(configs, store_dir).run()
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description=CLI_description)
+	setup_parser(parser)
+	args = parser.parse_args()
+	main(args)
@@ -0,0 +1,92 @@
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from config import Config, Course
+from history import History
+from sjtu_login import SJTU_Login
+from sjtu_real_canvas_video import VideoCatalog, prefetch_details
+from search_download import select_videos, download_videos, queue_videos
+from job_scheduler import JobScheduler
+
+def should_download(course: Course, date: datetime) -> bool:
+	"""Check if videos for a given date should be downloaded based on the course's schedule."""
+	weekday = date.weekday() + 1  # Convert to 1-7 (Mon-Sun)
+	return weekday in course.course_table
+
+class PollEngine:
+	'''Check all courses concurrently, and process the new videos of a course as soon as its check returns.
+
+	At most `config.poll_concurrency` courses are checked at once. Requests to the same host are further
+	bounded by the connection pool of the HTTP client (`config.http_pool_maxsize`).
+
+	With a scheduler, new videos are queued as jobs and the poll returns without waiting for them.'''
+	def __init__(self, config: Config, login: SJTU_Login, catalog: VideoCatalog, history: History, scheduler: JobScheduler = None):
+		self.config = config
+		self.login = login
+		self.catalog = catalog
+		self.history = history
+		self.scheduler = scheduler
+
+	async def check_course(self, course_name: str, course: Course, today: datetime, semaphore: asyncio.Semaphore):
+		'''Return the batches of a course that are ready to be processed.'''
+		video_dates = [today - timedelta(days=day_offset) for day_offset in range(self.config.skip_before)]
+		video_dates = [d for d in video_dates if should_download(course, d)]
+		if not video_dates:
+			return []
+		try:
+			async with semaphore:
+				cookies = await asyncio.to_thread(self.login.login)
+				videos = await asyncio.to_thread(self.catalog.fetch, course.course_id, cookies, self.login.client)
+		except Exception as e:
+			logging.error(f"Error fetching the video list of {course_name}: {e}", exc_info=True)
+			return []
+		ready = []
+		for video_date in video_dates:
+			selected = select_videos(videos, video_date, self.history)
+			if self.scheduler:
+				selected = [i for i in selected if i.video_id not in self.scheduler]
+			if selected:
+				await asyncio.to_thread(self.record_listed, course_name, selected)
+			if selected and len(selected) >= course.course_table.get(video_date.weekday() + 1, 0):
+				# resolve the details while the batch waits in the queue
+				prefetch_details(selected, self.config.detail_concurrency)
+				ready.append((course_name, course, video_date, selected))
+		return ready
+
+	def record_listed(self, course_name: str, videos: list):
+		with self.history.batch():
+			for video in videos:
+				self.history.listed(video.video_id, course=course_name, course_begin_time=video.start_time.timestamp())
+
+	async def process(self, queue: asyncio.Queue) -> set[str]:
+		'''Process (or queue) the batches one by one, return the names of the courses whose videos were downloaded (or queued).'''
+		download = set()
+		while (batch := await queue.get()) is not None:
+			course_name, course, video_date, videos = batch
+			try:
+				if self.scheduler:
+					await asyncio.to_thread(queue_videos, self.scheduler, self.config, course, videos, video_date, course_name)
+				else:
+					await asyncio.to_thread(download_videos, self.config, course, videos, video_date, course_name, self.history)
+				download.add(course_name)
+			except Exception as e:
+				logging.error(f"Error downloading videos for {course_name} on {video_date.strftime('%Y-%m-%d')}: {e}", exc_info=True)
+		return download
+
+	async def poll(self, courses: dict[str, Course] = None) -> set[str]:
+		'''Run one poll cycle over the courses (all auto-downloaded ones by default), return the names of those with new videos.'''
+		if courses is None:
+			courses = {name: course for name, course in self.config.course.items() if course.auto_download}
+		today = datetime.now()
+		semaphore = asyncio.Semaphore(self.config.poll_concurrency)
+		queue = asyncio.Queue()
+		worker = asyncio.create_task(self.process(queue))
+		checks = [
+			self.check_course(course_name, course, today, semaphore)
+			for course_name, course in courses.items()
+		]
+		for check in asyncio.as_completed(checks):
+			for batch in await check:
+				queue.put_nowait(batch)
+		queue.put_nowait(None)
+		return await worker
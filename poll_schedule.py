@@ -0,0 +1,99 @@
+from datetime import datetime, timedelta
+from config import Config, Course
+from history import History
+
+def quantile(values: list[float], q: float) -> float:
+	'''The `q` quantile of sorted `values`.'''
+	return values[min(len(values) - 1, int(q * len(values)))]
+
+class PollSchedule:
+	'''Decide when each course is checked next, from its `course_table` and the upload delays recorded in the history.
+
+	After each class an upload window is expected, from the class begin time plus the shortest usual delay until its
+	video is listed, to the begin time plus the longest usual delay, widened by `upload_window_margin`. Inside a window
+	the course is checked every `poll_min_interval`. Outside of windows the interval doubles after every check that
+	finds nothing, up to `poll_max_interval`, and the next check is never later than the start of the next window.
+	Windows of a day whose videos are all listed are skipped.
+
+	Class days without history yet are a single window over the whole day, checked every `check_interval`.'''
+	def __init__(self, config: Config, history: History):
+		self.config = config
+		self.history = history
+		self.next_check: dict[str, datetime] = {}	# course name : time of the next check
+		self.interval: dict[str, float] = {}	# course name : current interval between checks outside of windows, in seconds
+
+	def courses(self) -> dict[str, Course]:
+		return {name: course for name, course in self.config.course.items() if course.auto_download}
+
+	def windows(self, course: Course, day: datetime, videos: list[dict]) -> list[tuple[datetime, datetime, float]]:
+		'''The upload windows of a course on the day of `day`, as (start, end, interval between checks in seconds).'''
+		weekday = day.weekday() + 1
+		if weekday not in course.course_table:
+			return []
+		midnight = day.replace(hour=0, minute=0, second=0, microsecond=0)
+		videos = [v for v in videos if v["course_begin_time"] and v["listed_at"]]
+		delays = sorted(v["listed_at"] - v["course_begin_time"] for v in videos
+			if 0 <= v["listed_at"] - v["course_begin_time"] < 2 * 86400)	# longer ones were found by a late first run
+		begins = set()	# begin times of the classes on this weekday, in seconds after midnight rounded to 5 minutes
+		for v in videos:
+			begin = datetime.fromtimestamp(v["course_begin_time"])
+			if begin.weekday() == day.weekday():
+				begins.add(round((begin.hour * 3600 + begin.minute * 60) / 300) * 300)
+		if not delays or not begins:
+			return [(midnight, midnight + timedelta(days=1), self.config.check_interval * 60)]
+		margin = self.config.upload_window_margin * 60
+		low, high = quantile(delays, 0.1), quantile(delays, 0.9)
+		return [(midnight + timedelta(seconds=begin + low - margin), midnight + timedelta(seconds=begin + high + margin),
+			self.config.poll_min_interval * 60) for begin in sorted(begins)]
+
+	def satisfied(self, course: Course, day: datetime, videos: list[dict]) -> bool:
+		'''Whether all the videos expected on the day of `day` are listed already.'''
+		expected = course.course_table.get(day.weekday() + 1, 0)
+		midnight = day.replace(hour=0, minute=0, second=0, microsecond=0)
+		start, end = midnight.timestamp(), (midnight + timedelta(days=1)).timestamp()
+		listed = sum(1 for v in videos if v["course_begin_time"] and start <= v["course_begin_time"] < end)
+		return expected > 0 and listed >= expected
+
+	def next_window(self, course_name: str, course: Course, now: datetime) -> tuple[datetime, datetime, float] | None:
+		'''The window `now` is in, or the next one within a week.
+
+		Windows can end up to two days after their class, so those of the two days before are included.'''
+		videos = self.history.videos(course_name)
+		windows = []
+		for offset in range(-2, 8):
+			day = now + timedelta(days=offset)
+			if self.satisfied(course, day, videos):
+				continue
+			windows += [window for window in self.windows(course, day, videos) if window[1] > now]
+		return min(windows, default=None)
+
+	def plan(self, course_name: str, course: Course, now: datetime, found: bool) -> datetime:
+		'''Pick the time of the next check of a course, after a check at `now` that found new videos or not.'''
+		min_interval = self.config.poll_min_interval * 60
+		window = self.next_window(course_name, course, now)
+		if window and window[0] <= now:
+			self.interval[course_name] = min_interval
+			return now + timedelta(seconds=window[2])
+		interval = min_interval if found else min(self.interval.get(course_name, min_interval) * 2, self.config.poll_max_interval * 60)
+		self.interval[course_name] = interval
+		next_check = now + timedelta(seconds=interval)
+		if window:
+			next_check = min(next_check, window[0])
+		return next_check
+
+	def due(self, now: datetime) -> dict[str, Course]:
+		'''The courses to check now. Courses not planned yet are due right away.'''
+		return {name: course for name, course in self.courses().items() if self.next_check.get(name, now) <= now}
+
+	def update(self, checked: dict[str, Course], found: set[str], now: datetime):
+		'''Plan the next check of the courses that were just checked.'''
+		for name, course in checked.items():
+			self.next_check[name] = self.plan(name, course, now, name in found)
+
+	def sleep_time(self, now: datetime) -> float:
+		'''Seconds until the next course is due.'''
+		courses = self.courses()
+		if not courses:
+			return self.config.check_interval * 60
+		next_check = min(self.next_check.get(name, now) for name in courses)
+		return max((next_check - now).total_seconds(), 0)
@@ -1,14 +1,28 @@
 #!/usr/bin/env python3
 import tempfile
 import uuid
-import shutil
 import sys
 import re
 import argparse
 import subprocess
 import logging
+import time
+from datetime import datetime
 from pathlib import Path
-from config import Config
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING
+from download_store import DownloadStore
+from download_tuning import DownloadTuner, BandwidthSchedule, is_throttle, host_of
+from aria2_rpc import Aria2Error
+from fsutil import staging_path, place
+from metrics import metrics
+from transcribe_worker import transcribe_with_worker, worker_socket_path, WorkerError, init_pool_worker, pool_transcribe
+from transcript_cache import TranscriptCache, hash_file
+from transcript_index import TranscriptIndex
+from subtitle import Cue, read_srt, write_srt, shift_cues, iter_cues, format_timestamp
+import log
+if TYPE_CHECKING:
+	from config import Config	# only passed in by callers that loaded it, a merge of local files doesn't need pydantic
 
 CLI_description='Process and merge videos with optional transcription and readable subtitles.'
 aria2c_args = ["-x", "16", "-s", "16", "-j", "16", "-k", "1M"]	# default aria2c arguments, can be overridden in the config file
@@ -17,6 +31,21 @@ whisper_args = [
 	'--language', 'Chinese',
 	"--vad_filter", "True",
 	]	# default whisper-ctranslate2 arguments, can be overridden in the config file
+download_service = None	# a running Aria2Service to download through, instead of a new aria2c per batch
+download_tuner = None	# DownloadTuner picking the connections per download for each host, if any
+bandwidth_schedule = None	# BandwidthSchedule of the download speed limit, if any
+transcribe_worker_socket = None	# Unix socket of a running transcription worker to send jobs to, if any
+transcript_cache = None	# TranscriptCache of clip transcripts, if any
+transcript_index = None	# TranscriptIndex the final transcripts are added to, if any
+whisper_sample_rate = 16000
+shard_count = 1	# number of shards the audio of a clip is split into for parallel transcription
+shard_workers = 4	# number of shards transcribed at the same time
+whisper_pool = None	# (settings, ProcessPoolExecutor) of faster-whisper processes transcribing shards, see `shard_pool`
+min_shard_duration = 300	# in seconds, shorter audio is not split any further
+silence_noise = "-35dB"	# audio below this level counts as silence
+min_silence_duration = 60.0	# in seconds, shorter silences are not skipped or trimmed
+freeze_check = False	# only count silences as dead air while the video is frozen too
+dead_air_padding = 1.0	# in seconds, kept on both sides of a skipped or trimmed span
 
 def run_command(command):
 	# print('Running command: ' + " ".join(command))
@@ -30,115 +59,588 @@ def run_command(command):
 		# sys.exit(1)
 		raise e
 
-sjtu_header = 'referer: https://courses.sjtu.edu.cn/'
+sjtu_referer = 'https://courses.sjtu.edu.cn/'
+sjtu_header = f'referer: {sjtu_referer}'
 
-def download_video(links, file_names, output_dir, tmp_path):
+def downloaded_size(output_dir, file_names) -> int:
+	files = [Path(output_dir) / file_name for file_name in file_names]
+	return sum(file.stat().st_size for file in files if file.exists())
+
+def download_video(links, file_names, output_dir, tmp_path, tag=None):
 	if not links: return
 	logging.info(f"Downloading {len(links)} videos...")
-	# write links and arguments to aria2c input file
-	aria2c_input = tmp_path / 'aria2c_input.txt'
-	with aria2c_input.open('w') as f:
-		for link, file_name in zip(links, file_names):
-			f.write(f'{link}\n out={file_name}\n header={sjtu_header}\n')
-	# download videos using aria2c
-	run_command(['aria2c', '-i', str(aria2c_input), '-d', str(output_dir), *aria2c_args])
-	print()	# print a newline to console because aria2c doesn't print a newline after it's done
-	aria2c_input.unlink()
-
-def merge_video(files, output_file, tmp_path):
+	options = [download_tuner.options(link) if download_tuner else {} for link in links]
+	resumed = [downloaded_size(output_dir, [file_name]) for file_name in file_names]	# partials left by an earlier run are not downloaded again
+	start = time.perf_counter()
+	try:
+		with metrics.span("download", clips=len(links)):
+			if download_service:
+				download_service.download(links, file_names, output_dir, [sjtu_header], tag=tag, options=options)
+			else:
+				# write links and arguments to aria2c input file
+				aria2c_input = tmp_path / 'aria2c_input.txt'
+				with aria2c_input.open('w') as f:
+					for link, file_name, link_options in zip(links, file_names, options):
+						f.write(f'{link}\n out={file_name}\n header={sjtu_header}\n')
+						f.writelines(f' {k}={v}\n' for k, v in link_options.items())
+				# the limit of the schedule at launch, for this aria2c only
+				limit = [f'--max-overall-download-limit={bandwidth_schedule.limit(datetime.now())}'] if bandwidth_schedule else []
+				# download videos using aria2c
+				# continue partial downloads left by an interrupted run, instead of renaming the new file
+				run_command(['aria2c', '-i', str(aria2c_input), '-d', str(output_dir), '--continue=true', '--auto-file-renaming=false', *aria2c_args, *limit])
+				print()	# print a newline to console because aria2c doesn't print a newline after it's done
+				aria2c_input.unlink()
+	except (subprocess.CalledProcessError, Aria2Error) as e:
+		code, message = (e.returncode, "") if isinstance(e, subprocess.CalledProcessError) else (e.code, str(e))
+		if is_throttle(code, message):
+			metrics.count("retries", stage="download_throttled")
+			if download_tuner:
+				for link in {host_of(link): link for link in links}.values():	# one per host
+					download_tuner.throttled(link)
+		raise
+	elapsed = time.perf_counter() - start
+	sizes = [downloaded_size(output_dir, [file_name]) - before for file_name, before in zip(file_names, resumed)]
+	metrics.count("downloaded_bytes", sum(sizes))
+	if download_tuner:
+		# the clips of a batch download at the same time, so the throughput of a host is the sum over its clips
+		hosts = {}
+		for link, link_options, size in zip(links, options, sizes):
+			host = hosts.setdefault(host_of(link), [link, link_options["split"], 0])
+			host[2] += size
+		for link, connections, size in hosts.values():
+			download_tuner.observe(link, connections, size, elapsed)
+
+def subtitle_args(subtitle) -> list[str]:
+	'''ffmpeg arguments that add `subtitle` as a mov_text track to the output, after the first input.'''
+	if not subtitle:
+		return []
+	return ['-i', str(subtitle), '-map', '0', '-map', '1', '-c:s', 'mov_text']
+
+def merge_video(files, output_file, tmp_path, audio_only=False, subtitle=None):
 	# write file names to ffmpeg input file
 	ffmpeg_input = tmp_path / 'ffmpeg_input.txt'
 	with ffmpeg_input.open('w') as f:
 		for file in files:
 			f.write(f'file {file}\n')
-	# merge videos using ffmpeg
-	run_command(['ffmpeg', '-f', 'concat', '-safe', '0', '-i', str(ffmpeg_input), '-c', 'copy', str(output_file), '-loglevel', 'error', '-hide_banner'])
+	# merge videos using ffmpeg, dropping the video stream for audio-only outputs, and adding the subtitles in the same pass
+	# faststart moves the index to the front, so that playback over the network starts right away
+	with metrics.span("merge", clips=len(files)):
+		run_command(['ffmpeg', '-f', 'concat', '-safe', '0', '-i', str(ffmpeg_input), *subtitle_args(subtitle), *(['-vn'] if audio_only else []),
+				  '-c', 'copy', *(['-c:s', 'mov_text'] if subtitle else []), '-movflags', '+faststart', '-y', str(output_file), '-loglevel', 'error', '-hide_banner'])
+	ffmpeg_input.unlink()
+
+def stream_merge_video(inputs, output_file, tmp_path, audio_only=False):
+	'''Merge remote (and local) clips in one ffmpeg process that reads the URLs directly, so no clip is written to disk.'''
+	ffmpeg_input = tmp_path / 'ffmpeg_input.txt'
+	with ffmpeg_input.open('w') as f:
+		f.write('ffconcat version 1.0\n')
+		for input_file in inputs:
+			if input_file.startswith("http"):
+				f.write(f"file '{input_file}'\noption referer {sjtu_referer}\n")
+			else:
+				f.write(f"file '{Path(input_file).expanduser().absolute()}'\n")
+	with metrics.span("stream_merge", clips=len(inputs)):
+		run_command(['ffmpeg', '-f', 'concat', '-safe', '0', '-protocol_whitelist', 'file,http,https,tcp,tls,crypto',
+				  '-i', str(ffmpeg_input), *(['-vn'] if audio_only else []), '-c', 'copy', '-movflags', '+faststart', '-y', str(output_file), '-loglevel', 'error', '-hide_banner'])
+	if any(i.startswith("http") for i in inputs):
+		metrics.count("streamed_bytes", output_file.stat().st_size)	# about the size of the remote clips
 	ffmpeg_input.unlink()
 
 def make_subtitle_readable(input_file, output_file):
 	'''Format the srt file to be more readable'''
 	# example output : "[00:00:38,000 --> 00:00:50,000] 你好，我是一个测试。"
-	pattern = re.compile(r'\d+\n(\d{2}:\d{2}:\d{2},\d{3} --> \d{2}:\d{2}:\d{2},\d{3})\n(.+?)\n\n', re.DOTALL)
 	with open(input_file, 'r', encoding='utf-8') as infile, open(output_file, 'w', encoding='utf-8') as outfile:
-		content = infile.read()  # Read the entire content of the file
-		matches = pattern.finditer(content)  # Find all matches according to the pattern
-		for match in matches:
-			time_range, subtitle_text = match.groups()
-			formatted_line = f"[{time_range}] {subtitle_text}\n"
-			outfile.write(formatted_line)
-
-def transcribe_video(input_file : Path, output_file, tmp_path : Path, initial_prompt="数学分析，极限，证明，闭集，开集。", readable_subtitle_path=""):
+		for cue in iter_cues(infile):	# one cue at a time, the file is never read whole
+			outfile.write(f"[{format_timestamp(cue.start)} --> {format_timestamp(cue.end)}] {cue.text}\n")
+
+def index_transcript(transcript : Path, index_as=None):
+	'''Add the transcript to the search index, as the lecture `index_as` (course name, date, output file).'''
+	if transcript_index is None or index_as is None:
+		return
+	with open(transcript, 'r', encoding='utf-8') as f:
+		transcript_index.add(*index_as, iter_cues(f))
+
+def run_whisper(input_files : list[Path], tmp_path : Path, initial_prompt="") -> list[Path]:
+	'''Transcribe each file into `tmp_path/<stem>.srt`, through the transcription worker if one is configured, otherwise
+	with a single whisper-ctranslate2 process for all of them, so that the model is loaded once.'''
+	if transcribe_worker_socket:
+		try:
+			transcripts = []
+			for input_file in input_files:
+				with metrics.span("whisper", runner="worker"):
+					transcripts.append(transcribe_with_worker(transcribe_worker_socket, input_file, tmp_path, initial_prompt, whisper_args))
+			return transcripts
+		except (OSError, WorkerError) as e:
+			logging.warning(f"Transcription worker failed ({e}), falling back to whisper-ctranslate2.")
+			metrics.count("retries", stage="transcribe_worker")
 	# example command: whisper-ctranslate2 --model large-v3 -f vtt --language Chinese --initial_prompt "数学分析，极限，证明，闭集，开集。" --vad_filter True -o tmp_path MA-3-1-1.mp4
-	run_command(['whisper-ctranslate2', *whisper_args,
-			  '-f', 'srt',
-			  '--initial_prompt', initial_prompt,
-			  '-o', str(tmp_path),
-			  str(input_file)])
-	# merge the transcribed file with the video
-	transcript = tmp_path / f"{input_file.stem}.srt"
-	run_command(['ffmpeg', '-i', str(input_file), '-i', str(transcript), '-c', 'copy', '-c:s', 'mov_text', str(output_file), '-loglevel', 'error', '-hide_banner'])
+	with metrics.span("whisper", runner="whisper-ctranslate2", files=len(input_files)):
+		run_command(['whisper-ctranslate2', *whisper_args,
+				  '-f', 'srt',
+				  '--initial_prompt', initial_prompt,
+				  '-o', str(tmp_path),
+				  *map(str, input_files)])
+	return [tmp_path / f"{input_file.stem}.srt" for input_file in input_files]
+
+def probe_duration(file : Path) -> float:
+	'''Duration of a media file in seconds.'''
+	result = subprocess.run(['ffprobe', '-v', 'error', '-show_entries', 'format=duration', '-of', 'csv=p=0', str(file)],
+						 check=True, capture_output=True, text=True)
+	return float(result.stdout.strip())
+
+def extract_audio(input_file : Path, output_file : Path):
+	'''Extract the audio as 16 kHz mono PCM, the format whisper works on, so that the transcriber doesn't decode video frames.'''
+	with metrics.span("extract_audio"):
+		run_command(['ffmpeg', '-i', str(input_file), '-vn', '-ac', '1', '-ar', str(whisper_sample_rate), '-c:a', 'pcm_s16le',
+				  '-y', str(output_file), '-loglevel', 'error', '-hide_banner'])
+
+silence_pattern = re.compile(r'silence_(start|end): (-?[\d.]+)')
+
+def detect_silences(file : Path, noise="-35dB", min_duration=0.5) -> list[tuple[float, float]]:
+	'''Find the silent spans of a media file with ffmpeg's silencedetect, as (start, end) in seconds.'''
+	command = ['ffmpeg', '-i', str(file), '-af', f'silencedetect=noise={noise}:d={min_duration}', '-vn', '-f', 'null', '-', '-hide_banner']
+	logging.debug('Running command: ' + " ".join(command))
+	result = subprocess.run(command, check=True, capture_output=True, text=True)
+	silences = []
+	start = None
+	for kind, seconds in silence_pattern.findall(result.stderr):
+		if kind == "start":
+			start = max(float(seconds), 0.0)
+		elif start is not None:
+			silences.append((start, float(seconds)))
+			start = None
+	if start is not None:	# silent until the end
+		silences.append((start, probe_duration(file)))
+	return silences
+
+freeze_pattern = re.compile(r'freeze_(start|end): (-?[\d.]+)')
+
+def detect_freezes(file : Path, min_duration=2.0) -> list[tuple[float, float]]:
+	'''Find the spans where the video doesn't change with ffmpeg's freezedetect, as (start, end) in seconds.'''
+	command = ['ffmpeg', '-i', str(file), '-vf', f'freezedetect=d={min_duration}', '-an', '-f', 'null', '-', '-hide_banner']
+	logging.debug('Running command: ' + " ".join(command))
+	result = subprocess.run(command, check=True, capture_output=True, text=True)
+	freezes = []
+	start = None
+	for kind, seconds in freeze_pattern.findall(result.stderr):
+		if kind == "start":
+			start = max(float(seconds), 0.0)
+		elif start is not None:
+			freezes.append((start, float(seconds)))
+			start = None
+	if start is not None:	# frozen until the end
+		freezes.append((start, probe_duration(file)))
+	return freezes
+
+def has_video(file : Path) -> bool:
+	result = subprocess.run(['ffprobe', '-v', 'error', '-select_streams', 'v', '-show_entries', 'stream=index', '-of', 'csv=p=0', str(file)],
+						 check=True, capture_output=True, text=True)
+	return bool(result.stdout.strip())
+
+def dead_spans(file : Path, video_file : Path =None) -> list[tuple[float, float]]:
+	'''Long silences in `file` (breaks, and the recording before and after class), less some padding.
+
+	With `freeze_check`, only the parts where the video of `video_file` (by default `file`) is frozen too.'''
+	with metrics.span("silencedetect"):
+		spans = detect_silences(file, silence_noise, min_silence_duration)
+	video_file = video_file or file
+	if freeze_check and spans and has_video(video_file):
+		with metrics.span("freezedetect"):
+			freezes = detect_freezes(video_file, min_silence_duration)
+		spans = [(max(s1, s2), min(e1, e2)) for s1, e1 in spans for s2, e2 in freezes if min(e1, e2) - max(s1, s2) >= min_silence_duration]
+	return [(start + dead_air_padding, end - dead_air_padding) for start, end in spans if end - start > 2 * dead_air_padding]
+
+def live_segments(duration : float, dead : list[tuple[float, float]]) -> list[tuple[float, float]]:
+	'''The parts of [0, duration] outside of the dead spans.'''
+	segments = []
+	start = 0.0
+	for dead_start, dead_end in sorted(dead):
+		if dead_start - start > 0.5:
+			segments.append((start, dead_start))
+		start = max(start, dead_end)
+	if duration - start > 0.5:
+		segments.append((start, duration))
+	return segments
+
+def remap_cues(cues : list[Cue], segments : list[tuple[float, float]]):
+	'''Move the cues onto the timeline of a file trimmed down to `segments`. Cues in the removed parts are dropped.'''
+	offsets = []	# (start, end, time removed before the segment)
+	removed = 0.0
+	previous_end = 0.0
+	for start, end in segments:
+		removed += start - previous_end
+		offsets.append((start, end, removed))
+		previous_end = end
+	for cue in cues:
+		for start, end, offset in offsets:
+			if cue.start < end and cue.end > start:
+				yield Cue(max(cue.start, start) - offset, min(cue.end, end) - offset, cue.text)
+				break
+
+def dead_air_segments(input_file : Path) -> list[tuple[float, float]]:
+	'''The segments of `input_file` to keep when trimming its dead air.'''
+	duration = probe_duration(input_file)
+	segments = live_segments(duration, dead_spans(input_file)) or [(0.0, duration)]
+	if len(segments) > 1 or segments[0] != (0.0, duration):
+		logging.info(f"Trimming {duration - sum(end - start for start, end in segments):.0f}s of dead air from {input_file.name}.")
+	return segments
+
+def trim_video(input_file : Path, output_file : Path, tmp_path : Path, segments : list[tuple[float, float]], subtitle=None):
+	'''Write the `segments` of `input_file` to `output_file`, adding the subtitles (already remapped) in the same pass.
+
+	The segments are stream-copied, so the cuts snap to the keyframes of the video.'''
+	ffmpeg_input = tmp_path / f'trim_{input_file.stem}.txt'
+	with ffmpeg_input.open('w') as f:
+		f.write('ffconcat version 1.0\n')
+		for start, end in segments:
+			f.write(f"file '{Path(input_file).absolute()}'\ninpoint {start:.3f}\noutpoint {end:.3f}\n")
+	with metrics.span("trim", segments=len(segments)):
+		run_command(['ffmpeg', '-f', 'concat', '-safe', '0', '-i', str(ffmpeg_input), *subtitle_args(subtitle), '-c', 'copy',
+				  *(['-c:s', 'mov_text'] if subtitle else []), '-movflags', '+faststart', '-y', str(output_file), '-loglevel', 'error', '-hide_banner'])
+	ffmpeg_input.unlink()
+
+def trim_dead_air(input_file : Path, output_file : Path, tmp_path : Path) -> list[tuple[float, float]]:
+	'''Write `input_file` without its dead air to `output_file`, and return the segments that are kept.'''
+	segments = dead_air_segments(input_file)
+	trim_video(input_file, output_file, tmp_path, segments)
+	input_file.unlink()
+	return segments
+
+def shard_boundaries(duration : float, silences : list[tuple[float, float]], count : int) -> list[float]:
+	'''Pick `count - 1` cut points, each in the middle of the silence closest to an equal split. Return the shard starts and the end.'''
+	middles = [(start + end) / 2 for start, end in silences]
+	cuts = [0.0]
+	for i in range(1, count):
+		target = duration * i / count
+		candidates = [m for m in middles if m > cuts[-1]]
+		cut = min(candidates, key=lambda m: abs(m - target), default=target)
+		if abs(cut - target) > duration / count / 2:
+			cut = target	# no silence nearby, cut mid-speech rather than making the shards uneven
+		if cut > cuts[-1]:
+			cuts.append(cut)
+	return cuts + [duration]
+
+def split_audio(audio : Path, tmp_path : Path, skip=()) -> list[tuple[float, Path]]:
+	'''Cut the audio into the parts to transcribe, leaving out the spans in `skip`. Return the start and file of each part.
+
+	Long audio is split at silences into shards that are transcribed in parallel.'''
+	duration = probe_duration(audio)
+	segments = live_segments(duration, skip)
+	# shards sent to the transcription worker would only queue up there
+	count = 1 if transcribe_worker_socket else min(shard_count, int(duration // min_shard_duration))
+	if count > 1:
+		silences = detect_silences(audio)
+		shards = []
+		for start, end in segments:
+			inner = [(s - start, e - start) for s, e in silences if start <= s and e <= end]
+			boundaries = shard_boundaries(end - start, inner, max(1, round(count * (end - start) / duration)))
+			shards.extend((start + a, start + b) for a, b in zip(boundaries, boundaries[1:]))
+		segments = shards
+	if segments == [(0.0, duration)]:
+		return [(0.0, audio)]
+	logging.info(f"Transcribing {audio.name} in {len(segments)} parts...")
+	parts = []
+	for i, (start, end) in enumerate(segments):
+		part = tmp_path / f"{audio.stem}_shard{i}.wav"
+		run_command(['ffmpeg', '-i', str(audio), '-ss', str(start), '-to', str(end), '-c', 'copy', '-y', str(part),
+				  '-loglevel', 'error', '-hide_banner'])
+		parts.append((start, part))
+	return parts
+
+def shard_pool():
+	'''The pool of `shard_workers` faster-whisper processes that transcribe shards, started on first use. Each process loads
+	the model once, and keeps it until `release_shard_pool`. None if faster-whisper is not installed.'''
+	global whisper_pool
+	settings = (tuple(whisper_args), shard_workers)
+	if whisper_pool is not None and whisper_pool[0] == settings:
+		return whisper_pool[1]
+	release_shard_pool()
+	import importlib.util
+	if importlib.util.find_spec("faster_whisper") is None:
+		return None
+	import multiprocessing
+	from concurrent.futures import ProcessPoolExecutor
+	# spawned, as forking a process with running threads is unsafe
+	pool = ProcessPoolExecutor(shard_workers, mp_context=multiprocessing.get_context("spawn"),
+		initializer=init_pool_worker, initargs=(whisper_args,))
+	whisper_pool = (settings, pool)
+	return pool
+
+def release_shard_pool():
+	'''Stop the shard pool, freeing the models it holds.'''
+	global whisper_pool
+	if whisper_pool is not None:
+		whisper_pool[1].shutdown(wait=False, cancel_futures=True)
+		whisper_pool = None
+
+def transcribe_files(files : list[Path], tmp_path : Path, initial_prompt="") -> list[list[Cue]]:
+	'''Transcribe the files in one whisper-ctranslate2 process (or the transcription worker), or with sharding, in the
+	processes of the shard pool, falling back to up to `shard_workers` whisper-ctranslate2 processes without it.'''
+	if not files:
+		return []
+	parallel = shard_count > 1 and len(files) > 1 and not transcribe_worker_socket
+	pool = shard_pool() if parallel else None
+	if pool is not None:
+		from concurrent.futures.process import BrokenProcessPool
+		try:
+			with metrics.span("whisper", runner="pool", files=len(files)):
+				futures = [pool.submit(pool_transcribe, str(file), str(tmp_path), initial_prompt) for file in files]
+				transcripts = dict(zip(files, (Path(future.result()) for future in futures)))
+		except BrokenProcessPool:
+			release_shard_pool()	# a process died, e.g. out of memory, start over next time
+			raise
+		return [read_transcript(transcripts[file]) for file in files]
+	workers = min(shard_workers, len(files)) if parallel else 1
+	batches = [files[i::workers] for i in range(workers)]
+	with ThreadPoolExecutor(workers, thread_name_prefix="whisper") as pool:
+		transcripts = dict(zip([f for batch in batches for f in batch],
+			[t for result in pool.map(lambda batch: run_whisper(batch, tmp_path, initial_prompt), batches) for t in result]))
+	return [read_transcript(transcripts[file]) for file in files]
+
+def read_transcript(transcript : Path) -> list[Cue]:
+	cues = read_srt(transcript)
+	transcript.unlink()
+	return cues
+
+def transcribe_clips(clips : list[Path], transcript : Path, tmp_path : Path, initial_prompt="", skip_silence=False):
+	'''Write the subtitles of the concatenation of the clips to `transcript`, with the timestamps of each clip shifted by
+	the durations of those before it.
+
+	Cached transcripts are reused, and the other clips are transcribed together, so that the model is loaded once per
+	batch instead of once per clip. With `skip_silence`, the dead air of the clips is not transcribed.'''
+	transcripts = {}	# clip index : cues, relative to the start of the clip
+	keys = {}
+	for i, clip in enumerate(clips):
+		if transcript_cache:
+			keys[i] = transcript_cache.key(hash_file(clip), whisper_args, initial_prompt, skip_silence)
+			cues = transcript_cache.get(keys[i])
+			metrics.count("transcript_cache", result="miss" if cues is None else "hit")
+			if cues is not None:
+				logging.info(f"Using the cached transcript of {clip.name}.")
+				transcripts[i] = cues
+	pending = [i for i in range(len(clips)) if i not in transcripts]
+	parts = []	# (clip index, start in the clip, audio file)
+	try:
+		with metrics.span("transcribe_clips", clips=len(pending)):
+			for i in pending:
+				audio = tmp_path / f"{clips[i].stem}.wav"
+				extract_audio(clips[i], audio)
+				parts.append((i, 0.0, audio))	# so that it is deleted on failure, replaced below if it is cut
+				skip = dead_spans(audio, clips[i]) if skip_silence else ()
+				split = split_audio(audio, tmp_path, skip)
+				if split != [(0.0, audio)]:
+					audio.unlink()
+					parts[-1:] = [(i, start, part) for start, part in split]
+			results = transcribe_files([part for _, _, part in parts], tmp_path, initial_prompt)
+	finally:
+		for _, _, part in parts:
+			part.unlink(missing_ok=True)
+	for (i, start, _), cues in zip(parts, results):
+		transcripts.setdefault(i, []).extend(shift_cues(cues, start))
+	for i in pending:
+		transcripts.setdefault(i, [])	# nothing but dead air
+		if transcript_cache:
+			transcript_cache.put(keys[i], transcripts[i])
+	cues = []
+	offset = 0.0
+	for i, clip in enumerate(clips):
+		cues.extend(shift_cues(transcripts[i], offset))
+		if len(clips) > 1:
+			offset += probe_duration(clip)
+	write_srt(cues, transcript)
+
+def transcribe_video(input_file : Path, output_file, tmp_path : Path, initial_prompt="数学分析，极限，证明，闭集，开集。", readable_subtitle_path="", subtitle_path="", skip_silence=False, trim_silence=False, index_as=None):
+	'''Transcribe `input_file` and mux the subtitles into `output_file`.
+
+	With `subtitle_path`, the subtitles are written there instead, and `input_file` is moved to `output_file` as is.
+	With `trim_silence`, the dead air is cut out of the output, and the subtitles are moved to match.
+	With `index_as`, the subtitles are added to the search index (see `index_transcript`).'''
+	transcript = tmp_path / f"subtitles_{input_file.stem}.srt"
+	transcribe_clips([input_file], transcript, tmp_path, initial_prompt, skip_silence)
+	segments = None
+	if trim_silence:
+		segments = dead_air_segments(input_file)
+		write_srt(list(remap_cues(read_srt(transcript), segments)), transcript)
+	index_transcript(transcript, index_as)
 	if readable_subtitle_path:
 		make_subtitle_readable(transcript, readable_subtitle_path)
+	if subtitle_path:
+		place(transcript, subtitle_path)
+		if segments:
+			trim_video(input_file, output_file, tmp_path, segments)
+			input_file.unlink()
+		else:
+			place(input_file, output_file)
+		return
+	# merge the transcribed file with the video, trimming it in the same pass
+	if segments:
+		trim_video(input_file, output_file, tmp_path, segments, transcript)
+	else:
+		run_command(['ffmpeg', '-i', str(input_file), *subtitle_args(transcript), '-c', 'copy', '-c:s', 'mov_text', '-movflags', '+faststart',
+				  '-y', str(output_file), '-loglevel', 'error', '-hide_banner'])
 	transcript.unlink()
 
-def process_video(input_files, output_file : Path, tmp_path : Path =None, transcribe=False, readable_subtitle=False, config : Config =None, whisper_initial_prompt = "数学分析，极限，证明，闭集，开集。"):
-	if config:
-		global aria2c_args, whisper_args
-		aria2c_args = config.aria2c_args
-		whisper_args = config.whisper_args
-		tmp_path = config.tmp_dir
-	# Temporary storage for downloaded files
-	tmp_path = tmp_path or Path(tempfile.mkdtemp())
+def configure(config : 'Config'):
+	'''Use the aria2c and whisper arguments from the config file.'''
+	global aria2c_args, whisper_args, transcribe_worker_socket, transcript_cache, shard_count, shard_workers
+	global silence_noise, min_silence_duration, freeze_check, transcript_index, download_tuner, bandwidth_schedule
+	aria2c_args = config.aria2c_args
+	whisper_args = config.whisper_args
+	shard_count = config.shard_count
+	shard_workers = config.shard_workers
+	silence_noise = config.silence_noise
+	min_silence_duration = config.min_silence_duration
+	freeze_check = config.freeze_check
+	transcribe_worker_socket = worker_socket_path(config) if config.transcribe_worker else None
+	transcript_cache = TranscriptCache(config.data_dir) if config.transcript_cache else None
+	if not config.transcript_index:
+		transcript_index = None
+	elif transcript_index is None or transcript_index.db_file != TranscriptIndex.path(config.data_dir):
+		transcript_index = TranscriptIndex(config.data_dir)
+	if not config.adaptive_connections:
+		download_tuner = None
+	elif download_tuner is None or download_tuner.path != Path(config.data_dir) / "download_tuning.json":
+		download_tuner = DownloadTuner(config.data_dir, config.min_connections, config.max_connections)
+	bandwidth_schedule = BandwidthSchedule(config.bandwidth_schedule, config.max_download_limit) if config.bandwidth_schedule else None
+
+def prepare_inputs(input_files, tmp_path : Path, video_ids=None):
+	'''Split the inputs into URLs to download and local files. Return the list of files to merge, the links and their temporary file names.
+
+	With `video_ids`, the downloads are named after the videoId of each input, so that they can be resumed.'''
 	downloaded_files = []
 	download_links = []
 	temp_file_names = []
-
-	if output_file.exists():
-		logging.warning(f"Output file {output_file} already exists. Will overwrite it.")
-
 	# Determine whether each input is a URL or a local file
-	for input_file in input_files:
+	for i, input_file in enumerate(input_files):
 		if input_file.startswith("http") or input_file.startswith("https"):
 			# It's a URL, download the video
 			# Generate a temporary file name
-			temp_file_name = f"{uuid.uuid4()}.mp4"
+			temp_file_name = f"{video_ids[i]}.mp4" if video_ids else f"{uuid.uuid4()}.mp4"
 			download_links.append(input_file)
 			temp_file_names.append(temp_file_name)
 			downloaded_files.append(tmp_path / temp_file_name)
 		else:
 			# It's a local file, just add it to the list
 			downloaded_files.append(Path(input_file).expanduser().absolute())
+	return downloaded_files, download_links, temp_file_names
 
-	# Download the videos
-	download_video(download_links, temp_file_names, tmp_path, tmp_path)
+def merge_and_mux(clips : list[Path], output_file : Path, tmp_path : Path, transcript : Path =None, readable_subtitle_path="", audio_only=False, trim_silence=False, lecture=None):
+	'''Merge the clips into `output_file` and mux the subtitles of `transcript` (on the merged timeline) in the same ffmpeg pass.
 
-	# Merge the videos
-	out_file = tmp_path / f"merged_{uuid.uuid4()}.mp4"
-	merge_video(downloaded_files, out_file, tmp_path)
-	downloaded_files.append(out_file)
+	The output is written to a staging file next to `output_file` and renamed into place, so it is never copied
+	across file systems. Audio-only outputs get the subtitles in a srt file next to them instead. The subtitles are
+	added to the search index under `lecture` (course name and date), or the name of the output file.'''
+	staged_file = staging_path(output_file)
+	merged_file = tmp_path / f"merged_{uuid.uuid4()}{output_file.suffix}"
+	try:
+		segments = None
+		if trim_silence:
+			# dead air is found on the merged file, so trimming takes a second pass
+			merge_video(clips, merged_file, tmp_path, audio_only)
+			segments = dead_air_segments(merged_file)
+			if transcript:
+				write_srt(list(remap_cues(read_srt(transcript), segments)), transcript)
+		if transcript:
+			index_transcript(transcript, (*(lecture or (output_file.stem, "")), output_file))
+		if transcript and readable_subtitle_path:
+			make_subtitle_readable(transcript, readable_subtitle_path)
+		subtitle = transcript if not audio_only else None
+		if segments:
+			trim_video(merged_file, staged_file, tmp_path, segments, subtitle)
+		else:
+			merge_video(clips, staged_file, tmp_path, audio_only, subtitle)
+		if transcript and audio_only:
+			place(transcript, output_file.with_suffix('.srt'))
+		logging.info(f"Moving the final file to {output_file}")
+		staged_file.replace(output_file)
+	finally:
+		staged_file.unlink(missing_ok=True)
+		merged_file.unlink(missing_ok=True)
+
+def process_video(input_files, output_file : Path, tmp_path : Path =None, transcribe=False, readable_subtitle=False, config : 'Config' =None, whisper_initial_prompt = "数学分析，极限，证明，闭集，开集。", stream=False, download_store : DownloadStore =None, video_ids=None, audio_only=False, skip_silence=False, trim_silence=False, lecture=None):
+	'''`lecture` is the course name and date the transcript is indexed under, by default the name of the output file.'''
+	if config:
+		configure(config)
+		tmp_path = config.tmp_dir
+		stream = stream or config.stream_download
+	# Temporary storage for downloaded files
+	tmp_path = tmp_path or Path(tempfile.mkdtemp())
+
+	if output_file.exists():
+		logging.warning(f"Output file {output_file} already exists. Will overwrite it.")
+
+	if stream:
+		stream_process_video(input_files, output_file, tmp_path, transcribe, readable_subtitle, whisper_initial_prompt, audio_only,
+					   skip_silence, trim_silence, lecture)
+		return
+
+	if download_store and video_ids:
+		# resumable downloads, kept until the processing succeeds
+		downloaded_files, download_links, temp_file_names = prepare_inputs(input_files, download_store.dir, video_ids)
+		download_store.start(video_ids)
+		download_dir = download_store.dir
+	else:
+		downloaded_files, download_links, temp_file_names = prepare_inputs(input_files, tmp_path)
+		download_dir = tmp_path
+
+	# Download the videos
+	download_video(download_links, temp_file_names, download_dir, tmp_path)
 
-	# Transcribe the merged video
+	# Transcribe the clips before merging them, so that merging and adding the subtitles is a single pass
+	clips = list(downloaded_files)
+	transcript = None
 	if transcribe:
 		logging.info("Transcribing the video...")
-		in_file = out_file
-		out_file = tmp_path / f"transcribed_{uuid.uuid4()}.mp4"
-		downloaded_files.append(out_file)
-		readable_subtitle_path = output_file.with_suffix('.txt') if readable_subtitle else ''
-		transcribe_video(in_file, out_file, tmp_path, readable_subtitle_path=readable_subtitle_path,
-				   initial_prompt=whisper_initial_prompt)
-
-	# Move the final file to the output directory
-	# run_command(['mv', f'"{out_file}"', f'"{output_file}"'])
-	# out_file.rename(output_file)
-	logging.info(f"Moving the final file to {output_file}")
-	shutil.move(out_file, output_file)
+		transcript = tmp_path / f"subtitles_{uuid.uuid4()}.srt"
+		transcribe_clips(clips, transcript, tmp_path, whisper_initial_prompt, skip_silence)
+	readable_subtitle_path = output_file.with_suffix('.txt') if transcribe and readable_subtitle else ''
+
+	# Merge the videos straight into the output directory
+	try:
+		merge_and_mux(clips, output_file, tmp_path, transcript, readable_subtitle_path, audio_only, trim_silence, lecture)
+	finally:
+		if transcript:
+			transcript.unlink(missing_ok=True)
 
 	# Cleanup: Remove temporary downloaded files
 	for file in downloaded_files:
 		# only remove files in the temporary directory
 		if file.parent == tmp_path and file.exists():
 			file.unlink()
+	if download_store and video_ids:
+		download_store.remove(video_ids)
 
+def stream_process_video(input_files, output_file : Path, tmp_path : Path, transcribe=False, readable_subtitle=False, whisper_initial_prompt="", audio_only=False,
+						 skip_silence=False, trim_silence=False, lecture=None):
+	'''Like `process_video`, but the clips are fed straight into ffmpeg instead of being downloaded first.'''
+	if not transcribe and not trim_silence:
+		# write the merged video next to the output, nothing goes through the temporary directory
+		staged_file = staging_path(output_file)
+		try:
+			stream_merge_video(input_files, staged_file, tmp_path, audio_only)
+			logging.info(f"Moving the final file to {output_file}")
+			staged_file.replace(output_file)
+		finally:
+			staged_file.unlink(missing_ok=True)
+		return
+	merged_file = tmp_path / f"merged_{uuid.uuid4()}{output_file.suffix}"
+	out_file = staging_path(output_file)	# the last pass writes next to the output
+	try:
+		stream_merge_video(input_files, merged_file, tmp_path, audio_only)
+		if transcribe:
+			logging.info("Transcribing the video...")
+			readable_subtitle_path = output_file.with_suffix('.txt') if readable_subtitle else ''
+			transcribe_video(merged_file, out_file, tmp_path, readable_subtitle_path=readable_subtitle_path,
+					   initial_prompt=whisper_initial_prompt, subtitle_path=output_file.with_suffix('.srt') if audio_only else '',
+					   skip_silence=skip_silence, trim_silence=trim_silence,
+					   index_as=(*(lecture or (output_file.stem, "")), output_file))
+		else:
+			trim_dead_air(merged_file, out_file, tmp_path)
+		logging.info(f"Moving the final file to {output_file}")
+		out_file.replace(output_file)
+	finally:
+		merged_file.unlink(missing_ok=True)
+		out_file.unlink(missing_ok=True)
 
 def setup_parser(parser : argparse.ArgumentParser):
 	parser.add_argument('input_files', nargs='+', help='List of input video files or URLs to process.')
@@ -146,6 +648,10 @@ def setup_parser(parser : argparse.ArgumentParser):
 	parser.add_argument('-t', '--tmp_path', default=None, help='Temporary directory for processing files. Defaults to a system temp directory.')
 	parser.add_argument('--transcribe', action='store_true', help='Enable video transcription.')
 	parser.add_argument('--readable_subtitle', action='store_true', help='Generate a readable subtitle file (requires --transcribe).')
+	parser.add_argument('--stream', action='store_true', help='Merge remote videos while downloading them, without storing the clips.')
+	parser.add_argument('--audio_only', action='store_true', help='Keep only the audio (the output should be e.g. .m4a). Subtitles are written next to it.')
+	parser.add_argument('--skip_silence', action='store_true', help='Do not transcribe long silences (requires --transcribe).')
+	parser.add_argument('--trim_silence', action='store_true', help='Cut long silences out of the output, and shift the subtitles to match.')
 
 def main(args: argparse.Namespace):
 	# Process videos
@@ -153,9 +659,13 @@ def main(args: argparse.Namespace):
 		process_video(
 			input_files=args.input_files,
 			output_file=Path(args.output_file),
-			tmp_path=Path(args.tmp_path),
+			tmp_path=Path(args.tmp_path) if args.tmp_path else None,
 			transcribe=args.transcribe,
-			readable_subtitle=args.readable_subtitle
+			readable_subtitle=args.readable_subtitle,
+			stream=args.stream,
+			audio_only=args.audio_only,
+			skip_silence=args.skip_silence,
+			trim_silence=args.trim_silence
 		)
 	except Exception as e:
 		print(f"Error processing videos: {e}")
@@ -0,0 +1,31 @@
+#!/usr/bin/env python3
+import argparse
+import time
+from config import load_config, default_config_path
+from subtitle import format_timestamp
+from transcript_index import TranscriptIndex
+
+CLI_description = '''Search the transcripts of downloaded lectures. Terms separated by spaces must all appear in a subtitle.'''
+
+def setup_parser(parser: argparse.ArgumentParser):
+	parser.add_argument("query", help="Text to search for.")
+	parser.add_argument("-c", "--config", help="Path to the configuration file.", default=default_config_path)
+	parser.add_argument("--course", default=None, help="Only search the lectures of this course (the name used for the output files).")
+	parser.add_argument("-n", "--limit", type=int, default=50, help="Maximum number of results.")
+
+def main(args: argparse.Namespace):
+	config = load_config(args.config)
+	index = TranscriptIndex(config.data_dir)
+	start = time.perf_counter()
+	matches = index.search(args.query, args.course, args.limit)
+	elapsed = (time.perf_counter() - start) * 1000
+	for match in matches:
+		print(f"{match.course} {match.date} [{format_timestamp(match.start / 1000)}] {match.text}    ({match.file})")
+	print(f"{len(matches)} results in {elapsed:.1f} ms")
+	index.close()
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description=CLI_description)
+	setup_parser(parser)
+	args = parser.parse_args()
+	main(args)
@@ -3,44 +3,98 @@ from getpass import getpass
 from config import *
 from history import History
 from sjtu_login import SJTU_Login
-from sjtu_real_canvas_video import get_real_canvas_videos
+from sjtu_real_canvas_video import get_real_canvas_videos, LTICache, RealCourse, resolve_details
+from http_client import configure_client
+from session_store import SessionStore
 from process_video import process_video
+from job_scheduler import JobScheduler, Job
+from download_store import DownloadStore
+from metrics import metrics
 from datetime import datetime
 import argparse
 import os
 
 CLI_description = '''Search and download videos from SJTU Canvas. Skip if less than `min_count` videos are uploaded.'''
 
-# def search_download(course_id, login : SJTU_Login, output_dir, date : datetime, min_count = 0, course_name = None):
-def search_download(config : Config, course : Course, login : SJTU_Login, date : datetime, min_count = 0, course_name : str = None, history : History = None):
-	course_id = course.course_id
-	output_dir = config.video_dir
-	# Login
-	cookies = login.login()
-	# Get all the videos
-	videos = get_real_canvas_videos(course_id, cookies)[0]
-	# Filter the videos
+def select_videos(videos : list[RealCourse], date : datetime, history : History = None) -> list[RealCourse]:
+	'''Pick the videos recorded on `date` that are not in the history.'''
 	videos = [i for i in videos if i.start_time.date() == date.date()]
 	if history:
 		videos = [i for i in videos if i.video_id not in history]
-	# Check if there are enough videos
-	if len(videos) < min_count:
-		# Not finding enough videos means
-		return False, len(videos)
+	return videos
+
+def output_path(config : Config, course_name : str, date : datetime, audio_only : bool = False) -> Path:
+	suffix = ".m4a" if audio_only else ".mp4"
+	return config.video_dir / f"{course_name}-{date.strftime('%m-%d')}{suffix}"
+
+def download_videos(config : Config, course : Course, videos : list[RealCourse], date : datetime, course_name : str = None, history : History = None):
+	'''Download and process the videos of one day into a single file in `config.video_dir`.'''
+	resolve_details(videos, config.detail_concurrency)
 	video_links = [i["rtmpUrlHdv"] for i in videos]
 	course_name = course_name or videos[0]["subjName"]
-	output_video = output_dir / f"{course_name}-{date.strftime('%m-%d')}.mp4"
-	logging.info(f"Found {len(videos)} videos for {course_name}({course_id}) on {date.strftime('%m-%d')}.")
+	output_video = output_path(config, course_name, date, course.audio_only)
+	logging.info(f"Found {len(videos)} videos for {course_name}({course.course_id}) on {date.strftime('%m-%d')}.")
 	# Download and process the videos
-	process_video(
+	try:
+		with metrics.span("process_batch", course=course_name):
+			process_video(
+				video_links,
+				output_video,
+				transcribe=course.transcribe,
+				readable_subtitle=course.readable_subtitles,
+				config=config,
+				whisper_initial_prompt=course.whisper_initial_prompt,
+				download_store=DownloadStore(config.data_dir, config.tmp_dir, config.partial_max_age),
+				video_ids=[i.video_id for i in videos],
+				audio_only=course.audio_only,
+				skip_silence=course.skip_silence,
+				trim_silence=course.trim_silence,
+				lecture=(course_name, date.strftime('%Y-%m-%d')))
+	except Exception as e:
+		if history:
+			with history.batch():
+				for i in videos:
+					history.update(i.video_id, "failed", error=str(e))
+		raise
+	if history:
+		with history.batch():
+			for i in videos:
+				history.add(i.video_id, "transcribed" if course.transcribe else "merged")
+
+def queue_videos(scheduler : JobScheduler, config : Config, course : Course, videos : list[RealCourse], date : datetime, course_name : str = None) -> Job:
+	'''Like `download_videos`, but hand the videos to the job scheduler instead of processing them right away.'''
+	resolve_details(videos, config.detail_concurrency)
+	video_links = [i["rtmpUrlHdv"] for i in videos]
+	course_name = course_name or videos[0]["subjName"]
+	logging.info(f"Found {len(videos)} videos for {course_name}({course.course_id}) on {date.strftime('%m-%d')}.")
+	return scheduler.submit(
+		course_name,
+		date.strftime('%Y-%m-%d'),
+		[i.video_id for i in videos],
 		video_links,
-		output_video,
+		output_path(config, course_name, date, course.audio_only),
 		transcribe=course.transcribe,
 		readable_subtitle=course.readable_subtitles,
-		config=config,
-		whisper_initial_prompt=course.whisper_initial_prompt)
-	if history:
-		[history.add(i.video_id) for i in videos]
+		whisper_initial_prompt=course.whisper_initial_prompt,
+		audio_only=course.audio_only,
+		skip_silence=course.skip_silence,
+		trim_silence=course.trim_silence,
+		course_id=course.course_id)
+
+# def search_download(course_id, login : SJTU_Login, output_dir, date : datetime, min_count = 0, course_name = None):
+def search_download(config : Config, course : Course, login : SJTU_Login, date : datetime, min_count = 0, course_name : str = None, history : History = None, lti_cache : LTICache = None, videos : list[RealCourse] = None):
+	if videos is None:
+		# Login
+		cookies = login.login()
+		# Get all the videos
+		videos = get_real_canvas_videos(course.course_id, cookies, login.client, lti_cache)[0]
+	# Filter the videos
+	videos = select_videos(videos, date, history)
+	# Check if there are enough videos
+	if not videos or len(videos) < min_count:
+		# Not finding enough videos means
+		return False, len(videos)
+	download_videos(config, course, videos, date, course_name, history)
 	return True, len(videos)
 
 def parse_date(date_str) -> datetime:
@@ -84,16 +138,22 @@ def main(args: argparse.Namespace):
 		readable_subtitles=args.readable_subtitle
 	)
 
-	login = SJTU_Login(username, password)
+	if config.metrics:
+		metrics.configure(config.data_dir, config.metrics_port)
+	login = SJTU_Login(username, password, configure_client(config),
+					   SessionStore(config.data_dir, username, config.session_max_age))
 
-	success = search_download(
-		config=config,
-		course=course,
-		login=login,
-		date=args.date,
-		min_count=args.min_count,
-		course_name=args.course_name
-	)
+	try:
+		success = search_download(
+			config=config,
+			course=course,
+			login=login,
+			date=args.date,
+			min_count=args.min_count,
+			course_name=args.course_name
+		)
+	finally:
+		metrics.export()
 	if success[0]:
 		print(f"Download and processing complete. Found {success[1]} videos.")
 	else:
@@ -0,0 +1,61 @@
+import json
+import os
+import time
+import logging
+from pathlib import Path
+from requests.cookies import RequestsCookieJar, create_cookie
+
+canvas_domain = "oc.sjtu.edu.cn"
+
+class SessionStore:
+	'''Keep the jaccount and Canvas cookies of one user in `data_dir`, so that a restarted daemon can skip the login.
+
+	The file is only readable by its owner, as the cookies are as good as the password until they expire.'''
+	def __init__(self, data_dir, username: str, max_age: int = 24):
+		self.path = Path(data_dir) / f"session_{username}.json"
+		self.max_age = max_age * 3600	# in seconds, upper bound for cookies without an explicit expiry
+
+	def load(self) -> tuple[RequestsCookieJar, float] | None:
+		'''Return the stored cookies and their expiry time, or None if there is no usable session.'''
+		try:
+			with self.path.open('r') as f:
+				data = json.load(f)
+		except FileNotFoundError:
+			return None
+		except (OSError, ValueError) as e:
+			logging.warning(f"Failed to read session file {self.path}: {e}")
+			return None
+		if data["expires_at"] <= time.time():
+			return None
+		cookies = RequestsCookieJar()
+		for c in data["cookies"]:
+			cookies.set_cookie(create_cookie(**c))
+		return cookies, data["expires_at"]
+
+	def save(self, cookies: RequestsCookieJar) -> float:
+		'''Store the cookies and return their expiry time.'''
+		now = time.time()
+		expires_at = now + self.max_age
+		for c in cookies:
+			# only the Canvas session matters, other cookies are either session cookies or irrelevant trackers
+			if c.domain.endswith(canvas_domain) and c.expires is not None and c.expires > now:
+				expires_at = min(expires_at, c.expires)
+		data = {
+			"saved_at": now,
+			"expires_at": expires_at,
+			"cookies": [
+				{"name": c.name, "value": c.value, "domain": c.domain, "path": c.path, "expires": c.expires, "secure": c.secure}
+				for c in cookies
+			],
+		}
+		self.path.parent.mkdir(parents=True, exist_ok=True)
+		tmp_path = self.path.with_suffix('.tmp')
+		fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+		with os.fdopen(fd, 'w') as f:
+			json.dump(data, f)
+		os.chmod(tmp_path, 0o600)	# in case the file already existed with a looser mode
+		os.replace(tmp_path, self.path)
+		return expires_at
+
+	def clear(self):
+		self.path.unlink(missing_ok=True)
@@ -0,0 +1,105 @@
+import hashlib
+import json
+import os
+import time
+import logging
+import threading
+from pathlib import Path
+from fsutil import link
+from transcript_cache import hash_file
+
+sidecar_suffixes = (".txt", ".srt")	# readable subtitles, and the subtitles of audio-only outputs
+
+class SharedStore:
+	'''Finished outputs shared by the users of a multi-user daemon, stored once by content hash.
+
+	Jobs write their output to `incoming/`, and `put` moves it (and its readable subtitles or srt file) to
+	`objects/<hash>`. The index in `index.json` maps the videos and processing options of a job to its objects, so that
+	a user who subscribes later gets the same output without downloading it again. Outputs are linked into the
+	`video_dir` of each user with `fsutil.link`.'''
+	def __init__(self, root):
+		self.root = Path(root)
+		self.incoming_dir = self.root / "incoming"
+		self.objects_dir = self.root / "objects"
+		self.incoming_dir.mkdir(parents=True, exist_ok=True)
+		self.objects_dir.mkdir(parents=True, exist_ok=True)
+		self.index_file = self.root / "index.json"
+		self.index = {}	# key : {"object", "sidecars": {suffix : object}, "at"}, objects relative to `root`
+		self.lock = threading.Lock()
+		if self.index_file.exists():
+			try:
+				with self.index_file.open('r') as f:
+					self.index = json.load(f)
+			except (OSError, ValueError) as e:
+				logging.warning(f"Failed to read the shared store index {self.index_file}: {e}")
+
+	@staticmethod
+	def key(video_ids: list[str], options: dict) -> str:
+		return hashlib.blake2b(json.dumps([video_ids, options], sort_keys=True).encode(), digest_size=16).hexdigest()
+
+	def incoming(self, key: str, suffix: str) -> Path:
+		'''Where the job of `key` writes its output.'''
+		return self.incoming_dir / f"{key}{suffix}"
+
+	def get(self, key: str) -> dict | None:
+		'''The objects of `key`, if they are all still in the store.'''
+		with self.lock:
+			entry = self.index.get(key)
+		if entry is None or not all((self.root / o).exists() for o in [entry["object"], *entry["sidecars"].values()]):
+			return None
+		return entry
+
+	def add(self, file: Path) -> str:
+		'''Move a file into the objects, or drop it if the same content is there already.'''
+		digest = hash_file(file)
+		obj = self.objects_dir / digest[:2] / f"{digest}{file.suffix}"
+		obj.parent.mkdir(exist_ok=True)
+		if obj.exists():
+			file.unlink()
+		else:
+			os.replace(file, obj)
+		return str(obj.relative_to(self.root))
+
+	def put(self, key: str, output_file: Path) -> dict:
+		'''Store the output of the job of `key`, with the sidecar files next to it.'''
+		sidecars = {suffix: self.add(output_file.with_suffix(suffix)) for suffix in sidecar_suffixes
+			if output_file.with_suffix(suffix).exists()}
+		entry = {"object": self.add(output_file), "sidecars": sidecars, "at": time.time()}
+		with self.lock:
+			self.index[key] = entry
+			self.save()
+		return entry
+
+	def deliver(self, entry: dict, output_file: Path):
+		'''Link the objects of `entry` to `output_file` and the sidecars next to it.'''
+		output_file.parent.mkdir(parents=True, exist_ok=True)
+		kind = link(self.root / entry["object"], output_file)
+		for suffix, obj in entry["sidecars"].items():
+			link(self.root / obj, output_file.with_suffix(suffix))
+		logging.info(f"Delivered {output_file} ({kind}).")
+
+	def gc(self, max_age: int):
+		'''Delete the objects older than `max_age` days that no `video_dir` hardlinks to, and their index entries.
+
+		Reflinked and copied outputs don't share the inode, so their objects are only kept for `max_age`.'''
+		cutoff = time.time() - max_age * 86400
+		removed = 0
+		for obj in self.objects_dir.glob("*/*"):
+			stat = obj.stat()
+			if stat.st_nlink == 1 and stat.st_mtime < cutoff:
+				obj.unlink()
+				removed += 1
+		if not removed:
+			return
+		logging.info(f"Removed {removed} outputs from the shared store.")
+		with self.lock:
+			self.index = {key: entry for key, entry in self.index.items()
+				if all((self.root / o).exists() for o in [entry["object"], *entry["sidecars"].values()])}
+			self.save()
+
+	def save(self):
+		'''Must be called with the lock held.'''
+		tmp_file = self.index_file.with_suffix('.tmp')
+		with tmp_file.open('w') as f:
+			json.dump(self.index, f)
+		tmp_file.replace(self.index_file)
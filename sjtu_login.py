@@ -1,38 +1,100 @@
-import requests
+from http_client import HTTPClient, get_client
 import re
 import io
 import urllib.parse
 import time
+import logging
+import threading
 from getpass import getpass
+from session_store import SessionStore
+from metrics import span, count
 
 oauth_urls = (
     "https://courses.sjtu.edu.cn/app/oauth/2.0/login?login_type=outer",
     "https://oc.sjtu.edu.cn/login/openid_connect"
 )
+login_hosts = ("jaccount.sjtu.edu.cn", "courses.sjtu.edu.cn", "oc.sjtu.edu.cn")
 
 class SJTU_Login:
-    def __init__(self, username, password):
+    def __init__(self, username, password, client: HTTPClient = None, store: SessionStore = None,
+                 probe_interval: float = 60):
         self.username = username
         self.password = password or getpass(prompt='Password for SJTU: ')
+        self.client = client or get_client()
+        self.store = store
+        self.probe_interval = probe_interval  # in seconds, how long a successful probe is trusted
         self.cookies = None
+        self.expires_at = 0.0
+        self.probed_at = 0.0
+        self.lock = threading.RLock()
+        self.refresh_thread = None
+        if store is not None:
+            stored = store.load()
+            if stored is not None:
+                self.cookies, self.expires_at = stored
+                logging.info(f"Loaded stored session for {username}.")
 
     def login(self):
-        if self.cookies is not None and test_login(self.cookies):
-            return self.cookies
-        params, uuid, cookies, url = get_params_uuid_cookies(oauth_urls[0])
-        img = get_captcha_img(uuid, cookies, url)
-        captcha = solve_captcha(img)
-        time.sleep(1)
-        cookies = login_jaccount(self.username, self.password, uuid, captcha, params, cookies)
-        login_Canvas(oauth_urls[1], cookies)
-        return cookies
+        with self.lock:
+            if self.cookies is not None and self.expires_at > time.time():
+                if time.time() - self.probed_at < self.probe_interval or test_login(self.cookies, self.client):
+                    self.probed_at = time.time()
+                    return self.cookies
+            return self.refresh()
+
+    def refresh(self):
+        '''Log in from scratch and store the new session.'''
+        with self.lock, span("login"):
+            clear_login_cookies(self.client)
+            params, uuid, cookies, url = get_params_uuid_cookies(oauth_urls[0], self.client)
+            with span("captcha"):
+                img = get_captcha_img(uuid, cookies, url, self.client)
+                captcha = solve_captcha(img, self.client)
+            time.sleep(1)
+            cookies = login_jaccount(self.username, self.password, uuid, captcha, params, cookies, self.client)
+            login_Canvas(oauth_urls[1], cookies, self.client)
+            self.cookies = cookies
+            self.probed_at = time.time()
+            if self.store is not None:
+                self.expires_at = self.store.save(cookies)
+            else:
+                self.expires_at = float('inf')
+            return cookies
+
+    def start_refresh(self, margin: float = 1800):
+        '''Refresh the session in a background thread `margin` seconds before it expires.'''
+        if self.refresh_thread is not None:
+            return
+        self.refresh_thread = threading.Thread(target=self._refresh_loop, args=(margin,), daemon=True)
+        self.refresh_thread.start()
+
+    def _refresh_loop(self, margin):
+        while True:
+            time.sleep(min(max(self.expires_at - margin - time.time(), 60), 3600))
+            if self.expires_at - margin > time.time():
+                continue
+            try:
+                self.refresh()
+                logging.info("Login session refreshed.")
+            except Exception as e:
+                logging.error(f"Failed to refresh login session: {e}")
+
+def clear_login_cookies(client: HTTPClient):
+    '''Drop the cookies of the login hosts from the shared jar, so that the login starts from scratch.
+
+    Otherwise a JAAuthCookie still accepted by jaccount skips the login page, which has the uuid of the captcha.'''
+    for cookie in list(client.cookies):
+        domain = cookie.domain.lstrip(".")
+        if any(host == domain or host.endswith("." + domain) for host in login_hosts):
+            client.cookies.clear(cookie.domain, cookie.path, cookie.name)
+
 
 def parse_params(url):
     return urllib.parse.parse_qs(url[url.find('?')+1:])
 
 
-def get_params_uuid_cookies(url):
-    r = requests.get(
+def get_params_uuid_cookies(url, client: HTTPClient = None):
+    r = (client or get_client()).get(
         url,
         headers={"accept-language": "zh-CN"}
     )
@@ -44,8 +106,8 @@ def get_params_uuid_cookies(url):
     return params, uuid, cookies, r.url
 
 
-def get_captcha_img(uuid, cookies, url2):
-    r = requests.get(
+def get_captcha_img(uuid, cookies, url2, client: HTTPClient = None):
+    r = (client or get_client()).get(
         "https://jaccount.sjtu.edu.cn/jaccount/captcha",
         params={
             "uuid": uuid,
@@ -58,9 +120,9 @@ def get_captcha_img(uuid, cookies, url2):
     )
     return r.content
 
-def solve_captcha(img):
+def solve_captcha(img, client: HTTPClient = None):
     try:
-        r = requests.post(
+        r = (client or get_client()).post(
             "https://plus.sjtu.edu.cn/captcha-solver/",
             files={"image": ("captcha.jpg", io.BytesIO(img))}
         )
@@ -69,8 +131,8 @@ def solve_captcha(img):
         raise Exception("Captcha solving failed.")
 
 
-def login_jaccount(username, password, uuid, captcha, params, cookies):
-    r = requests.post(
+def login_jaccount(username, password, uuid, captcha, params, cookies, client: HTTPClient = None):
+    r = (client or get_client()).post(
         "https://jaccount.sjtu.edu.cn/jaccount/ulogin",
         data={
             "user": username,
@@ -90,8 +152,8 @@ def login_jaccount(username, password, uuid, captcha, params, cookies):
     return cookies
 
 
-def login_Canvas(url, cookies):
-    r = requests.get(
+def login_Canvas(url, cookies, client: HTTPClient = None):
+    r = (client or get_client()).get(
         url,
         headers={"accept-language": "zh-CN"},
         cookies=cookies
@@ -100,12 +162,15 @@ def login_Canvas(url, cookies):
     for i in r.history:
         cookies.update(i.cookies)
 
-def test_login(cookies):
+def test_login(cookies, client: HTTPClient = None):
     '''Test whether the cookies are valid, return True if valid.'''
-    r = requests.get(
-        "https://oc.sjtu.edu.cn/",
-        cookies=cookies
-    )
+    with span("login_probe"):
+        r = (client or get_client()).get(
+            "https://oc.sjtu.edu.cn/api/v1/users/self",
+            cookies=cookies,
+            allow_redirects=False
+        )
+    count("login_probes", valid=r.status_code == 200)
     return r.status_code == 200
 
 if __name__ == "__main__":
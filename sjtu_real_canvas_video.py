@@ -1,85 +1,321 @@
-import requests
-from bs4 import BeautifulSoup
-from datetime import datetime
-
-
-def get_sub_cookies(course_id, oc_cookies):
-    data = {
-        i["name"]: i["value"]
-        for i in
-        BeautifulSoup(
-            requests.get(
-                f"https://oc.sjtu.edu.cn/courses/{course_id}/external_tools/162",
-                cookies=oc_cookies
-            ).content, "html.parser"
-        ).find(
-            "form",
-            attrs={
-                "action": "https://courses.sjtu.edu.cn/lti/launch"
-            }
-        ).children
-        if i.name == "input"
-    }
-
-    r = requests.post(
-        "https://courses.sjtu.edu.cn/lti/launch",
+from http_client import HTTPClient, get_client
+from metrics import span, count
+from html.parser import HTMLParser
+from datetime import datetime, timedelta
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, Future
+import codecs
+import json
+import logging
+import threading
+import time
+
+lti_launch_url = "https://courses.sjtu.edu.cn/lti/launch"
+
+
+class LTISessionExpired(Exception):
+    pass
+
+
+class _FormComplete(Exception):
+    pass
+
+
+class LaunchFormParser(HTMLParser):
+    '''Collect the inputs of the LTI launch form, and stop as soon as the form is closed.'''
+    def __init__(self):
+        super().__init__()
+        self.in_form = False
+        self.data = {}
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if tag == "form" and attrs.get("action") == lti_launch_url:
+            self.in_form = True
+        elif tag == "input" and self.in_form and "name" in attrs:
+            self.data[attrs["name"]] = attrs.get("value") or ""
+
+    def handle_endtag(self, tag):
+        if tag == "form" and self.in_form:
+            raise _FormComplete()
+
+
+def get_launch_form(course_id, oc_cookies, client: HTTPClient = None):
+    '''Fetch the external tool page and return the launch form, without reading the rest of the page.'''
+    client = client or get_client()
+    parser = LaunchFormParser()
+    with client.get(
+        f"https://oc.sjtu.edu.cn/courses/{course_id}/external_tools/162",
+        cookies=oc_cookies,
+        stream=True
+    ) as r:
+        decoder = codecs.getincrementaldecoder(r.encoding or "utf-8")(errors="replace")
+        try:
+            for chunk in r.iter_content(chunk_size=8192):
+                parser.feed(decoder.decode(chunk))
+            parser.feed(decoder.decode(b"", final=True))
+        except _FormComplete:
+            return parser.data
+    raise Exception(f"LTI launch form not found for course {course_id}.")
+
+
+def get_sub_cookies(course_id, oc_cookies, client: HTTPClient = None):
+    client = client or get_client()
+    with span("lti_launch", course=course_id):
+        data = get_launch_form(course_id, oc_cookies, client)
+
+        # each launch starts a new session on courses.sjtu.edu.cn, so don't reuse the session of another course
+        r = client.post(
+            lti_launch_url,
+            data=data,
+            allow_redirects=False,
+            session_cookies=False
+        )
+
+    return r.cookies, r.headers["location"].partition("?canvasCourseId=")[-1]
+
+
+class LTICache:
+    '''Cache the result of the LTI launch (sub_cookies, canvasCourseId) of each course for `ttl` seconds.'''
+    def __init__(self, ttl: float = 3600):
+        self.ttl = ttl
+        self.sessions = {}  # course_id : (sub_cookies, canvasCourseId, expires_at)
+        self.lock = threading.Lock()
+        self.relaunch_lock = threading.Lock()  # held while replacing a rejected session, so concurrent callers launch once
+
+    def get(self, course_id, oc_cookies, client: HTTPClient = None):
+        with self.lock:
+            session = self.sessions.get(course_id)
+        if session is not None and session[2] > time.time():
+            count("lti_cache", result="hit")
+            return session[0], session[1]
+        count("lti_cache", result="miss")
+        sub_cookies, canvasCourseId = get_sub_cookies(course_id, oc_cookies, client)
+        with self.lock:
+            self.sessions[course_id] = (sub_cookies, canvasCourseId, time.time() + self.ttl)
+        return sub_cookies, canvasCourseId
+
+    def invalidate(self, course_id):
+        with self.lock:
+            self.sessions.pop(course_id, None)
+
+    def relaunch(self, course_id, oc_cookies, stale, client: HTTPClient = None):
+        '''Launch again after `stale` (the sub_cookies of a session) was rejected, unless another caller already did.'''
+        with self.relaunch_lock:
+            with self.lock:
+                session = self.sessions.get(course_id)
+            if session is not None and session[0] is not stale and session[2] > time.time():
+                return session[0], session[1]
+            count("retries", stage="lti_launch")
+            self.invalidate(course_id)
+            return self.get(course_id, oc_cookies, client)
+
+
+def lti_api_call(url, data, sub_cookies, client: HTTPClient = None):
+    '''POST to an LTI API and return the body. Raise LTISessionExpired if courses.sjtu.edu.cn rejects the session.'''
+    r = (client or get_client()).post(
+        url,
         data=data,
+        cookies=sub_cookies,
         allow_redirects=False
     )
-
-    return r.cookies, r.headers["location"].partition("?canvasCourseId=")[-1]
+    if r.status_code in (401, 403) or r.is_redirect:
+        raise LTISessionExpired(f"LTI session rejected with status {r.status_code}.")
+    return r.json()["body"]
 
 
-def get_real_canvas_video_single(i, sub_cookies):
-    return requests.post(
-        "https://courses.sjtu.edu.cn/lti/vodVideo/getVodVideoInfos",
-        data={
-            "playTypeHls": "true",
-            "id": i["videoId"],
-            "isAudit": "true"
-        },
-        cookies=sub_cookies
-    ).json()["body"]
+def get_real_canvas_video_single(i, sub_cookies, client: HTTPClient = None):
+    with span("video_details"):
+        return lti_api_call(
+            "https://courses.sjtu.edu.cn/lti/vodVideo/getVodVideoInfos",
+            {
+                "playTypeHls": "true",
+                "id": i["videoId"],
+                "isAudit": "true"
+            },
+            sub_cookies,
+            client
+        )
 
 
 class RealCourse:
-    def __init__(self, i, sub_cookies):
+    def __init__(self, i, sub_cookies, client: HTTPClient = None, relaunch=None):
         self.info = i
         self.video_id = i["videoId"]
         self.start_time = datetime.strptime(i["courseBeginTime"], "%Y-%m-%d %H:%M:%S")
         self.sub_cookies = sub_cookies
+        self.client = client
+        self.relaunch = relaunch  # stale sub_cookies -> new sub_cookies, to retry once when the LTI session expired
         self.flag = False
         self.course = None
+        self.lock = threading.Lock()  # so that concurrent callers fetch the details only once
 
     def get(self):
-        if not self.flag:
-            self.flag = True
-            self.course = get_real_canvas_video_single(
-                self.info, self.sub_cookies
-            )
+        with self.lock:
+            if not self.flag:
+                try:
+                    self.course = get_real_canvas_video_single(self.info, self.sub_cookies, self.client)
+                except LTISessionExpired:
+                    if self.relaunch is None:
+                        raise
+                    self.sub_cookies = self.relaunch(self.sub_cookies)
+                    self.course = get_real_canvas_video_single(self.info, self.sub_cookies, self.client)
+                self.flag = True
         return self.course
 
     def __getitem__(self, key):
         return self.get()[key]
 
 
-def get_real_canvas_videos_using_sub_cookies(sub_cookies, canvasCourseId):
+detail_pool = ThreadPoolExecutor(thread_name_prefix="video-details")
+
+
+def resolve_details(videos: list[RealCourse], max_workers: int = 8) -> list[RealCourse]:
+    '''Fetch the details of many videos concurrently, and fill the cached `course` of each one.'''
+    pending = [i for i in videos if not i.flag]
+    if len(pending) == 1:
+        pending[0].get()
+    elif pending:
+        with ThreadPoolExecutor(min(max_workers, len(pending))) as pool:
+            list(pool.map(RealCourse.get, pending))  # re-raises the first failure
+    return videos
+
+
+def resolve_links(course_id, video_ids: list[str], oc_cookies, client: HTTPClient = None, cache: LTICache = None,
+        max_workers: int = 8) -> list[str]:
+    '''Fetch the signed links of videos again, e.g. for a job resumed after its links may have expired.'''
+    cache = cache or LTICache()
+    sub_cookies, _ = cache.get(course_id, oc_cookies, client)
+
+    def link(video_id):
+        try:
+            return get_real_canvas_video_single({"videoId": video_id}, sub_cookies, client)["rtmpUrlHdv"]
+        except LTISessionExpired:
+            fresh, _ = cache.relaunch(course_id, oc_cookies, sub_cookies, client)
+            return get_real_canvas_video_single({"videoId": video_id}, fresh, client)["rtmpUrlHdv"]
+
+    with ThreadPoolExecutor(max(1, min(max_workers, len(video_ids)))) as pool:
+        return list(pool.map(link, video_ids))
+
+
+def prefetch_details(videos: list[RealCourse], max_workers: int = 8) -> Future:
+    '''Start resolving the details in the background. Later accesses wait for the prefetch instead of fetching again.'''
+    return detail_pool.submit(resolve_details, videos, max_workers)
+
+
+def get_real_canvas_videos_using_sub_cookies(sub_cookies, canvasCourseId, client: HTTPClient = None, relaunch=None):
+    client = client or get_client()
     return [
         [
-            RealCourse(i, sub_cookies)
-            for i in requests.post(
+            RealCourse(i, sub_cookies, client, relaunch)
+            for i in lti_api_call(
                 "https://courses.sjtu.edu.cn/lti/vodVideo/findVodVideoList",
-                data={
+                {
                     "pageIndex": "1",
                     "pageSize": "1000",
                     "canvasCourseId": canvasCourseId
                 },
-                cookies=sub_cookies
-            ).json()["body"]["list"]
+                sub_cookies,
+                client
+            )["list"]
         ][::-1]
     ]
 
 
-def get_real_canvas_videos(course_id, oc_cookies):
-    sub_cookies, canvasCourseId = get_sub_cookies(course_id, oc_cookies)
-    return get_real_canvas_videos_using_sub_cookies(sub_cookies, canvasCourseId)
+def get_real_canvas_videos(course_id, oc_cookies, client: HTTPClient = None, cache: LTICache = None):
+    if cache is None:
+        sub_cookies, canvasCourseId = get_sub_cookies(course_id, oc_cookies, client)
+        return get_real_canvas_videos_using_sub_cookies(sub_cookies, canvasCourseId, client)
+    relaunch = lambda stale: cache.relaunch(course_id, oc_cookies, stale, client)[0]
+    sub_cookies, canvasCourseId = cache.get(course_id, oc_cookies, client)
+    try:
+        return get_real_canvas_videos_using_sub_cookies(sub_cookies, canvasCourseId, client, relaunch)
+    except LTISessionExpired:
+        # the cached session is stale, launch again once
+        sub_cookies, canvasCourseId = cache.relaunch(course_id, oc_cookies, sub_cookies, client)
+        return get_real_canvas_videos_using_sub_cookies(sub_cookies, canvasCourseId, client, relaunch)
+
+
+def fetch_listing(sub_cookies, canvasCourseId, since: str = None, page_size=20, client: HTTPClient = None):
+    '''Page through the listing newest first, until a page reaches videos that began before `since`
+    ("YYYY-MM-DD HH:MM:SS", the whole listing if None). Return the entries seen, oldest first.'''
+    entries = []
+    page_index = 1
+    while True:
+        page = lti_api_call(
+            "https://courses.sjtu.edu.cn/lti/vodVideo/findVodVideoList",
+            {
+                "pageIndex": str(page_index),
+                "pageSize": str(page_size),
+                "canvasCourseId": canvasCourseId
+            },
+            sub_cookies,
+            client
+        )["list"]
+        count("listing_pages")
+        entries += page
+        if len(page) < page_size or (since and any(i["courseBeginTime"] < since for i in page)):
+            return entries[::-1]
+        page_index += 1
+
+
+class VideoCatalog:
+    '''The video listing of each course, kept in `data_dir` and updated incrementally.
+
+    Each fetch pages through the videos of the last `window` days, so a clip published late (e.g. the first clip of a
+    day, after the second one) is still found, and edited or deleted entries in the window are replaced. Every
+    `resync_every` fetches of a course (and the first one after a start), the whole listing is fetched instead, which
+    also drops older entries deleted since.'''
+    def __init__(self, data_dir=None, page_size: int = 20, cache: LTICache = None, window: float = 2, resync_every: int = 24):
+        self.path = Path(data_dir) / "catalog.json" if data_dir else None
+        self.page_size = page_size
+        self.cache = cache or LTICache()
+        self.window = window
+        self.resync_every = resync_every
+        self.courses = {}  # course_id : list of video infos, oldest first
+        self.fetches = {}  # course_id : number of fetches since the last full listing
+        self.lock = threading.Lock()
+        if self.path and self.path.exists():
+            try:
+                with self.path.open("r") as f:
+                    self.courses = json.load(f)
+            except (OSError, ValueError) as e:
+                logging.warning(f"Failed to read video catalog {self.path}: {e}")
+
+    def fetch(self, course_id, oc_cookies, client: HTTPClient = None) -> list[RealCourse]:
+        '''Update the listing of a course and return all its videos, oldest first.'''
+        key = str(course_id)  # json keys are strings
+        with self.lock:
+            entries = self.courses.get(key, [])
+            full = key not in self.fetches or self.fetches[key] + 1 >= self.resync_every
+        since = None if full else (datetime.now() - timedelta(days=self.window)).strftime("%Y-%m-%d %H:%M:%S")
+        with span("listing", course=course_id, full=full):
+            sub_cookies, canvasCourseId = self.cache.get(course_id, oc_cookies, client)
+            try:
+                fetched = fetch_listing(sub_cookies, canvasCourseId, since, self.page_size, client)
+            except LTISessionExpired:
+                sub_cookies, canvasCourseId = self.cache.relaunch(course_id, oc_cookies, sub_cookies, client)
+                fetched = fetch_listing(sub_cookies, canvasCourseId, since, self.page_size, client)
+        # the fetched part of the listing replaces what was known of it, the rest is kept
+        fetched_ids = {i["videoId"] for i in fetched}
+        kept = [i for i in entries if i["videoId"] not in fetched_ids and since and i["courseBeginTime"] < since]
+        updated = sorted(kept + fetched, key=lambda i: i["courseBeginTime"])
+        new = len(fetched_ids - {i["videoId"] for i in entries})
+        count("videos_listed", new)
+        with self.lock:
+            self.fetches[key] = 0 if full else self.fetches[key] + 1
+            if updated != entries:
+                logging.debug(f"Listing of course {course_id} changed: {new} new videos, {len(entries) + new - len(updated)} removed.")
+                entries = self.courses[key] = updated
+                self.save()
+        # the details are fetched later, possibly after the session expired
+        relaunch = lambda stale: self.cache.relaunch(course_id, oc_cookies, stale, client)[0]
+        return [RealCourse(i, sub_cookies, client, relaunch) for i in entries]
+
+    def save(self):
+        if self.path is None:
+            return
+        tmp_path = self.path.with_suffix(".tmp")
+        with tmp_path.open("w") as f:
+            json.dump(self.courses, f)
+        tmp_path.replace(self.path)
@@ -0,0 +1,51 @@
+from typing import NamedTuple, Iterable, Iterator
+
+class Cue(NamedTuple):
+	start: float	# in seconds
+	end: float	# in seconds
+	text: str
+
+def format_timestamp(seconds: float) -> str:
+	milliseconds = round(seconds * 1000)
+	hours, milliseconds = divmod(milliseconds, 3600000)
+	minutes, milliseconds = divmod(milliseconds, 60000)
+	seconds, milliseconds = divmod(milliseconds, 1000)
+	return f"{hours:02d}:{minutes:02d}:{seconds:02d},{milliseconds:03d}"
+
+def parse_timestamp(timestamp: str) -> float:
+	hms, _, milliseconds = timestamp.strip().replace('.', ',').partition(',')
+	hours, minutes, seconds = hms.split(':')
+	return int(hours) * 3600 + int(minutes) * 60 + int(seconds) + int(milliseconds or 0) / 1000
+
+def iter_cues(lines: Iterable[str]) -> Iterator[Cue]:
+	'''Parse SRT cues one at a time from an iterable of lines, such as an open file.'''
+	timing = None
+	text = []
+	for line in lines:
+		line = line.rstrip('\r\n')
+		if timing is None:
+			if ' --> ' in line:
+				start, _, end = line.partition(' --> ')
+				timing = (parse_timestamp(start), parse_timestamp(end.split(' ')[0]))
+			continue	# the cue number, or blank lines between cues
+		if line:
+			text.append(line)
+		else:
+			yield Cue(*timing, '\n'.join(text))
+			timing = None
+			text = []
+	if timing is not None:
+		yield Cue(*timing, '\n'.join(text))
+
+def read_srt(path) -> list[Cue]:
+	with open(path, 'r', encoding='utf-8') as f:
+		return list(iter_cues(f))
+
+def write_srt(cues: Iterable[Cue], path):
+	with open(path, 'w', encoding='utf-8') as f:
+		for i, cue in enumerate(cues, start=1):
+			f.write(f"{i}\n{format_timestamp(cue.start)} --> {format_timestamp(cue.end)}\n{cue.text}\n\n")
+
+def shift_cues(cues: Iterable[Cue], offset: float) -> Iterator[Cue]:
+	for cue in cues:
+		yield Cue(cue.start + offset, cue.end + offset, cue.text)
@@ -0,0 +1,147 @@
+'''Tests of `aria2_rpc` against the stand-in `bench/fake_aria2.py`, run from the repository root:
+
+	python -m unittest discover -s tests'''
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from pathlib import Path
+
+root = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(root))
+
+from aria2_rpc import Aria2Service, Aria2Error, websocket_messages
+from bench.fake_aria2 import FakeAria2
+
+fake_aria2 = str(root / "bench" / "fake_aria2.py")
+
+def free_port() -> int:
+	with socket.socket() as s:
+		s.bind(("127.0.0.1", 0))
+		return s.getsockname()[1]
+
+def wait_for(condition, timeout: float = 5) -> bool:
+	deadline = time.time() + timeout
+	while time.time() < deadline:
+		if condition():
+			return True
+		time.sleep(0.05)
+	return False
+
+class Aria2ServiceTest(unittest.TestCase):
+	def setUp(self):
+		self.dir = tempfile.TemporaryDirectory()
+		self.service = Aria2Service([fake_aria2], free_port(), executable=sys.executable)
+		self.service.start()
+
+	def tearDown(self):
+		self.service.stop()
+		self.dir.cleanup()
+
+	def test_download_completes(self):
+		start = time.time()
+		self.service.download(["fake://a?size=32", "fake://b?size=8&delay=0.2"], ["a.bin", "b.bin"], self.dir.name, tag="job")
+		self.assertLess(time.time() - start, 5)	# woken by the notifications, not by the check after a minute
+		self.assertEqual((Path(self.dir.name) / "a.bin").stat().st_size, 32)
+		self.assertEqual((Path(self.dir.name) / "b.bin").stat().st_size, 8)
+		self.assertEqual(self.service.tags, {})
+
+	def test_progress(self):
+		gid = self.service.add("fake://a?size=64&delay=1", "a.bin", self.dir.name, tag="job")
+		progress = self.service.progress("job")
+		self.assertEqual(progress["total"], 64)
+		self.assertEqual(progress["speed"], 1024)
+		self.service.wait(gid)
+		self.assertEqual(self.service.progress("other")["total"], 0)
+
+	def test_download_error(self):
+		with self.assertRaises(Aria2Error) as raised:
+			self.service.download(["fake://a", "fake://b?fail=29"], ["a.bin", "b.bin"], self.dir.name)
+		self.assertEqual(raised.exception.code, "29")
+		self.assertIn("Simulated failure", str(raised.exception))
+
+	def test_failure_removes_the_rest(self):
+		with self.assertRaises(Aria2Error):
+			self.service.download(["fake://a?fail=3", "fake://b?delay=0.5"], ["a.bin", "b.bin"], self.dir.name, tag="job")
+		self.assertTrue(wait_for(lambda: not self.service.abandoned))	# the notification of the removal is ignored
+		time.sleep(0.6)
+		self.assertFalse((Path(self.dir.name) / "b.bin").exists())
+		self.assertEqual(self.service.results, {})
+		self.assertEqual(self.service.tags, {})
+
+	def test_rpc_error(self):
+		with self.assertRaises(Aria2Error) as raised:
+			self.service.call("aria2.tellStatus", "0000000000000000")
+		self.assertIn("not found", str(raised.exception))
+
+	def test_reconnect(self):
+		self.service.call("fake.dropConnections")
+		self.assertTrue(wait_for(lambda: self.service.call("fake.stats")["opened"] == 2 and self.service.connected.is_set()))
+		start = time.time()
+		self.service.download(["fake://a"], ["a.bin"], self.dir.name)
+		self.assertLess(time.time() - start, 5)
+
+	def test_change_global_option(self):
+		self.service.change_global_option(max_overall_download_limit="1M")
+		self.assertEqual(self.service.call("aria2.tellStatus", self.service.add("fake://a", "a.bin", self.dir.name))["status"], "active")
+
+class StopWithProcessTest(unittest.TestCase):
+	def test_aria2c_stops_when_the_daemon_is_killed(self):
+		port = free_port()
+		code = (f"import sys, time; sys.path.insert(0, {str(root)!r}); from aria2_rpc import Aria2Service; "
+			f"s = Aria2Service([{fake_aria2!r}], {port}, executable=sys.executable); s.start(); "
+			f"print(s.process.pid, flush=True); time.sleep(60)")
+		daemon = subprocess.Popen([sys.executable, "-c", code], stdout=subprocess.PIPE, text=True)
+		try:
+			aria2c = int(daemon.stdout.readline())
+		finally:
+			daemon.kill()
+			daemon.wait()
+
+		def gone():
+			try:
+				os.kill(aria2c, 0)
+			except ProcessLookupError:
+				return True
+			try:	# exited but not reaped yet, as its parent was killed
+				return os.waitpid(aria2c, os.WNOHANG)[0] != 0
+			except ChildProcessError:
+				return False
+		self.assertTrue(wait_for(gone))
+
+class WebSocketTest(unittest.TestCase):
+	def setUp(self):
+		self.fake = FakeAria2(free_port())
+		threading.Thread(target=self.fake.serve, daemon=True).start()
+
+	def tearDown(self):
+		self.fake.stop()
+		self.fake.server.server_close()
+
+	def test_messages(self):
+		messages = []
+		opened = threading.Event()
+
+		def listen():
+			for message in websocket_messages("127.0.0.1", self.fake.server.server_address[1], "/jsonrpc", on_open=opened.set):
+				messages.append(json.loads(message))
+		thread = threading.Thread(target=listen, daemon=True)
+		thread.start()
+		self.assertTrue(opened.wait(5))
+		self.assertTrue(wait_for(lambda: self.fake.rpc_stats()["open"] == 1))
+		self.fake.notify("aria2.onDownloadComplete", "a")
+		self.fake.notify("aria2.onDownloadComplete", "b" * 300)	# a 16-bit payload length
+		self.fake.notify("aria2.onDownloadComplete", "c" * 70000)	# a 64-bit payload length
+		self.assertTrue(wait_for(lambda: len(messages) == 3))
+		self.assertEqual([len(m["params"][0]["gid"]) for m in messages], [1, 300, 70000])
+		self.fake.rpc_dropConnections()
+		thread.join(5)
+		self.assertFalse(thread.is_alive())
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import logging
+import os
+import socket
+import socketserver
+import struct
+from pathlib import Path
+from typing import TYPE_CHECKING
+from subtitle import Cue, write_srt
+if TYPE_CHECKING:
+	from config import Config	# pydantic is slow to import, and process_video only needs the client side
+
+CLI_description = '''Run a transcription worker that keeps the whisper model loaded and serves jobs over a Unix socket.'''
+
+class WorkerError(Exception):
+	pass
+
+# whisper-ctranslate2 takes language names, faster-whisper takes codes
+language_codes = {
+	"chinese": "zh", "english": "en", "japanese": "ja", "korean": "ko",
+	"french": "fr", "german": "de", "spanish": "es", "russian": "ru",
+}
+
+def str_to_bool(v: str) -> bool:
+	return v.lower() in ("true", "1", "yes")
+
+def parse_whisper_args(whisper_args: list[str]) -> tuple[dict, dict]:
+	'''Split whisper-ctranslate2 arguments into the options of the model and of `transcribe`. Unknown ones are ignored.'''
+	parser = argparse.ArgumentParser(add_help=False)
+	parser.add_argument("--model", default="large-v2")
+	parser.add_argument("--model_directory", default=None)
+	parser.add_argument("--device", default="auto")
+	parser.add_argument("--compute_type", default="default")
+	parser.add_argument("--threads", type=int, default=0)
+	parser.add_argument("--language", default=None)
+	parser.add_argument("--task", default="transcribe")
+	parser.add_argument("--beam_size", type=int, default=5)
+	parser.add_argument("--best_of", type=int, default=5)
+	parser.add_argument("--vad_filter", type=str_to_bool, default=False)
+	parser.add_argument("--condition_on_previous_text", type=str_to_bool, default=True)
+	args, _ = parser.parse_known_args(whisper_args)
+	model_options = {
+		"model_size_or_path": args.model_directory or args.model,
+		"device": args.device,
+		"compute_type": args.compute_type,
+		"cpu_threads": args.threads,
+	}
+	language = args.language
+	if language is not None:
+		language = language_codes.get(language.lower(), language.lower())
+	transcribe_options = {
+		"language": language,
+		"task": args.task,
+		"beam_size": args.beam_size,
+		"best_of": args.best_of,
+		"vad_filter": args.vad_filter,
+		"condition_on_previous_text": args.condition_on_previous_text,
+	}
+	return model_options, transcribe_options
+
+def map_wav(path):
+	'''Read the samples of a 16 kHz mono 16-bit PCM WAV file as float32, without decoding it through ffmpeg again.
+	Return None for any other file, which is then left to faster-whisper to decode.
+
+	faster-whisper needs the whole float32 array in memory (4 bytes per sample, about 230 MB per hour). The int16
+	samples are only memory-mapped, and converted in windows straight into that array, so no second copy is made.'''
+	import numpy as np
+	with open(path, 'rb') as f:
+		if f.read(12)[8:] != b"WAVE":
+			return None
+		while header := f.read(8):
+			chunk_id, size = struct.unpack("<4sI", header)
+			if chunk_id == b"fmt ":
+				audio_format, channels, sample_rate, _, _, bits = struct.unpack("<HHIIHH", f.read(16))
+				if (audio_format, channels, sample_rate, bits) != (1, 1, 16000, 16):
+					return None
+				f.seek(size - 16 + size % 2, os.SEEK_CUR)
+			elif chunk_id == b"data":
+				offset = f.tell()
+				break
+			else:
+				f.seek(size + size % 2, os.SEEK_CUR)	# chunks are padded to an even size
+		else:
+			return None
+	samples = np.memmap(path, dtype="<i2", mode='r', offset=offset, shape=(size // 2,))
+	audio = np.empty(len(samples), dtype=np.float32)
+	window = 1 << 20
+	for start in range(0, len(samples), window):
+		np.multiply(samples[start:start + window], 1 / 32768.0, out=audio[start:start + window], casting='unsafe')
+	return audio
+
+pool_worker = None	# the TranscribeWorker of a process of a shard pool, see `process_video.shard_pool`
+
+def init_pool_worker(whisper_args: list[str]):
+	global pool_worker
+	pool_worker = TranscribeWorker(whisper_args)
+
+def pool_transcribe(input_file: str, output_dir: str, initial_prompt: str = "") -> str:
+	return pool_worker.transcribe(input_file, output_dir, initial_prompt)
+
+def worker_socket_path(config: 'Config') -> Path:
+	return Path(config.data_dir) / "transcribe_worker.sock"
+
+class TranscribeWorker:
+	'''Keep a whisper model in memory, and transcribe one file after another into SRT files.'''
+	def __init__(self, whisper_args: list[str]):
+		from faster_whisper import WhisperModel	# heavy, only needed in the worker process
+		model_options, self.transcribe_options = parse_whisper_args(whisper_args)
+		logging.info(f"Loading whisper model {model_options['model_size_or_path']}...")
+		self.model = WhisperModel(**model_options)
+
+	def transcribe(self, input_file: str, output_dir: str, initial_prompt: str = "", whisper_args: list[str] = None) -> str:
+		options = dict(self.transcribe_options)
+		if whisper_args:
+			options.update(parse_whisper_args(whisper_args)[1])	# the model stays the one loaded at startup
+		audio = map_wav(input_file) if input_file.endswith(".wav") else None
+		segments, _ = self.model.transcribe(input_file if audio is None else audio, initial_prompt=initial_prompt or None, **options)
+		srt_file = Path(output_dir) / f"{Path(input_file).stem}.srt"
+		write_srt((Cue(segment.start, segment.end, segment.text.strip()) for segment in segments), srt_file)
+		return str(srt_file)
+
+	def serve(self, socket_path: Path):
+		'''Serve jobs one at a time. Each connection sends one JSON line and gets one JSON line back.'''
+		worker = self
+		class Handler(socketserver.StreamRequestHandler):
+			def handle(self):
+				request = json.loads(self.rfile.readline())
+				logging.info(f"Transcribing {request['input']}...")
+				try:
+					srt_file = worker.transcribe(request["input"], request["output_dir"],
+						request.get("initial_prompt", ""), request.get("whisper_args"))
+					response = {"ok": True, "srt": srt_file}
+				except Exception as e:
+					logging.error(f"Failed to transcribe {request['input']}: {e}", exc_info=True)
+					response = {"ok": False, "error": str(e)}
+				self.wfile.write(json.dumps(response).encode() + b"\n")
+
+		socket_path.unlink(missing_ok=True)
+		with socketserver.UnixStreamServer(str(socket_path), Handler) as server:
+			os.chmod(socket_path, 0o600)
+			logging.info(f"Transcription worker listening on {socket_path}.")
+			try:
+				server.serve_forever()
+			finally:
+				socket_path.unlink(missing_ok=True)
+
+def transcribe_with_worker(socket_path: Path, input_file: Path, output_dir: Path, initial_prompt: str = "", whisper_args: list[str] = None) -> Path:
+	'''Send a job to a running worker and wait for the SRT file. Raise OSError if no worker is listening.'''
+	with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+		sock.connect(str(socket_path))
+		request = {"input": str(input_file), "output_dir": str(output_dir), "initial_prompt": initial_prompt, "whisper_args": whisper_args}
+		sock.sendall(json.dumps(request).encode() + b"\n")
+		with sock.makefile('rb') as f:
+			line = f.readline()
+	if not line:
+		raise WorkerError("Transcription worker closed the connection.")
+	response = json.loads(line)
+	if not response["ok"]:
+		raise WorkerError(response["error"])
+	return Path(response["srt"])
+
+def setup_parser(parser: argparse.ArgumentParser):
+	from config import default_config_path
+	parser.add_argument("-c", "--config", help="Path to the configuration file.", default=default_config_path)
+
+def main(args: argparse.Namespace):
+	from config import load_config
+	config = load_config(args.config)
+	TranscribeWorker(config.whisper_args).serve(worker_socket_path(config))
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description=CLI_description)
+	setup_parser(parser)
+	args = parser.parse_args()
+	main(args)
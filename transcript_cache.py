@@ -0,0 +1,41 @@
+import hashlib
+import json
+from pathlib import Path
+from subtitle import Cue, read_srt, write_srt
+from transcribe_worker import parse_whisper_args
+
+def hash_file(path, chunk_size: int = 1 << 20) -> str:
+	'''Content hash of a file, read in chunks so that large clips don't have to fit in memory.'''
+	h = hashlib.blake2b(digest_size=20)
+	with open(path, 'rb') as f:
+		while chunk := f.read(chunk_size):
+			h.update(chunk)
+	return h.hexdigest()
+
+class TranscriptCache:
+	'''Transcripts of single clips in `data_dir/transcripts`, with timestamps relative to the start of the clip.
+
+	Entries are keyed by the content hash of the clip plus the model, language and initial prompt, so that a
+	merged subtitle track can be assembled from cached clips and only new clips need to be transcribed.'''
+	def __init__(self, data_dir):
+		self.dir = Path(data_dir) / "transcripts"
+		self.dir.mkdir(parents=True, exist_ok=True)
+
+	def key(self, clip_hash: str, whisper_args: list[str], initial_prompt: str, skip_silence: bool = False) -> str:
+		model_options, transcribe_options = parse_whisper_args(whisper_args)
+		settings = [clip_hash, model_options["model_size_or_path"], transcribe_options["language"], initial_prompt]
+		if skip_silence:
+			settings.append("skip_silence")	# appended only when set, so that earlier entries keep their keys
+		return hashlib.blake2b(json.dumps(settings).encode(), digest_size=20).hexdigest()
+
+	def get(self, key: str) -> list[Cue] | None:
+		path = self.dir / f"{key}.srt"
+		if not path.exists():
+			return None
+		return read_srt(path)
+
+	def put(self, key: str, cues: list[Cue]):
+		path = self.dir / f"{key}.srt"
+		tmp_path = path.with_suffix('.tmp')
+		write_srt(cues, tmp_path)
+		tmp_path.replace(path)
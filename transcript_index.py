@@ -0,0 +1,101 @@
+import sqlite3
+import threading
+from pathlib import Path
+from typing import Iterable, NamedTuple
+from subtitle import Cue
+
+class Match(NamedTuple):
+	course: str
+	date: str	# YYYY-MM-DD, or empty if unknown
+	file: str	# the lecture the transcript belongs to
+	start: int	# in milliseconds
+	end: int	# in milliseconds
+	text: str
+
+def bigrams(text: str) -> str:
+	'''The pairs of successive characters of `text` and its last character, separated by spaces.'''
+	return " ".join([text[i:i + 2] for i in range(len(text) - 1)] + [text[-1:]])
+
+def short_term_query(term: str) -> str | None:
+	'''The FTS5 query of the bigram index for a term of one or two characters, or None if it has no letter or digit.'''
+	if not any(c.isalnum() for c in term):
+		return None	# the unicode61 tokenizer drops punctuation, so there is no token to look up
+	quoted = '"' + term.replace('"', '""') + '"'
+	return quoted + "*" if len(term) == 1 else quoted
+
+class TranscriptIndex:
+	'''A full-text index of all transcripts in `data_dir/transcripts.db`, one row per cue.
+
+	The cues are indexed with the FTS5 trigram tokenizer, which matches any substring of three or more characters and
+	so works for Chinese text without word segmentation. Shorter terms, such as most Chinese words, are looked up in a
+	second, contentless index of the character bigrams of each cue (see `bigrams`), with the same rowids.'''
+	def __init__(self, data_dir):
+		self.db_file = self.path(data_dir)
+		self.db = sqlite3.connect(self.db_file, check_same_thread=False)
+		self.lock = threading.Lock()
+		with self.lock, self.db:
+			self.db.execute("PRAGMA journal_mode=WAL")
+			self.db.execute("CREATE TABLE IF NOT EXISTS lectures (id INTEGER PRIMARY KEY, course TEXT, date TEXT, file TEXT UNIQUE)")
+			self.db.execute("CREATE VIRTUAL TABLE IF NOT EXISTS cues USING fts5("
+				"text, lecture UNINDEXED, start UNINDEXED, end UNINDEXED, tokenize='trigram')")
+			self.db.execute("CREATE VIRTUAL TABLE IF NOT EXISTS cue_bigrams USING fts5(bigrams, content='', tokenize='unicode61')")
+			if self.db.execute("PRAGMA user_version").fetchone()[0] < 1:	# an index created before the bigrams were added
+				self.db.executemany("INSERT INTO cue_bigrams (rowid, bigrams) VALUES (?, ?)",
+					((rowid, bigrams(text)) for rowid, text in self.db.execute("SELECT rowid, text FROM cues").fetchall()))
+				self.db.execute("PRAGMA user_version = 1")
+
+	@staticmethod
+	def path(data_dir) -> Path:
+		return Path(data_dir) / "transcripts.db"
+
+	def add(self, course: str, date: str, file, cues: Iterable[Cue]):
+		'''Index the transcript of a lecture, replacing any earlier transcript of the same file.'''
+		with self.lock, self.db:
+			row = self.db.execute("SELECT id FROM lectures WHERE file = ?", (str(file),)).fetchone()
+			if row:
+				# a contentless table is deleted from with the indexed values
+				self.db.executemany("INSERT INTO cue_bigrams (cue_bigrams, rowid, bigrams) VALUES ('delete', ?, ?)",
+					((rowid, bigrams(text)) for rowid, text in self.db.execute("SELECT rowid, text FROM cues WHERE lecture = ?", row).fetchall()))
+				self.db.execute("DELETE FROM cues WHERE lecture = ?", row)
+				self.db.execute("UPDATE lectures SET course = ?, date = ? WHERE id = ?", (course, date, row[0]))
+				lecture = row[0]
+			else:
+				lecture = self.db.execute("INSERT INTO lectures (course, date, file) VALUES (?, ?, ?)",
+					(course, date, str(file))).lastrowid
+			for cue in cues:
+				rowid = self.db.execute("INSERT INTO cues (text, lecture, start, end) VALUES (?, ?, ?, ?)",
+					(cue.text, lecture, round(cue.start * 1000), round(cue.end * 1000))).lastrowid
+				self.db.execute("INSERT INTO cue_bigrams (rowid, bigrams) VALUES (?, ?)", (rowid, bigrams(cue.text)))
+
+	def search(self, query: str, course: str = None, limit: int = 50) -> list[Match]:
+		'''Find the cues containing all the terms of `query` (separated by spaces), newest lectures first.'''
+		terms = query.split()
+		long_terms = [t for t in terms if len(t) >= 3]
+		short_queries = [q for q in (short_term_query(t) for t in terms if len(t) < 3) if q]
+		conditions = []
+		params = []
+		if long_terms:
+			conditions.append("cues MATCH ?")
+			params.append(" AND ".join('"' + t.replace('"', '""') + '"' for t in long_terms))
+		if short_queries:
+			conditions.append("cues.rowid IN (SELECT rowid FROM cue_bigrams WHERE cue_bigrams MATCH ?)")
+			params.append(" AND ".join(short_queries))
+		for term in terms:
+			if len(term) < 3:
+				# the exact term, as the bigram tokens ignore case and punctuation (and not LIKE, which the trigram
+				# tokenizer of some SQLite versions gets wrong for short patterns)
+				conditions.append("instr(cues.text, ?) > 0")
+				params.append(term)
+		if course:
+			conditions.append("lectures.course = ?")
+			params.append(course)
+		if not conditions:
+			return []
+		sql = ("SELECT lectures.course, lectures.date, lectures.file, cues.start, cues.end, cues.text "
+			"FROM cues JOIN lectures ON lectures.id = cues.lecture "
+			f"WHERE {' AND '.join(conditions)} ORDER BY lectures.date DESC, cues.start LIMIT ?")
+		with self.lock:
+			return [Match(*row) for row in self.db.execute(sql, (*params, limit))]
+
+	def close(self):
+		self.db.close()